@@ -0,0 +1,55 @@
+"""
+DB access from coroutines (the async views).
+
+A coroutine waiting on MercadoLibre must not hold a DB connection, or a
+process serving hundreds of slow scrapes needs hundreds of connections.
+run_db() runs a sync DB step in the request's sync thread and closes the
+connection right after. Every step takes one of the ASGI_DB_CONNECTIONS
+slots of the process, so a burst of requests queues here instead of
+exhausting the server's max_connections. Streaming exports keep their
+cursor's connection until the client has read the last byte, however slow
+it is, so they take one of the separate ASGI_EXPORT_CONNECTIONS slots
+instead: slow downloads never hold up the DB steps of other requests.
+"""
+import asyncio
+import weakref
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import connection
+
+_slots = weakref.WeakKeyDictionary() # event loop -> {setting name: asyncio.Semaphore}
+
+
+def _loop_semaphore(setting):
+    slots = _slots.setdefault(asyncio.get_running_loop(), {})
+    if setting not in slots:
+        slots[setting] = asyncio.Semaphore(max(1, getattr(settings, setting)))
+    return slots[setting]
+
+
+def db_slot():
+    """Semaphore of the running event loop counting the DB connections in use (`async with db_slot():`)."""
+    return _loop_semaphore('ASGI_DB_CONNECTIONS')
+
+
+def export_slot():
+    """db_slot() for the connections of streaming exports, held for a whole download."""
+    return _loop_semaphore('ASGI_EXPORT_CONNECTIONS')
+
+
+def close_connection():
+    connection.close()
+
+
+def _call_and_close(func, args, kwargs):
+    try:
+        return func(*args, **kwargs)
+    finally:
+        close_connection()
+
+
+async def run_db(func, *args, **kwargs):
+    """`func(*args, **kwargs)` through sync_to_async, without keeping the thread's DB connection open."""
+    async with db_slot():
+        return await sync_to_async(_call_and_close)(func, args, kwargs)
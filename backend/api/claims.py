@@ -0,0 +1,172 @@
+"""
+Single-flight coalescing of page fetches.
+
+Before fetching, a scrape run claims each page it needs in the PageClaim
+table. Only the run holding the claim fetches the page; other runs that
+need it at the same time wait for the claim to finish and reuse the rows
+it stored, so N concurrent requests for one term cost one fetch per page.
+"""
+import asyncio
+import time
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from .asyncdb import run_db
+from .models import PageClaim
+
+# How often a waiting run re-reads the claims it is waiting on
+WAIT_POLL_INTERVAL = 0.25
+
+
+def new_owner():
+    """Unique id of one scrape run."""
+    return uuid.uuid4().hex
+
+
+def _claim_expiry():
+    return timezone.now() + timedelta(seconds=settings.PAGE_CLAIM_TTL)
+
+
+def _reusable(claim, now):
+    """
+    Result of a finished claim that can stand in for a fetch, or None. Only
+    claims finished within PAGE_CLAIM_REUSE_TTL count: older ones are taken
+    over and the page is fetched again.
+    """
+    if claim.updated_at < now - timedelta(seconds=settings.PAGE_CLAIM_REUSE_TTL):
+        return None
+    if claim.status == PageClaim.STATUS_STORED:
+        return PageClaim.STATUS_STORED # The rows are in the DB already
+    if claim.status == PageClaim.STATUS_EMPTY:
+        return PageClaim.STATUS_EMPTY # Recently seen past the last page
+    return None
+
+
+def claim_pages(search_query, pages, owner):
+    """
+    Claim `pages` of `search_query` for the run `owner`.
+
+    Returns (claimed, finished, waiting):
+      claimed  - pages this run must fetch
+      finished - {page: status} of pages another run already stored or found empty
+      waiting  - pages another run is fetching right now
+    """
+    now = timezone.now()
+    existing = {
+        claim.page: claim
+        for claim in PageClaim.objects.filter(search_query=search_query, page__in=pages)
+    }
+    claimed, finished, waiting = [], {}, []
+
+    for page in pages:
+        claim = existing.get(page)
+        if claim is None:
+            try:
+                with transaction.atomic():
+                    PageClaim.objects.create(
+                        search_query=search_query, page=page, owner=owner, expires_at=_claim_expiry()
+                    )
+            except IntegrityError:
+                waiting.append(page) # Another run claimed it since we looked
+            else:
+                claimed.append(page)
+            continue
+
+        if claim.status == PageClaim.STATUS_FETCHING and claim.expires_at > now:
+            waiting.append(page)
+            continue
+
+        reused = _reusable(claim, now)
+        if reused is not None:
+            finished[page] = reused
+            continue
+
+        # Failed, abandoned or outdated claim: take it over, unless another run just did
+        taken = PageClaim.objects.filter(
+            pk=claim.pk, owner=claim.owner, status=claim.status, expires_at=claim.expires_at
+        ).update(status=PageClaim.STATUS_FETCHING, owner=owner, expires_at=_claim_expiry())
+        if taken:
+            claimed.append(page)
+        else:
+            waiting.append(page)
+
+    return claimed, finished, waiting
+
+
+def finish_claim(search_query, page, owner, status):
+    """Record the outcome of a claimed page so waiting runs can use it."""
+    PageClaim.objects.filter(search_query=search_query, page=page, owner=owner).update(status=status)
+
+
+def mark_page_stored(search_query, page, owner):
+    """
+    Record that `owner` stored `page` without claiming it first (a refresh),
+    unless another run is fetching it right now. The claim's updated_at then
+    tells retention (see retention.expired_products()) when the page was last stored.
+    """
+    now = timezone.now()
+    updated = PageClaim.objects.filter(search_query=search_query, page=page).exclude(
+        status=PageClaim.STATUS_FETCHING, expires_at__gt=now,
+    ).update(status=PageClaim.STATUS_STORED, owner=owner, expires_at=now)
+    if updated:
+        return
+    try:
+        with transaction.atomic():
+            PageClaim.objects.create(
+                search_query=search_query, page=page, owner=owner, status=PageClaim.STATUS_STORED, expires_at=now
+            )
+    except IntegrityError:
+        pass # Being fetched by another run, which records it when done
+
+
+def release_claims(search_query, owner):
+    """Drop the claims of `owner` that were never fetched (e.g. cancelled pages)."""
+    PageClaim.objects.filter(
+        search_query=search_query, owner=owner, status=PageClaim.STATUS_FETCHING
+    ).delete()
+
+
+def _finished_claims(search_query, pending):
+    """(page, status) of the claims in `pending` that are no longer being fetched, removed from `pending`."""
+    now = timezone.now()
+    claims = {
+        claim.page: claim
+        for claim in PageClaim.objects.filter(search_query=search_query, page__in=pending)
+    }
+    finished = []
+    for page in sorted(pending):
+        claim = claims.get(page)
+        if claim is None or (claim.status == PageClaim.STATUS_FETCHING and claim.expires_at <= now):
+            finished.append((page, PageClaim.STATUS_FAILED))
+        elif claim.status != PageClaim.STATUS_FETCHING:
+            finished.append((page, claim.status))
+    pending.difference_update(page for page, _ in finished)
+    return finished
+
+
+def wait_for_claims(search_query, pages):
+    """
+    Block until the claims on `pages` are no longer being fetched.
+
+    Yields (page, status) as each one finishes. A claim that expires or
+    disappears while waiting is reported as failed.
+    """
+    pending = set(pages)
+    while pending:
+        yield from _finished_claims(search_query, pending)
+        if pending:
+            time.sleep(WAIT_POLL_INTERVAL)
+
+
+async def wait_for_claims_async(search_query, pages):
+    """wait_for_claims() for coroutines: the claims are read with run_db() and the poll interval is awaited."""
+    pending = set(pages)
+    while pending:
+        for finished in await run_db(_finished_claims, search_query, pending):
+            yield finished
+        if pending:
+            await asyncio.sleep(WAIT_POLL_INTERVAL)
@@ -0,0 +1,363 @@
+"""
+Streaming exports of stored products: CSV, gzip-compressed CSV, NDJSON,
+and (when pyarrow is installed) Parquet and Arrow IPC.
+
+Rows are read through a chunked server-side cursor and rendered by a
+generator, so memory stays flat and the first bytes go out before the
+last row has been read. Parquet gets one row group per chunk of rows and
+Arrow one record batch per chunk.
+
+Rendered exports are also kept in the 'exports' cache, keyed by everything
+their content depends on (search query, last page, `last_updated` and
+format). The same key doubles as a strong ETag, so a client revalidating
+an unchanged export costs a single indexed lookup.
+"""
+import csv
+import hashlib
+import json
+import time
+import zlib
+from itertools import islice
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpResponse, StreamingHttpResponse
+
+from .asyncdb import close_connection, export_slot
+from .metrics import EXPORT_RENDER_SECONDS, EXPORT_SIZE
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError: # pyarrow is optional, only the Parquet and Arrow formats need it
+    pa = pq = None
+
+EXPORT_FIELDS = (
+    'page', 'title', 'price', 'seller', 'reviews', 'image_url',
+    # Parsed at ingest (see normalize.py), so clients need not re-parse the display strings
+    'price_amount', 'currency', 'rating', 'review_count', 'seller_name',
+)
+
+# Fields of batch exports, which combine the products of many search terms
+BATCH_EXPORT_FIELDS = ('search_term',) + EXPORT_FIELDS
+
+# Rendered rows are sent in blocks of about this many characters rather than one by one
+STREAM_BLOCK_SIZE = 64 * 1024
+
+# gzip level of the csv.gz format: 6 is zlib's default speed/size trade-off
+GZIP_LEVEL = 6
+
+
+class Echo:
+    """Pseudo-buffer for csv.writer: write() returns the line instead of storing it."""
+
+    def write(self, value):
+        return value
+
+
+def iter_rows(queryset, chunk_size=None, fields=EXPORT_FIELDS):
+    """Tuples of `fields` values, read from a chunked cursor."""
+    if chunk_size is None:
+        chunk_size = settings.EXPORT_CHUNK_SIZE
+    return queryset.values_list(*fields).iterator(chunk_size=chunk_size)
+
+
+def iter_blocks(lines):
+    """Join rendered lines into blocks of about STREAM_BLOCK_SIZE characters."""
+    block = []
+    block_size = 0
+    for line in lines:
+        block.append(line)
+        block_size += len(line)
+        if block_size >= STREAM_BLOCK_SIZE:
+            yield ''.join(block)
+            block = []
+            block_size = 0
+    if block:
+        yield ''.join(block)
+
+
+def iter_csv(rows, fields=EXPORT_FIELDS):
+    """Yield the CSV export of `rows` (header included) in blocks of text."""
+    writer = csv.writer(Echo())
+    yield writer.writerow(fields)
+    yield from iter_blocks(writer.writerow(row) for row in rows)
+
+
+def iter_csv_gzip(rows, fields=EXPORT_FIELDS):
+    """The CSV export compressed as a single gzip member, in blocks of bytes."""
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31) # wbits=31: gzip header and trailer
+    for block in iter_csv(rows, fields):
+        data = compressor.compress(block.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def _json_value(value):
+    # rating is a Decimal; JSON has numbers for it
+    return float(value)
+
+
+def iter_ndjson(rows, fields=EXPORT_FIELDS):
+    """One JSON object per product and line (newline-delimited JSON), in blocks of text."""
+    return iter_blocks(
+        json.dumps(dict(zip(fields, row)), ensure_ascii=False, default=_json_value) + '\n'
+        for row in rows
+    )
+
+
+class ByteSink:
+    """Write-only file object collecting what pyarrow writes, drained by the export generator."""
+    closed = False
+
+    def __init__(self):
+        self.parts = []
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.parts)
+        self.parts = []
+        return data
+
+
+if pa is not None:
+    # Arrow type of every exportable field, EXPORT_FIELDS and the search_term of batch exports
+    ARROW_TYPES = {
+        'search_term': pa.string(),
+        'page': pa.int32(),
+        'title': pa.string(),
+        'price': pa.string(),
+        'seller': pa.string(),
+        'reviews': pa.string(),
+        'image_url': pa.string(),
+        'price_amount': pa.int64(),
+        'currency': pa.string(),
+        'rating': pa.float64(),
+        'review_count': pa.int32(),
+        'seller_name': pa.string(),
+    }
+
+
+def arrow_schema(fields=EXPORT_FIELDS):
+    return pa.schema([(name, ARROW_TYPES[name]) for name in fields])
+
+
+def iter_record_batches(rows, fields=EXPORT_FIELDS, chunk_size=None):
+    """An Arrow record batch of arrow_schema(fields) per chunk of rows."""
+    if chunk_size is None:
+        chunk_size = settings.EXPORT_CHUNK_SIZE
+    schema = arrow_schema(fields)
+    rating = fields.index('rating')
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            return
+        columns = [list(column) for column in zip(*chunk)]
+        columns[rating] = [None if value is None else float(value) for value in columns[rating]]
+        yield pa.record_batch(
+            [pa.array(column, type=field.type) for column, field in zip(columns, schema)],
+            schema=schema,
+        )
+
+
+def iter_parquet(rows, fields=EXPORT_FIELDS):
+    """Parquet file of the export, one row group per chunk of rows, in blocks of bytes."""
+    sink = ByteSink()
+    with pq.ParquetWriter(sink, arrow_schema(fields), compression='zstd') as writer:
+        for batch in iter_record_batches(rows, fields):
+            writer.write_batch(batch)
+            data = sink.drain()
+            if data:
+                yield data
+    yield sink.drain() # Footer
+
+
+def iter_arrow(rows, fields=EXPORT_FIELDS):
+    """Arrow IPC stream of the export, one record batch per chunk of rows, in blocks of bytes."""
+    sink = ByteSink()
+    with pa.ipc.new_stream(sink, arrow_schema(fields)) as writer:
+        for batch in iter_record_batches(rows, fields):
+            writer.write_batch(batch)
+            yield sink.drain()
+    yield sink.drain() # End-of-stream marker
+
+
+class ExportFormat:
+    def __init__(self, name, content_type, extension, render, media_types=(), needs_pyarrow=False):
+        self.name = name
+        self.content_type = content_type
+        self.extension = extension
+        self.render = render # render(rows, fields=EXPORT_FIELDS) -> iterable of str or bytes blocks
+        self.media_types = media_types # Accept header values selecting this format
+        self.needs_pyarrow = needs_pyarrow
+
+    @property
+    def available(self):
+        return pa is not None or not self.needs_pyarrow
+
+
+EXPORT_FORMATS = {
+    export_format.name: export_format for export_format in (
+        ExportFormat('csv', 'text/csv', 'csv', iter_csv, ('text/csv',)),
+        ExportFormat('csv.gz', 'application/gzip', 'csv.gz', iter_csv_gzip, ('application/gzip', 'application/x-gzip')),
+        ExportFormat('ndjson', 'application/x-ndjson', 'ndjson', iter_ndjson, ('application/x-ndjson', 'application/ndjson')),
+        ExportFormat('parquet', 'application/vnd.apache.parquet', 'parquet', iter_parquet,
+                     ('application/vnd.apache.parquet', 'application/x-parquet'), needs_pyarrow=True),
+        ExportFormat('arrow', 'application/vnd.apache.arrow.stream', 'arrow', iter_arrow,
+                     ('application/vnd.apache.arrow.stream',), needs_pyarrow=True),
+    )
+}
+DEFAULT_EXPORT_FORMAT = 'csv'
+
+
+def negotiate_export_format(request):
+    """
+    The ExportFormat asked for by the '?format=' parameter, else by the first
+    Accept media type that names one, else CSV. Raises ValueError with a
+    message for the client when the format is unknown or not available.
+    """
+    name = request.GET.get('format') # GET is query_params on DRF requests, and async views get plain Django ones
+    if name is None:
+        name = DEFAULT_EXPORT_FORMAT
+        for accepted in request.headers.get('Accept', '').split(','):
+            media_type = accepted.split(';')[0].strip().lower()
+            match = next((f.name for f in EXPORT_FORMATS.values() if media_type in f.media_types), None)
+            if match is not None:
+                name = match
+                break
+    export_format = EXPORT_FORMATS.get(name)
+    if export_format is None:
+        raise ValueError(f"'format' must be one of: {', '.join(EXPORT_FORMATS)}.")
+    if not export_format.available:
+        raise ValueError(f"The {name} format needs pyarrow, which is not installed on this server.")
+    return export_format
+
+
+def export_cache_key(search_query, final_max_page, export_format='csv', variant=''):
+    """`variant` identifies the filters and sort order of the export, '' for the full export."""
+    last_updated = search_query.last_updated.isoformat()
+    return f'export:{search_query.pk}:{final_max_page}:{last_updated}:{export_format}:{variant}'
+
+
+def export_etag(search_query, final_max_page, export_format='csv', variant=''):
+    """Strong ETag of an export: it changes whenever the exported rows can change."""
+    digest = hashlib.sha256(export_cache_key(search_query, final_max_page, export_format, variant).encode('utf-8'))
+    return f'"{digest.hexdigest()[:32]}"'
+
+
+def get_cached_export(cache_key):
+    return caches['exports'].get(cache_key)
+
+
+def caching_stream(chunks, cache_key):
+    """
+    Pass `chunks` through unchanged, and store the full export in the cache
+    once the last chunk is sent, unless it grows past EXPORT_CACHE_MAX_BYTES.
+    Nothing is cached if the client disconnects half way.
+    """
+    parts = []
+    size = 0
+    for chunk in chunks:
+        if parts is not None:
+            parts.append(chunk)
+            size += len(chunk)
+            if size > settings.EXPORT_CACHE_MAX_BYTES:
+                parts = None # Too big to cache, keep streaming only
+        yield chunk
+    if parts:
+        caches['exports'].set(cache_key, parts[0][:0].join(parts))
+
+
+def timed_render(chunks, export_format):
+    """
+    Pass `chunks` through, recording the time spent producing them (reading
+    and rendering rows, not sending them to the client) and their size.
+    Nothing is recorded if the client disconnects half way.
+    """
+    chunks = iter(chunks)
+    elapsed = 0
+    size = 0
+    while True:
+        started = time.perf_counter()
+        chunk = next(chunks, None)
+        elapsed += time.perf_counter() - started
+        if chunk is None:
+            break
+        size += len(chunk)
+        yield chunk
+    EXPORT_RENDER_SECONDS.labels(export_format.name).observe(elapsed)
+    EXPORT_SIZE.labels(export_format.name).inc(size)
+
+
+def attach_export_headers(response, filename, etag):
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    response['ETag'] = etag
+    # Clients may keep the file but must revalidate it with If-None-Match
+    response['Cache-Control'] = 'no-cache'
+    # The format can come from the Accept header
+    response['Vary'] = 'Accept'
+    return response
+
+
+def cached_export_response(content, export_format, filename, etag):
+    """Response for an export found in the cache."""
+    return attach_export_headers(HttpResponse(content, content_type=export_format.content_type), filename, etag)
+
+
+async def async_chunks(chunks):
+    """
+    Async iterator over the `chunks` generator, each chunk produced by
+    sync_to_async in the request's sync thread, where its DB cursor lives.
+    Under ASGI Django reads a sync streaming response into a list before
+    sending any of it. Holds an export slot (see asyncdb.py) until the end.
+    """
+    next_chunk = sync_to_async(next)
+    async with export_slot():
+        try:
+            while True:
+                chunk = await next_chunk(chunks, None)
+                if chunk is None:
+                    break
+                yield chunk
+        finally:
+            await sync_to_async(close_stream)(chunks)
+
+
+def close_stream(chunks):
+    chunks.close()
+    close_connection()
+
+
+def export_response(queryset, export_format, filename, etag, cache_key, async_stream=False):
+    """
+    StreamingHttpResponse that downloads `queryset` as `filename`, filling the
+    export cache. With `async_stream` the body is an async iterator, for async views.
+    """
+    chunks = caching_stream(timed_render(export_format.render(iter_rows(queryset)), export_format), cache_key)
+    if async_stream:
+        chunks = async_chunks(chunks)
+    response = StreamingHttpResponse(chunks, content_type=export_format.content_type)
+    return attach_export_headers(response, filename, etag)
+
+
+def batch_export_response(queryset, fields, export_format, filename, async_stream=False):
+    """
+    StreamingHttpResponse of the `fields` of `queryset`, for batch exports:
+    neither cached nor given an ETag, since they are rarely asked for twice.
+    """
+    chunks = timed_render(export_format.render(iter_rows(queryset, fields=fields), fields), export_format)
+    if async_stream:
+        chunks = async_chunks(chunks)
+    response = StreamingHttpResponse(chunks, content_type=export_format.content_type)
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    response['Vary'] = 'Accept'
+    return response
@@ -0,0 +1,211 @@
+"""
+Concurrent page-fetch engine for the MercadoLibre scraper.
+
+Pages are fetched on a bounded thread pool and handed back to the caller
+(the DB writer) as soon as each one completes, so an N page request costs
+roughly ceil(N / SCRAPER_CONCURRENCY) fetches instead of N serial ones.
+The request rate itself is capped by the scraper's shared token bucket
+(see scraping/fetcher.py). fetch_units_async() and fetch_pages_async() do
+the same on the running event loop, for the async views.
+"""
+import asyncio
+import logging
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import aclosing
+from pathlib import Path
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# --- Dynamically add scraping directory to sys.path ---
+# Assumes backend/ and scraping/ are siblings in the project root
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+SCRAPING_DIR = BACKEND_DIR.parent / 'scraping'
+
+if str(SCRAPING_DIR) not in sys.path:
+    sys.path.insert(0, str(SCRAPING_DIR))
+
+try:
+    from scraper import ListingItem, fetch_listing_items, fetch_listing_items_async, parse_cached_listing # noqa: F401
+except ImportError as e:
+    # Handle case where scraper.py might be missing or has issues
+    logger.error("Error importing scraper: %s", e)
+    def fetch_listing_items(search_param, page=1, use_cache=True):
+        logger.error("Scraper function not available.")
+        return []
+
+    async def fetch_listing_items_async(search_param, page=1, use_cache=True):
+        return fetch_listing_items(search_param, page, use_cache)
+
+    def parse_cached_listing(search_param, page=1):
+        return None
+# --- End Path Setup ---
+
+
+def last_useful_page(page_num, items):
+    """
+    Last page of a term worth fetching once page `page_num` gave `items`:
+    the page itself when it had no results, else the last page of results
+    it reports (scraper.ListingItems.total_pages). None when unknown.
+    """
+    if not items:
+        return page_num
+    total_pages = getattr(items, 'total_pages', None)
+    return None if total_pages is None else max(total_pages, page_num)
+
+
+def fetch_units(units, max_workers=None, deadline=None, use_cache=True):
+    """
+    Fetch (search_term, page) units concurrently, several terms at once.
+
+    Units are pulled from `units` lazily and at most `max_workers` are in
+    flight, so the order of a prioritized iterator is respected. Yields
+    (search_term, page, items) in completion order, `items` being a list of
+    ListingItem records, parsed in the worker thread. A page that fails or
+    comes back empty yields an empty list, and the pages after it of the
+    same term are not started: they are yielded with items=None, meaning
+    "past the end of the results". So are the pages after the last page of
+    results a fetched page reports (see last_useful_page()). Pages already in
+    flight by then are not interrupted, they are yielded with what they
+    returned. No new unit is started once `deadline` (a time.monotonic()
+    value) has passed; those units are not yielded.
+
+    A new unit is only started when the consumer asks for the next page, so
+    at most `max_workers` pages (in flight, or parsed and waiting for the
+    DB writer) are held at once, however many pages a request needs.
+    """
+    if max_workers is None:
+        max_workers = settings.SCRAPER_CONCURRENCY
+    max_workers = max(1, max_workers)
+    units = iter(units)
+    end_pages = {} # search_term -> first page that had no results
+
+    def fetch(search_term, page_num):
+        # Politeness is enforced by the scraper's shared rate limiter
+        return fetch_listing_items(search_term, page_num, use_cache=use_cache)
+
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    in_flight = {}
+    units_left = True
+    try:
+        while True:
+            # Keep the pool busy with the next units in priority order
+            while units_left and len(in_flight) < max_workers:
+                if deadline is not None and time.monotonic() >= deadline:
+                    units_left = False
+                    break
+                try:
+                    search_term, page_num = next(units)
+                except StopIteration:
+                    units_left = False
+                    break
+                end_page = end_pages.get(search_term)
+                if end_page is not None and page_num > end_page:
+                    yield search_term, page_num, None
+                    continue
+                in_flight[executor.submit(fetch, search_term, page_num)] = (search_term, page_num)
+
+            if not in_flight:
+                break
+
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                search_term, page_num = in_flight.pop(future)
+                try:
+                    items = future.result()
+                except Exception as e:
+                    logger.warning("Error fetching page %s for '%s': %s", page_num, search_term, e,
+                                   extra={'search_term': search_term, 'page': page_num})
+                    items = []
+
+                end_page = last_useful_page(page_num, items)
+                if end_page is not None and end_page < end_pages.get(search_term, end_page + 1):
+                    end_pages[search_term] = end_page
+
+                yield search_term, page_num, items
+    finally:
+        # Also runs when the consumer stops iterating early
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def fetch_pages(search_term, pages, max_workers=None):
+    """
+    Fetch listing pages for `search_term` concurrently.
+
+    Yields (page_num, items) tuples in completion order, not page order.
+    A page that fails or comes back empty yields an empty list, and the
+    pages after it are skipped, since MercadoLibre has no results past the
+    last page. So are the pages past the last one a fetched page reports.
+    """
+    units = ((search_term, page_num) for page_num in pages)
+    for _, page_num, items in fetch_units(units, max_workers=max_workers):
+        if items is not None:
+            yield page_num, items
+
+
+async def fetch_units_async(units, max_workers=None, use_cache=True):
+    """
+    fetch_units() for coroutines: each (search_term, page) unit is a task on
+    the running event loop instead of a pool thread, with the same rules (at
+    most `max_workers` in flight, completion order, pages past the end of a
+    term's results yielded with items=None).
+    """
+    if max_workers is None:
+        max_workers = settings.SCRAPER_CONCURRENCY
+    max_workers = max(1, max_workers)
+    units = iter(units)
+    end_pages = {} # search_term -> first page that had no results
+    in_flight = {} # task -> (search_term, page_num)
+    units_left = True
+    try:
+        while True:
+            while units_left and len(in_flight) < max_workers:
+                unit = next(units, None)
+                if unit is None:
+                    units_left = False
+                    break
+                search_term, page_num = unit
+                end_page = end_pages.get(search_term)
+                if end_page is not None and page_num > end_page:
+                    yield search_term, page_num, None
+                    continue
+                task = asyncio.ensure_future(fetch_listing_items_async(search_term, page_num, use_cache=use_cache))
+                in_flight[task] = unit
+
+            if not in_flight:
+                break
+
+            done, _ = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                search_term, page_num = in_flight.pop(task)
+                try:
+                    items = task.result()
+                except Exception as e:
+                    logger.warning("Error fetching page %s for '%s': %s", page_num, search_term, e,
+                                   extra={'search_term': search_term, 'page': page_num})
+                    items = []
+
+                end_page = last_useful_page(page_num, items)
+                if end_page is not None and end_page < end_pages.get(search_term, end_page + 1):
+                    end_pages[search_term] = end_page
+
+                yield search_term, page_num, items
+    finally:
+        # Also runs when the consumer stops iterating early
+        for task in in_flight:
+            task.cancel()
+        if in_flight:
+            await asyncio.gather(*in_flight, return_exceptions=True)
+
+
+async def fetch_pages_async(search_term, pages, max_workers=None):
+    """fetch_pages() for coroutines, on fetch_units_async()."""
+    units = ((search_term, page_num) for page_num in pages)
+    # aclosing: stopping early cancels the pages in flight right away, not when the generator is collected
+    async with aclosing(fetch_units_async(units, max_workers=max_workers)) as results:
+        async for _, page_num, items in results:
+            if items is not None:
+                yield page_num, items
@@ -0,0 +1,534 @@
+"""
+DB writer for scraped listing pages.
+
+Every page is written in a short transaction of its own, after it has been
+fetched and parsed, so no transaction is ever open across network I/O. On
+Postgres a page is loaded with COPY into a temporary staging table and
+merged with a single INSERT ... ON CONFLICT; other databases go through the
+ORM.
+"""
+import hashlib
+import io
+import logging
+import time
+from contextlib import aclosing
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .asyncdb import run_db
+from .claims import claim_pages, finish_claim, new_owner, release_claims, wait_for_claims, wait_for_claims_async
+from .fetching import fetch_pages, fetch_pages_async, fetch_units, fetch_units_async
+from .metrics import PAGE_WRITE_SECONDS, PRODUCTS_WRITTEN, SCRAPED_PAGES
+from .models import PageClaim, PriceHistory, Product, SearchQuery
+from .normalize import normalized_fields
+
+logger = logging.getLogger(__name__)
+
+# Scraped fields compared by content_hash(), in the order they are hashed
+CONTENT_FIELDS = ('title', 'price', 'seller', 'reviews', 'image_url')
+
+# Product.seen_at of an unchanged row is only rewritten once it is this old: a
+# refresh then writes each unchanged row at most twice a day, not on every pass.
+# Retention (retention.py) allows for the lag.
+SEEN_AT_INTERVAL = timedelta(hours=12)
+
+
+def content_hash(values):
+    """Hash of the scraped fields of a product (`values` in CONTENT_FIELDS order)."""
+    return hashlib.sha1('\x1f'.join(value or '' for value in values).encode('utf-8')).hexdigest()
+
+
+def item_identity(item):
+    """The item id from the parser, or a hash of title and image for items that have none."""
+    if item.item_id:
+        return item.item_id
+    return 'h:' + content_hash((item.title, item.image_url))[:20]
+
+
+def dedup_key(item_id):
+    """Fixed-width key of an item identity, unique per search query (Product.dedup_key)."""
+    return hashlib.sha1(item_id.encode('utf-8')).hexdigest()
+
+
+class UpsertResult:
+    def __init__(self):
+        self.created = 0
+        self.updated = 0
+        self.unchanged = 0
+        self.price_changes = 0
+
+    @property
+    def total(self):
+        return self.created + self.updated + self.unchanged
+
+
+def upsert_page(search_query, page_num, items):
+    """
+    Store the scraped items (ListingItem records) of one page, keyed by item identity.
+
+    New items are inserted; known items are only written when their content
+    hash changed, and a changed price is appended to PriceHistory. An item
+    keeps the lowest page it was stored on: a listing repeated further down
+    (sponsored, or moved by a refresh) stays in the exports of its first page
+    instead of moving out of them.
+    Rows stored before item ids were parsed are matched by page, title and
+    image and adopted. Returns an UpsertResult.
+
+    Uses COPY and a merge on Postgres (see copy_upsert()), unless the page
+    still has such rows to adopt or INGEST_USE_COPY is off.
+    """
+    result = UpsertResult()
+    scraped = {}
+    for item in items:
+        values = (item.title, item.price, item.seller, item.reviews, item.image_url)
+        # A listing repeated on the page (e.g. sponsored) is stored once
+        scraped.setdefault(item_identity(item), values)
+    if not scraped:
+        return result
+
+    started = time.perf_counter()
+    if use_copy_ingest() and not Product.objects.filter(search_query=search_query, page=page_num, item_id='').exists():
+        copy_upsert(search_query, page_num, scraped, result)
+    else:
+        orm_upsert(search_query, page_num, scraped, result)
+
+    PAGE_WRITE_SECONDS.observe(time.perf_counter() - started)
+    PRODUCTS_WRITTEN.labels('created').inc(result.created)
+    PRODUCTS_WRITTEN.labels('updated').inc(result.updated)
+    PRODUCTS_WRITTEN.labels('unchanged').inc(result.unchanged)
+    return result
+
+
+def orm_upsert(search_query, page_num, scraped, result):
+    """upsert_page() through the ORM. `scraped` maps item identity -> CONTENT_FIELDS values."""
+    keys = {dedup_key(item_id): item_id for item_id in scraped}
+    existing = {
+        keys[product.dedup_key]: product
+        for product in Product.objects.filter(search_query=search_query, dedup_key__in=list(keys))
+    }
+    missing = [item_id for item_id in scraped if item_id not in existing]
+    if missing:
+        legacy = {
+            (product.title, product.image_url): product
+            for product in Product.objects.filter(search_query=search_query, page=page_num, item_id='')
+        }
+        if legacy:
+            for item_id in missing:
+                values = scraped[item_id]
+                product = legacy.pop((values[0], values[4]), None)
+                if product is not None:
+                    existing[item_id] = product
+
+    now = timezone.now()
+    to_create = []
+    to_update = {} # tuple of changed fields -> products, written with one bulk_update() each
+    history = []
+    seen = [] # Unchanged products whose seen_at is due
+    for item_id, values in scraped.items():
+        digest = content_hash(values)
+        product = existing.get(item_id)
+        if product is None:
+            to_create.append(Product(
+                search_query=search_query, page=page_num, item_id=item_id, dedup_key=dedup_key(item_id),
+                content_hash=digest, seen_at=now,
+                **dict(zip(CONTENT_FIELDS, values)),
+                **normalized_fields(values[1], values[2], values[3]),
+            ))
+            continue
+        page = min(product.page, page_num)
+        if product.content_hash == digest and product.page == page and product.item_id == item_id:
+            result.unchanged += 1
+            if product.seen_at < now - SEEN_AT_INTERVAL:
+                seen.append(product.pk)
+            continue
+        if product.price != values[1]:
+            history.append(PriceHistory(product=product, previous_price=product.price, price=values[1], changed_at=now))
+        new_values = dict(zip(CONTENT_FIELDS, values), page=page, item_id=item_id,
+                          dedup_key=dedup_key(item_id), content_hash=digest,
+                          **normalized_fields(values[1], values[2], values[3]))
+        # Only the changed columns: bulk_update() cost grows with rows x fields
+        changed = tuple(field for field, value in new_values.items() if getattr(product, field) != value)
+        for field in changed:
+            setattr(product, field, new_values[field])
+        product.seen_at = now
+        to_update.setdefault(changed + ('seen_at',), []).append(product)
+
+    if to_create:
+        # ignore_conflicts=True: a concurrent scrape of another page may insert the same listing first
+        Product.objects.bulk_create(to_create, ignore_conflicts=True)
+    for fields, products in to_update.items():
+        Product.objects.bulk_update(products, fields)
+    if history:
+        PriceHistory.objects.bulk_create(history)
+    if seen:
+        Product.objects.filter(pk__in=seen).update(seen_at=now)
+    result.created = len(to_create)
+    result.updated = sum(len(products) for products in to_update.values())
+    result.price_changes = len(history)
+
+
+# --- Postgres COPY ingest ---
+
+# Columns loaded into the staging table, in COPY order
+STAGED_COLUMNS = (
+    'dedup_key', 'item_id', *CONTENT_FIELDS, 'content_hash',
+    'price_amount', 'currency', 'rating', 'review_count', 'seller_name',
+)
+STAGING_TABLE = 'product_staging'
+
+
+def use_copy_ingest():
+    return settings.INGEST_USE_COPY and connection.vendor == 'postgresql'
+
+
+def copy_text_value(value):
+    """`value` in COPY's text format: None is \\N, and backslashes and separators are escaped."""
+    if value is None:
+        return '\\N'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def copy_rows(cursor, sql, data):
+    raw = cursor.cursor
+    if hasattr(raw, 'copy_expert'): # psycopg2
+        raw.copy_expert(sql, io.StringIO(data))
+    else: # psycopg 3
+        with raw.copy(sql) as copy:
+            copy.write(data)
+
+
+def copy_upsert(search_query, page_num, scraped, result):
+    """
+    upsert_page() on Postgres: COPY the page into a temporary staging table,
+    record price changes, then merge with INSERT ... ON CONFLICT DO UPDATE,
+    which only rewrites rows whose content hash, item id or (lower) page
+    changed, and bump seen_at where it is due. A fixed number of statements per page,
+    whatever changed.
+    """
+    quote = connection.ops.quote_name
+    product_table = quote(Product._meta.db_table)
+    history_table = quote(PriceHistory._meta.db_table)
+    columns = ', '.join(quote(column) for column in STAGED_COLUMNS)
+    updated_columns = [column for column in STAGED_COLUMNS if column != 'dedup_key'] + ['seen_at']
+
+    lines = []
+    for item_id, values in scraped.items():
+        fields = dict(zip(CONTENT_FIELDS, values), dedup_key=dedup_key(item_id), item_id=item_id,
+                      content_hash=content_hash(values), **normalized_fields(values[1], values[2], values[3]))
+        lines.append('\t'.join(copy_text_value(fields[column]) for column in STAGED_COLUMNS) + '\n')
+
+    now = timezone.now()
+    # Part of the caller's page transaction (or one of its own): staging rows are dropped at commit
+    with transaction.atomic(savepoint=False), connection.cursor() as cursor:
+        # Created once per connection and emptied at every commit
+        cursor.execute(f"""
+            CREATE TEMPORARY TABLE IF NOT EXISTS {STAGING_TABLE} (
+                dedup_key varchar(40) NOT NULL, item_id varchar(64) NOT NULL,
+                title text, price text, seller text, reviews text, image_url text,
+                content_hash varchar(40) NOT NULL, price_amount bigint, currency varchar(3),
+                rating numeric(2, 1), review_count integer, seller_name text
+            ) ON COMMIT DELETE ROWS
+        """)
+        cursor.execute(f'TRUNCATE {STAGING_TABLE}') # Left over by an earlier page of this transaction
+        copy_rows(cursor, f'COPY {STAGING_TABLE} ({columns}) FROM STDIN', ''.join(lines))
+
+        # Before the merge, while the old prices are still there
+        cursor.execute(f"""
+            INSERT INTO {history_table} (product_id, previous_price, price, changed_at)
+            SELECT product.id, product.price, staged.price, %s
+            FROM {STAGING_TABLE} staged
+            JOIN {product_table} product ON product.search_query_id = %s AND product.dedup_key = staged.dedup_key
+            WHERE product.price <> staged.price
+        """, [now, search_query.pk])
+        result.price_changes = cursor.rowcount
+
+        # xmax = 0 only on rows inserted by this statement. Known items keep the lowest page they were stored on
+        cursor.execute(f"""
+            INSERT INTO {product_table} (search_query_id, page, scraped_at, seen_at, {columns})
+            SELECT %s, %s, %s, %s, {columns} FROM {STAGING_TABLE}
+            ON CONFLICT (search_query_id, dedup_key) DO UPDATE SET
+                {', '.join(f'{quote(column)} = EXCLUDED.{quote(column)}' for column in updated_columns)},
+                page = LEAST({product_table}.page, EXCLUDED.page)
+            WHERE ({product_table}.content_hash, {product_table}.page, {product_table}.item_id)
+                IS DISTINCT FROM (EXCLUDED.content_hash, LEAST({product_table}.page, EXCLUDED.page), EXCLUDED.item_id)
+            RETURNING (xmax = 0)
+        """, [search_query.pk, page_num, now, now])
+        written = [inserted for (inserted,) in cursor.fetchall()]
+
+        # Unchanged rows: the merge left them alone
+        cursor.execute(f"""
+            UPDATE {product_table} product SET seen_at = %s
+            FROM {STAGING_TABLE} staged
+            WHERE product.search_query_id = %s AND product.dedup_key = staged.dedup_key AND product.seen_at < %s
+        """, [now, search_query.pk, now - SEEN_AT_INTERVAL])
+
+    result.created = sum(written)
+    result.updated = len(written) - result.created
+    result.unchanged = len(scraped) - len(written)
+
+
+def store_page(search_query, page_num, items):
+    """Store the scraped items of one page. Returns the number of distinct items sent to the DB."""
+    return upsert_page(search_query, page_num, items).total
+
+
+def record_result_count(search_query, page_num, items):
+    """
+    Keep the totals a fetched page reports (see scraper.ListingItems) on
+    `search_query`, for SearchQuery.reachable_pages(). Empty pages past the
+    end report 0 results, so an empty page only counts when it is page 1:
+    the term has no results at all. Written when the totals change or the
+    stored ones are half way to RESULT_COUNT_MAX_AGE, not on every page.
+    """
+    total_pages = getattr(items, 'total_pages', None)
+    if total_pages is None or (not items and page_num != 1):
+        return
+    now = timezone.now()
+    counted_at = search_query.results_counted_at
+    fresh = counted_at is not None and (now - counted_at).total_seconds() < settings.RESULT_COUNT_MAX_AGE / 2
+    if fresh and (search_query.total_results, search_query.total_pages) == (items.total_results, total_pages):
+        return
+    SearchQuery.objects.filter(pk=search_query.pk).update(
+        total_results=items.total_results, total_pages=total_pages, results_counted_at=now,
+    )
+    search_query.total_results, search_query.total_pages, search_query.results_counted_at = (
+        items.total_results, total_pages, now
+    )
+
+
+def contiguous_max_page(start_page, stored_pages):
+    """Highest page P such that every page from start_page + 1 to P is in stored_pages."""
+    max_page = start_page
+    while max_page + 1 in stored_pages:
+        max_page += 1
+    return max_page
+
+
+class MissingPagesScrape:
+    """
+    One scrape_missing_pages() run: its page claims, the outcome of every
+    page and the final `max_page_scraped`. The sync and async versions
+    only differ in how they fetch pages and wait for other runs.
+    """
+
+    def __init__(self, search_query, pages_required, on_page=None):
+        self.search_query = search_query
+        self.on_page = on_page
+        self.start_page = search_query.max_page_scraped
+        self.pages_to_scrape = list(range(self.start_page + 1, search_query.reachable_pages(pages_required) + 1))
+        self.owner = new_owner()
+        self.stored_pages = set()
+        self.stop_page = None # First page that came back empty or failed
+        self.log_context = {'search_term': search_query.search_term}
+
+    def claim(self):
+        """Claim the missing pages. Returns (pages to fetch, pages other runs are fetching)."""
+        search_query = self.search_query
+        logger.info("Scraping required for '%s' pages %s to %s",
+                    search_query.search_term, self.pages_to_scrape[0], self.pages_to_scrape[-1],
+                    extra=self.log_context)
+
+        claimed, finished, waiting = claim_pages(search_query, self.pages_to_scrape, self.owner)
+        if finished or waiting:
+            logger.info("Reusing %s page(s) of '%s' fetched by other requests.",
+                        len(finished) + len(waiting), search_query.search_term, extra=self.log_context)
+
+        for page_num, page_status in sorted(finished.items()):
+            self.record(page_num, page_status)
+        if self.stop_page is not None:
+            claimed = [page_num for page_num in claimed if page_num < self.stop_page]
+        return claimed, waiting
+
+    def record(self, page_num, page_status, count=0):
+        if page_status == PageClaim.STATUS_STORED:
+            self.stored_pages.add(page_num)
+        else:
+            self.stop_page = page_num if self.stop_page is None else min(self.stop_page, page_num)
+        if self.on_page is not None:
+            self.on_page(page_num, page_status, count)
+
+    def wants(self, page_num):
+        """False for pages past the end of the results, which have nothing to keep."""
+        return self.stop_page is None or page_num <= self.stop_page
+
+    def store(self, page_num, items):
+        """Write a fetched page in a transaction of its own and finish its claim."""
+        search_query = self.search_query
+        log_context = dict(self.log_context, page=page_num)
+        record_result_count(search_query, page_num, items)
+        if not items:
+            logger.info("No data returned from scraper for page %s. Assuming no more results.", page_num,
+                        extra=log_context)
+            SCRAPED_PAGES.labels(PageClaim.STATUS_EMPTY).inc()
+            finish_claim(search_query, page_num, self.owner, PageClaim.STATUS_EMPTY)
+            self.record(page_num, PageClaim.STATUS_EMPTY)
+            return
+
+        try:
+            with transaction.atomic():
+                count = store_page(search_query, page_num, items)
+                finish_claim(search_query, page_num, self.owner, PageClaim.STATUS_STORED)
+        except Exception as e:
+            logger.exception("Error saving page %s for '%s': %s", page_num, search_query.search_term, e,
+                             extra=log_context)
+            SCRAPED_PAGES.labels(PageClaim.STATUS_FAILED).inc()
+            finish_claim(search_query, page_num, self.owner, PageClaim.STATUS_FAILED)
+            self.record(page_num, PageClaim.STATUS_FAILED)
+        else:
+            logger.info("Stored %s products from page %s.", count, page_num, extra=dict(log_context, products=count))
+            SCRAPED_PAGES.labels(PageClaim.STATUS_STORED).inc()
+            self.record(page_num, PageClaim.STATUS_STORED, count)
+
+    def release(self):
+        # Claimed pages that were cancelled or skipped go back to the pool
+        release_claims(self.search_query, self.owner)
+
+    def finish(self):
+        """Advance `max_page_scraped` over the contiguous run of stored pages and return it."""
+        search_query = self.search_query
+        max_page_successfully_scraped = contiguous_max_page(self.start_page, self.stored_pages)
+
+        # Update SearchQuery only after attempting all required pages. The filter keeps a
+        # concurrent request that got further from being overwritten with a lower page.
+        if max_page_successfully_scraped > self.start_page:
+            SearchQuery.objects.filter(
+                pk=search_query.pk, max_page_scraped__lt=max_page_successfully_scraped
+            ).update(max_page_scraped=max_page_successfully_scraped, last_updated=timezone.now())
+            logger.info("Updated max_page_scraped for '%s' to %s", search_query.search_term,
+                        max_page_successfully_scraped, extra=self.log_context)
+        search_query.refresh_from_db(fields=['max_page_scraped', 'last_updated'])
+
+        return search_query.max_page_scraped
+
+
+def scrape_missing_pages(search_query, pages_required, on_page=None):
+    """
+    Scrape and store the pages of `search_query` that are not in the DB yet.
+
+    Pages are claimed first (see claims.py): pages another request is
+    already fetching are waited for and reused instead of fetched again.
+    The claimed pages are fetched concurrently and written as they arrive,
+    each one in its own transaction so progress is visible to other
+    connections (e.g. the job status endpoint) while the scrape runs.
+    Only the contiguous run of stored pages counts towards
+    `max_page_scraped`, so a gap left by an empty or failed page is never
+    reported as scraped.
+
+    `on_page(page_num, page_status, stored_count)` is called after every page
+    is resolved, with a PageClaim status.
+    Pages past the last page of results the term is known to have (see
+    SearchQuery.reachable_pages()) are not scraped.
+
+    Returns the updated `max_page_scraped`.
+    """
+    if search_query.max_page_scraped >= search_query.reachable_pages(pages_required):
+        return search_query.max_page_scraped
+
+    run = MissingPagesScrape(search_query, pages_required, on_page)
+    claimed, waiting = run.claim()
+    try:
+        for page_num, items in fetch_pages(search_query.search_term, claimed):
+            if run.wants(page_num):
+                run.store(page_num, items)
+    finally:
+        run.release()
+
+    for page_num, page_status in wait_for_claims(search_query, waiting):
+        run.record(page_num, page_status)
+    return run.finish()
+
+
+async def scrape_missing_pages_async(search_query, pages_required, on_page=None):
+    """
+    scrape_missing_pages() for coroutines (the ASGI view). Pages are fetched
+    on the event loop and every DB step goes through run_db(), so a request
+    waiting on MercadoLibre holds neither a thread nor a DB connection.
+    `on_page` is called on the loop or in a DB thread.
+    """
+    if search_query.max_page_scraped >= search_query.reachable_pages(pages_required):
+        return search_query.max_page_scraped
+
+    run = MissingPagesScrape(search_query, pages_required, on_page)
+    claimed, waiting = await run_db(run.claim)
+    try:
+        async for page_num, items in fetch_pages_async(search_query.search_term, claimed):
+            if run.wants(page_num):
+                await run_db(run.store, page_num, items)
+    finally:
+        await run_db(run.release)
+
+    async for page_num, page_status in wait_for_claims_async(search_query, waiting):
+        run.record(page_num, page_status)
+    return await run_db(run.finish)
+
+
+def batch_runs(targets):
+    """MissingPagesScrape runs of the (search_query, pages_required) `targets` that miss pages, by search term."""
+    return {
+        search_query.search_term: MissingPagesScrape(search_query, pages_required)
+        for search_query, pages_required in targets
+        if search_query.max_page_scraped < search_query.reachable_pages(pages_required)
+    }
+
+
+def batch_units(claims):
+    """
+    (search_term, page) units of the claimed pages of a batch, page-major:
+    page 1 of every term goes out first and reports how many pages its term
+    has (see fetching.last_useful_page()) before the later pages are fetched.
+    """
+    units = [(search_term, page_num) for search_term, (claimed, _) in claims.items() for page_num in claimed]
+    return sorted(units, key=lambda unit: unit[1])
+
+
+def scrape_missing_pages_batch(targets, max_workers=None):
+    """
+    scrape_missing_pages() for many terms at once, `targets` being
+    (search_query, pages_required) pairs with distinct search queries.
+
+    The missing pages of every term are fetched by one pool (see
+    fetching.fetch_units()), so a batch of a hundred terms keeps the pool
+    busy instead of scraping them one after the other: its throughput is
+    set by the fetch concurrency and the rate limiter. Each search query is
+    refreshed with its new `max_page_scraped`.
+    """
+    runs = batch_runs(targets)
+    claims = {search_term: run.claim() for search_term, run in runs.items()}
+    units = batch_units(claims)
+    try:
+        for search_term, page_num, items in fetch_units(units, max_workers=max_workers):
+            run = runs[search_term]
+            if items is not None and run.wants(page_num):
+                run.store(page_num, items)
+    finally:
+        for run in runs.values():
+            run.release()
+
+    for search_term, run in runs.items():
+        for page_num, page_status in wait_for_claims(run.search_query, claims[search_term][1]):
+            run.record(page_num, page_status)
+        run.finish()
+
+
+async def scrape_missing_pages_batch_async(targets, max_workers=None):
+    """scrape_missing_pages_batch() for coroutines, fetching on the event loop like scrape_missing_pages_async()."""
+    runs = batch_runs(targets)
+    claims = {search_term: await run_db(run.claim) for search_term, run in runs.items()}
+    units = batch_units(claims)
+    try:
+        async with aclosing(fetch_units_async(units, max_workers=max_workers)) as results:
+            async for search_term, page_num, items in results:
+                run = runs[search_term]
+                if items is not None and run.wants(page_num):
+                    await run_db(run.store, page_num, items)
+    finally:
+        for run in runs.values():
+            await run_db(run.release)
+
+    for search_term, run in runs.items():
+        async for page_num, page_status in wait_for_claims_async(run.search_query, claims[search_term][1]):
+            run.record(page_num, page_status)
+        await run_db(run.finish)
@@ -0,0 +1,120 @@
+"""
+DB-backed queue of scrape jobs.
+
+The API enqueues a job when a request needs pages that are not stored yet,
+and `manage.py run_scrape_jobs` workers claim and run them, so web workers
+never block on the network.
+"""
+import logging
+import os
+import socket
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+
+from .ingest import scrape_missing_pages
+from .models import ScrapeJob
+
+logger = logging.getLogger(__name__)
+
+
+def worker_name():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def enqueue_scrape_job(search_query, pages_required):
+    """
+    Queue a scrape of `search_query` up to `pages_required`.
+
+    Reuses a pending or running job that already covers those pages.
+    Returns (job, created).
+    """
+    job = ScrapeJob.objects.filter(
+        search_query=search_query,
+        status__in=ScrapeJob.ACTIVE_STATUSES,
+        pages_required__gte=pages_required,
+    ).order_by('created_at').first()
+    if job is not None:
+        return job, False
+    return ScrapeJob.objects.create(search_query=search_query, pages_required=pages_required), True
+
+
+def recently_attempted(search_query, pages_required):
+    """
+    True if a job already tried to scrape these pages within SCRAPE_JOB_RETRY_AFTER
+    seconds. The term simply has fewer pages then, and queuing again would not help.
+    """
+    since = timezone.now() - timedelta(seconds=settings.SCRAPE_JOB_RETRY_AFTER)
+    return ScrapeJob.objects.filter(
+        search_query=search_query,
+        status=ScrapeJob.STATUS_DONE,
+        pages_required__gte=pages_required,
+        finished_at__gte=since,
+    ).exists()
+
+
+def claim_next_job(worker=None):
+    """
+    Atomically take the oldest runnable job, or return None if there is none.
+
+    Pending jobs are runnable, and so are running jobs whose worker stopped
+    sending heartbeats (crashed or killed). The claim is a conditional
+    UPDATE, so two workers can never run the same job.
+    """
+    worker = worker or worker_name()
+    stale_before = timezone.now() - timedelta(seconds=settings.SCRAPE_JOB_STALE_AFTER)
+
+    while True:
+        candidate = (
+            ScrapeJob.objects.filter(status=ScrapeJob.STATUS_PENDING)
+            .order_by('created_at').values_list('pk', 'status', 'heartbeat_at').first()
+            or ScrapeJob.objects.filter(status=ScrapeJob.STATUS_RUNNING, heartbeat_at__lt=stale_before)
+            .order_by('heartbeat_at').values_list('pk', 'status', 'heartbeat_at').first()
+        )
+        if candidate is None:
+            return None
+
+        pk, job_status, heartbeat_at = candidate
+        now = timezone.now()
+        claimed = ScrapeJob.objects.filter(pk=pk, status=job_status, heartbeat_at=heartbeat_at).update(
+            status=ScrapeJob.STATUS_RUNNING,
+            worker=worker,
+            started_at=now,
+            heartbeat_at=now,
+        )
+        if claimed:
+            return ScrapeJob.objects.select_related('search_query').get(pk=pk)
+        # Another worker took it first, try the next one
+
+
+def run_job(job):
+    """Scrape the pages of `job`, recording per-page progress on the job row."""
+    search_query = job.search_query
+    pages_total = max(0, search_query.reachable_pages(job.pages_required) - search_query.max_page_scraped)
+    ScrapeJob.objects.filter(pk=job.pk).update(pages_total=pages_total, pages_done=0)
+
+    def on_page(page_num, page_status, stored_count):
+        ScrapeJob.objects.filter(pk=job.pk).update(
+            pages_done=F('pages_done') + 1,
+            heartbeat_at=timezone.now(),
+        )
+
+    try:
+        scrape_missing_pages(search_query, job.pages_required, on_page=on_page)
+    except Exception as e:
+        ScrapeJob.objects.filter(pk=job.pk).update(
+            status=ScrapeJob.STATUS_FAILED,
+            error=str(e),
+            finished_at=timezone.now(),
+        )
+        logger.exception("Job %s for '%s' failed: %s", job.pk, search_query.search_term, e,
+                         extra={'job': job.pk, 'search_term': search_query.search_term})
+    else:
+        ScrapeJob.objects.filter(pk=job.pk).update(
+            status=ScrapeJob.STATUS_DONE,
+            finished_at=timezone.now(),
+        )
+    job.refresh_from_db()
+    return job
@@ -0,0 +1,307 @@
+import asyncio
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone as dt_timezone
+
+import django
+from asgiref.sync import ThreadSensitiveContext, sync_to_async
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections, connection
+from django.test import RequestFactory
+
+from api.fetching import SCRAPING_DIR
+from api.metrics import PRODUCTS_WRITTEN, REGISTRY
+from api.models import SearchQuery
+from api.views import AsyncProductDataView, ProductDataView
+
+try:
+    import resource
+except ImportError: # Windows: no peak RSS, only the tracemalloc numbers
+    resource = None
+
+# Metrics compared by --compare: higher is better for these suffixes, lower is better for the rest
+HIGHER_IS_BETTER = ('_per_s',)
+COMPARED_SUFFIXES = ('_per_s', '_ms', '_mb', '_s')
+
+
+def percentile(values, q):
+    """Nearest-rank percentile of `values` (0 < q <= 100)."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * q // 100)) # ceil(n * q / 100)
+    return ordered[int(rank) - 1]
+
+
+def latency_summary(prefix, seconds):
+    return {
+        f'{prefix}_p50_ms': round(percentile(seconds, 50) * 1000, 2),
+        f'{prefix}_p95_ms': round(percentile(seconds, 95) * 1000, 2),
+        f'{prefix}_p99_ms': round(percentile(seconds, 99) * 1000, 2),
+        f'{prefix}_max_ms': round(max(seconds) * 1000, 2),
+    }
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process so far (a high-water mark, it never goes down)."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / 1024 if sys.platform != 'darwin' else peak / 1024 / 1024, 1) # KB on Linux, bytes on macOS
+
+
+def fetch_counts():
+    """Listing page requests made by this process so far, by status (scraper_fetch_seconds)."""
+    return {key[0]: count for key, count in REGISTRY.get('scraper_fetch_seconds').counts().items()}
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=settings.BASE_DIR, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def start_standin(options):
+    """Start standin_server.py on a free port. Returns (process, base URL)."""
+    command = [
+        sys.executable, str(SCRAPING_DIR / 'standin_server.py'), '--port', '0',
+        '--latency', str(options['latency']), '--jitter', str(options['jitter']),
+        '--error-rate', str(options['error_rate']), '--pages', str(options['standin_pages'] or options['pages_required']),
+        '--price-change-rate', str(options['price_change_rate']), '--seed', str(options['seed']),
+    ]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    line = process.stdout.readline() # 'Listening on http://127.0.0.1:<port>/'
+    if not line.startswith('Listening on '):
+        process.kill()
+        raise CommandError(f'The stand-in server did not start: {line!r}')
+    return process, line.split()[-1]
+
+
+class Command(BaseCommand):
+    help = ('End-to-end benchmark of the scrape pipeline against a local stand-in for MercadoLibre '
+            '(scraping/standin_server.py): ProductDataView requests and an update_products run, '
+            'reporting throughput, latency percentiles and peak memory. Uses throwaway search terms '
+            'that are deleted afterwards.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--terms', type=int, default=4, help='Search terms requested.')
+        parser.add_argument('--pages-required', type=int, default=10, help='pages_required of every request.')
+        parser.add_argument('--warm-requests', type=int, default=5, help='Repeat requests per term once its pages are stored.')
+        parser.add_argument('--clients', type=int, default=1, help='Requests sent at once (SQLite may answer "database is locked" above 1).')
+        parser.add_argument('--asgi', action='store_true',
+                            help='Send the requests to AsyncProductDataView, as --clients coroutines on one event loop.')
+        parser.add_argument('--workers', type=int, default=settings.SCRAPER_CONCURRENCY, help='update_products workers.')
+        parser.add_argument('--rate', type=float, default=1000, help='SCRAPER_RATE for this run (the stand-in needs no politeness).')
+        parser.add_argument('--base-url', default=None, help='Use a stand-in server that is already running instead of starting one.')
+        parser.add_argument('--latency', type=float, default=0.2, help='Stand-in latency per page, in seconds.')
+        parser.add_argument('--jitter', type=float, default=0.05, help='Stand-in latency jitter, in seconds.')
+        parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of stand-in pages answered with 503.')
+        parser.add_argument('--standin-pages', type=int, default=None, help='Pages with results per term (default: --pages-required).')
+        parser.add_argument('--price-change-rate', type=float, default=0.1, help='Fraction of prices changed on each fetch.')
+        parser.add_argument('--seed', type=int, default=1, help='Seed of the stand-in latency, errors and price changes.')
+        parser.add_argument('--trace-memory', action='store_true',
+                            help='Also report the peak of Python allocations per scenario (tracemalloc; slows the run down).')
+        parser.add_argument('--output', default=None, help='Write the results to this JSON file.')
+        parser.add_argument('--compare', default=None, help='Compare with the results in this JSON file.')
+        parser.add_argument('--threshold', type=float, default=0.1,
+                            help='With --compare, fail when a metric is worse by more than this fraction.')
+
+    def handle(self, *args, **options):
+        # Read by the scraper's fetcher and page cache when they are first used, which is below
+        os.environ['SCRAPER_RATE'] = str(options['rate'])
+        os.environ['SCRAPER_BURST'] = str(max(1, options['rate']))
+        os.environ['SCRAPER_CACHE_DIR'] = '' # Every page must come from the stand-in
+        os.environ.pop('SCRAPER_RATE_FILE', None)
+        import scraper # On sys.path through api.fetching
+
+        process = None
+        base_url = options['base_url']
+        if base_url is None:
+            process, base_url = start_standin(options)
+        original_base_url, scraper.BASE_URL = scraper.BASE_URL, base_url.rstrip('/') + '/'
+
+        run_id = uuid.uuid4().hex[:8]
+        terms = [f'__bench_{run_id}_{n}' for n in range(options['terms'])]
+        results = {
+            'run': {
+                'started_at': datetime.now(dt_timezone.utc).isoformat(timespec='seconds'),
+                'git_revision': git_revision(),
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'database': connection.vendor,
+                'options': {
+                    name: options[name] for name in (
+                        'terms', 'pages_required', 'warm_requests', 'clients', 'asgi', 'workers', 'rate', 'latency',
+                        'jitter', 'error_rate', 'standin_pages', 'price_change_rate', 'seed', 'trace_memory',
+                    )
+                },
+            },
+            'scenarios': {},
+        }
+        try:
+            cold = [(term, options['pages_required']) for term in terms]
+            request_all = self.request_all_asgi if options['asgi'] else self.request_all
+            results['scenarios']['view_cold'] = self.run_scenario(options, lambda: request_all(cold, options['clients']))
+            warm = [(term, options['pages_required']) for term in terms] * options['warm_requests']
+            results['scenarios']['view_warm'] = self.run_scenario(options, lambda: request_all(warm, options['clients']))
+            results['scenarios']['update_products'] = self.run_scenario(options, lambda: self.refresh(terms, options['workers']))
+        finally:
+            scraper.BASE_URL = original_base_url
+            SearchQuery.objects.filter(search_term__in=terms).delete()
+            if process is not None:
+                process.terminate()
+                process.wait()
+
+        self.report(results)
+        if options['output']:
+            with open(options['output'], 'w') as fh:
+                json.dump(results, fh, indent=2)
+            self.stdout.write(f"Results written to {options['output']}")
+        if options['compare']:
+            self.compare(options['compare'], results, options['threshold'])
+
+    def run_scenario(self, options, scenario):
+        """Run `scenario()` (which returns a dict of numbers), adding time, fetches and memory to it."""
+        fetches_before = fetch_counts()
+        if options['trace_memory']:
+            tracemalloc.start()
+        started = time.perf_counter()
+        result = scenario()
+        result['elapsed_s'] = round(time.perf_counter() - started, 3)
+        if options['trace_memory']:
+            result['traced_peak_mb'] = round(tracemalloc.get_traced_memory()[1] / 1024 / 1024, 1)
+            tracemalloc.stop()
+        result['peak_rss_mb'] = peak_rss_mb()
+        fetches = {
+            status: count - fetches_before.get(status, 0) for status, count in fetch_counts().items()
+            if count > fetches_before.get(status, 0)
+        }
+        result['page_fetches'] = sum(fetches.values())
+        result['page_fetches_by_status'] = fetches
+        if result['page_fetches']:
+            result['pages_per_s'] = round(result['page_fetches'] / result['elapsed_s'], 2)
+        return result
+
+    def request(self, term, pages_required):
+        """One ProductDataView request, read to the end. Returns (status, seconds, seconds to first byte)."""
+        factory = RequestFactory()
+        request = factory.get('/api/products', {'search_term': term, 'pages_required': pages_required, 'async': 'false'})
+        started = time.perf_counter()
+        try:
+            response = ProductDataView.as_view()(request)
+            first_byte = None
+            if response.streaming:
+                for _chunk in response.streaming_content:
+                    if first_byte is None:
+                        first_byte = time.perf_counter() - started
+            elif hasattr(response, 'render'): # DRF Response (errors)
+                response.render()
+            elapsed = time.perf_counter() - started
+            return response.status_code, elapsed, first_byte if first_byte is not None else elapsed
+        finally:
+            close_old_connections() # As at the end of a real request
+
+    async def request_async(self, term, pages_required):
+        """request() for AsyncProductDataView, with its own sync thread as under an ASGI server."""
+        factory = RequestFactory()
+        request = factory.get('/api/products', {'search_term': term, 'pages_required': pages_required, 'async': 'false'})
+        async with ThreadSensitiveContext():
+            started = time.perf_counter()
+            try:
+                response = await AsyncProductDataView.as_view()(request)
+                first_byte = None
+                if response.streaming:
+                    async for _chunk in response:
+                        if first_byte is None:
+                            first_byte = time.perf_counter() - started
+                elapsed = time.perf_counter() - started
+                return response.status_code, elapsed, first_byte if first_byte is not None else elapsed
+            finally:
+                await sync_to_async(close_old_connections)()
+
+    def request_all(self, requests, clients):
+        started = time.perf_counter()
+        if clients > 1:
+            with ThreadPoolExecutor(max_workers=clients) as executor:
+                outcomes = list(executor.map(lambda args: self.request(*args), requests))
+        else:
+            outcomes = [self.request(*args) for args in requests]
+        return self.summarize(outcomes, time.perf_counter() - started)
+
+    def request_all_asgi(self, requests, clients):
+        async def send_all():
+            slots = asyncio.Semaphore(max(1, clients))
+
+            async def send(args):
+                async with slots:
+                    return await self.request_async(*args)
+
+            return await asyncio.gather(*(send(args) for args in requests))
+
+        started = time.perf_counter()
+        outcomes = asyncio.run(send_all())
+        return self.summarize(outcomes, time.perf_counter() - started)
+
+    def summarize(self, outcomes, elapsed):
+        result = {
+            'requests': len(outcomes),
+            'errors': sum(1 for status, _, _ in outcomes if status != 200),
+            'requests_per_s': round(len(outcomes) / elapsed, 2),
+        }
+        result.update(latency_summary('latency', [seconds for _, seconds, _ in outcomes]))
+        result.update(latency_summary('ttfb', [first_byte for _, _, first_byte in outcomes]))
+        return result
+
+    def refresh(self, terms, workers):
+        written_before = {result: PRODUCTS_WRITTEN.value(result) for result in ('created', 'updated', 'unchanged')}
+        output = io.StringIO()
+        call_command('update_products', terms=terms, workers=workers, stdout=output)
+        return {
+            f'products_{result}': PRODUCTS_WRITTEN.value(result) - before
+            for result, before in written_before.items()
+        }
+
+    def report(self, results):
+        for name, scenario in results['scenarios'].items():
+            self.stdout.write(self.style.MIGRATE_HEADING(name))
+            for key, value in scenario.items():
+                self.stdout.write(f'  {key:<24} {value}')
+
+    def compare(self, path, results, threshold):
+        with open(path) as fh:
+            baseline = json.load(fh)
+        self.stdout.write(self.style.MIGRATE_HEADING(f"Compared with {path} (revision {baseline['run'].get('git_revision')})"))
+        differing = [
+            name for name, value in results['run']['options'].items()
+            if baseline['run'].get('options', {}).get(name) != value
+        ]
+        if differing:
+            self.stdout.write(self.style.WARNING(f"Options differ from the baseline run: {', '.join(differing)}"))
+        regressions = []
+        for name, scenario in results['scenarios'].items():
+            for key, value in scenario.items():
+                old = baseline['scenarios'].get(name, {}).get(key)
+                if not key.endswith(COMPARED_SUFFIXES) or not isinstance(value, (int, float)) or not old:
+                    continue
+                change = (value - old) / old
+                worse = -change if key.endswith(HIGHER_IS_BETTER) else change
+                flag = ''
+                if worse > threshold:
+                    flag = '  REGRESSION'
+                    regressions.append(f'{name}.{key}')
+                self.stdout.write(f'  {name}.{key:<24} {old:>10} -> {value:>10} ({change:+.1%}){flag}')
+        if regressions:
+            raise CommandError(f"{len(regressions)} metric(s) worse by more than {threshold:.0%}: {', '.join(regressions)}")
@@ -0,0 +1,113 @@
+import csv
+import gzip
+import io
+import json
+import time
+import uuid
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from api.exports import EXPORT_FIELDS, EXPORT_FORMATS, iter_csv, iter_rows, pa, pq
+from api.fetching import ListingItem
+from api.ingest import upsert_page
+from api.models import Product, SearchQuery
+
+
+def load_export(export_format, content):
+    """Parse an export the way a client would, returning the number of rows."""
+    if export_format == 'csv':
+        return len(list(csv.reader(io.StringIO(content.decode('utf-8'))))) - 1
+    if export_format == 'csv.gz':
+        return len(list(csv.reader(io.StringIO(gzip.decompress(content).decode('utf-8'))))) - 1
+    if export_format == 'ndjson':
+        return len([json.loads(line) for line in content.decode('utf-8').splitlines()])
+    if export_format == 'parquet':
+        return pq.read_table(io.BytesIO(content)).num_rows
+    return pa.ipc.open_stream(content).read_all().num_rows
+
+
+def synthetic_page(page_num, page_size, price_round=0):
+    """Items shaped like real listings: long titles and image URLs, one id each."""
+    items = []
+    for position in range(page_size):
+        n = (page_num - 1) * page_size + position
+        items.append(ListingItem(
+            item_id=f'MCO{1000000000 + n}',
+            title=f'Celular Galaxy Bench {n} 256 GB Negro Reacondicionado - Distribuidor Autorizado',
+            price=f'${(n % 5000 + 100) * 1000 + price_round:,}'.replace(',', '.'),
+            seller=f'Tienda {n % 97}',
+            reviews=f'Calificación 4,{n % 10} de 5 estrellas. {n % 900} opiniones.',
+            image_url=f'https://http2.mlstatic.com/D_Q_NP_2X_{n:06d}-MLA{88000000 + n}_092023-E.webp',
+        ))
+    return items
+
+
+class Command(BaseCommand):
+    help = ('Measures product write throughput and export query time on the configured database, '
+            'using a throwaway search term that is deleted afterwards.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--pages', type=int, default=200, help='Pages of synthetic products to write.')
+        parser.add_argument('--page-size', type=int, default=48, help='Products per page.')
+        parser.add_argument('--repeat', type=int, default=3, help='Export runs to time (the best one is reported).')
+
+    def handle(self, *args, **options):
+        pages, page_size = options['pages'], options['page_size']
+        search_query = SearchQuery.objects.create(search_term=f'__bench_{uuid.uuid4().hex[:12]}', max_page_scraped=pages)
+        rows = pages * page_size
+        try:
+            # Insert: every item is new
+            started = time.perf_counter()
+            for page_num in range(1, pages + 1):
+                with transaction.atomic():
+                    upsert_page(search_query, page_num, synthetic_page(page_num, page_size))
+            insert_time = time.perf_counter() - started
+            self.stdout.write(f'Insert:        {rows} rows in {insert_time:.2f}s ({rows / insert_time:,.0f} rows/s)')
+
+            # Refresh: every price changed, so every row is rewritten and a PriceHistory row added
+            started = time.perf_counter()
+            for page_num in range(1, pages + 1):
+                with transaction.atomic():
+                    upsert_page(search_query, page_num, synthetic_page(page_num, page_size, price_round=1))
+            update_time = time.perf_counter() - started
+            self.stdout.write(f'Update:        {rows} rows in {update_time:.2f}s ({rows / update_time:,.0f} rows/s)')
+
+            # Same query as the export view
+            products = Product.objects.filter(search_query=search_query, page__lte=pages).order_by('page', 'id')
+            query_best = render_best = None
+            for _ in range(options['repeat']):
+                started = time.perf_counter()
+                for _row in products.values_list(*EXPORT_FIELDS).iterator(chunk_size=2000):
+                    pass
+                elapsed = time.perf_counter() - started
+                query_best = elapsed if query_best is None else min(query_best, elapsed)
+
+                started = time.perf_counter()
+                size = sum(len(chunk) for chunk in iter_csv(iter_rows(products)))
+                elapsed = time.perf_counter() - started
+                render_best = elapsed if render_best is None else min(render_best, elapsed)
+            self.stdout.write(f'Export query:  {rows} rows in {query_best * 1000:.0f}ms')
+            self.stdout.write(f'Export CSV:    {rows} rows ({size / 1e6:.1f} MB) in {render_best * 1000:.0f}ms')
+            self.stdout.write(f'Export query plan:\n{products.explain()}')
+
+            self.stdout.write('Format     size       render   client load')
+            for export_format in EXPORT_FORMATS.values():
+                if not export_format.available:
+                    self.stdout.write(f'{export_format.name:<10} (needs pyarrow)')
+                    continue
+                started = time.perf_counter()
+                content = b''.join(
+                    chunk.encode('utf-8') if isinstance(chunk, str) else chunk
+                    for chunk in export_format.render(iter_rows(products))
+                )
+                render_time = time.perf_counter() - started
+                started = time.perf_counter()
+                loaded = load_export(export_format.name, content)
+                load_time = time.perf_counter() - started
+                assert loaded == rows, f'{export_format.name} export has {loaded} rows, expected {rows}'
+                self.stdout.write(
+                    f'{export_format.name:<10} {len(content) / 1e6:6.2f} MB  {render_time * 1000:5.0f}ms  {load_time * 1000:5.0f}ms'
+                )
+        finally:
+            search_query.delete()
@@ -0,0 +1,50 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from api.retention import expired_counts, run_compaction
+
+
+class Command(BaseCommand):
+    help = ('Deletes stored rows past their retention (PRODUCT_RETENTION_DAYS, PRICE_HISTORY_RETENTION_DAYS, '
+            'SCRAPE_JOB_RETENTION_DAYS) in short batches, optionally archiving them first. '
+            'Safe to interrupt and to run while the API and refreshes are running.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=settings.COMPACTION_BATCH_SIZE,
+                            help='Primary keys scanned, and at most rows deleted, per transaction.')
+        parser.add_argument('--max-duration', type=float, default=None,
+                            help='Stop starting new batches after this many seconds.')
+        parser.add_argument('--pause', type=float, default=0,
+                            help='Seconds to sleep after each batch that deleted rows, to leave I/O to the API.')
+        parser.add_argument('--archive-dir', default=None,
+                            help='Write deleted rows to gzipped NDJSON files in this directory first.')
+        parser.add_argument('--dry-run', action='store_true', help='Only count the rows that would be deleted.')
+
+    def handle(self, *args, **options):
+        if options['dry_run']:
+            for label, count in expired_counts().items():
+                self.stdout.write(f'{label}: {count} row(s) past retention.')
+            return
+
+        deadline = time.monotonic() + options['max_duration'] if options['max_duration'] else None
+        started = time.monotonic()
+        stats = run_compaction(
+            batch_size=options['batch_size'],
+            deadline=deadline,
+            archive_dir=options['archive_dir'],
+            pause=options['pause'],
+            log=self.stdout.write,
+        )
+        elapsed = time.monotonic() - started
+
+        deleted = ', '.join(f'{count} {label}' for label, count in sorted(stats.deleted.items()) if count) or 'nothing'
+        self.stdout.write(
+            f'Deleted {deleted}. {stats.partitions_dropped} partition(s) dropped, '
+            f'{stats.partitions_created} created, in {elapsed:.1f}s.'
+        )
+        if stats.finished:
+            self.stdout.write(self.style.SUCCESS('Compaction finished.'))
+        else:
+            self.stdout.write(self.style.WARNING('Compaction stopped early; run it again to continue.'))
@@ -0,0 +1,78 @@
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from api.models import Product, SearchQuery
+from api.normalize import normalized_fields
+from api.search import normalize_search_term
+
+NORMALIZED_FIELDS = ('price_amount', 'currency', 'rating', 'review_count', 'seller_name')
+
+
+def write_rows(fields, products):
+    """
+    UPDATE `fields` of `products` with one executemany(): unlike bulk_update(),
+    whose CASE expression grows with rows x fields, this stays linear.
+    """
+    model_fields = [Product._meta.get_field(name) for name in fields]
+    quote = connection.ops.quote_name
+    sql = 'UPDATE {} SET {} WHERE {} = %s'.format(
+        quote(Product._meta.db_table),
+        ', '.join(f'{quote(field.column)} = %s' for field in model_fields),
+        quote(Product._meta.pk.column),
+    )
+    params = [
+        [field.get_db_prep_save(getattr(product, field.attname), connection) for field in model_fields] + [product.pk]
+        for product in products
+    ]
+    with connection.cursor() as cursor:
+        cursor.executemany(sql, params)
+
+
+class Command(BaseCommand):
+    help = ('Fills the numeric price, currency, rating, review count and seller name columns '
+            'of stored products from their display strings. Runs in batches and can be re-run at any time.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('terms', nargs='*', help='Search terms to process (default: all).')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Rows read and written per transaction.')
+
+    def handle(self, *args, **options):
+        products = Product.objects.order_by('pk').only('pk', 'search_query_id', 'price', 'seller', 'reviews', *NORMALIZED_FIELDS)
+        if options['terms']:
+            search_queries = SearchQuery.objects.filter(search_term__in=[normalize_search_term(term) for term in options['terms']])
+            products = products.filter(search_query__in=search_queries)
+
+        seen = updated = 0
+        touched_queries = set()
+        last_pk = 0
+        while True:
+            # Keyset pagination: every batch is one short indexed range scan
+            batch = list(products.filter(pk__gt=last_pk)[:options['batch_size']])
+            if not batch:
+                break
+            last_pk = batch[-1].pk
+
+            to_update = {} # tuple of changed fields -> products
+            for product in batch:
+                values = normalized_fields(product.price, product.seller, product.reviews)
+                changed = tuple(field for field in NORMALIZED_FIELDS if getattr(product, field) != values[field])
+                if not changed:
+                    continue
+                for field in changed:
+                    setattr(product, field, values[field])
+                to_update.setdefault(changed, []).append(product)
+                touched_queries.add(product.search_query_id)
+
+            with transaction.atomic():
+                for fields, changed_products in to_update.items():
+                    write_rows(fields, changed_products)
+            seen += len(batch)
+            updated += sum(len(changed_products) for changed_products in to_update.values())
+            self.stdout.write(f'  {seen} rows checked, {updated} updated')
+
+        if touched_queries:
+            # The exports of these terms gain the new columns: move their ETags
+            for search_query in SearchQuery.objects.filter(pk__in=touched_queries):
+                search_query.save(update_fields=['last_updated'])
+
+        self.stdout.write(self.style.SUCCESS(f'Normalization finished: {updated} of {seen} row(s) updated.'))
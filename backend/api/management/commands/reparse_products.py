@@ -0,0 +1,62 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from api.fetching import parse_cached_listing
+from api.ingest import item_identity, upsert_page
+from api.models import Product, SearchQuery
+from api.search import normalize_search_term
+
+
+class Command(BaseCommand):
+    help = ('Rebuilds stored products from the raw HTML page cache, without any network access. '
+            'Use it after a parser fix or to backfill a new field.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('terms', nargs='*', help='Search terms to re-parse (default: all).')
+
+    def handle(self, *args, **options):
+        search_queries = SearchQuery.objects.filter(max_page_scraped__gt=0).order_by('search_term')
+        if options['terms']:
+            search_queries = search_queries.filter(search_term__in=[normalize_search_term(term) for term in options['terms']])
+
+        pages_rebuilt = pages_missing = 0
+        for query in search_queries:
+            self.stdout.write(f"Re-parsing '{query.search_term}' (up to page {query.max_page_scraped})")
+            rebuilt_pages = []
+            identities = set() # Items of every rebuilt page: one may be stored on a lower page than it is now on
+            changed = False
+            for page_num in range(1, query.max_page_scraped + 1):
+                items = parse_cached_listing(query.search_term, page_num)
+                if items is None:
+                    self.stdout.write(f"  Page {page_num} is not in the page cache, keeping stored rows.")
+                    pages_missing += 1
+                    continue
+                if not items:
+                    self.stdout.write(f"  Cached page {page_num} has no items, keeping stored rows.")
+                    pages_missing += 1
+                    continue
+
+                # Upsert keeps product ids (and their price history)
+                with transaction.atomic():
+                    result = upsert_page(query, page_num, items)
+                identities.update(item_identity(item) for item in items)
+                self.stdout.write(f"  Rebuilt page {page_num}: {result.total} products "
+                                  f"({result.created} new, {result.updated} changed).")
+                rebuilt_pages.append(page_num)
+                changed = changed or bool(result.created or result.updated)
+
+            if rebuilt_pages:
+                # Rows of the rebuilt pages that the new parse no longer produces on any of them
+                removed, _ = Product.objects.filter(search_query=query, page__in=rebuilt_pages).exclude(
+                    item_id__in=identities).delete()
+                if removed:
+                    self.stdout.write(f"  Removed {removed} row(s) the new parse no longer produces.")
+                    changed = True
+
+            if changed:
+                query.save(update_fields=['last_updated']) # Bump last_updated only, other fields may have moved since
+            pages_rebuilt += len(rebuilt_pages)
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Re-parse finished: {pages_rebuilt} page(s) rebuilt, {pages_missing} page(s) skipped.'
+        ))
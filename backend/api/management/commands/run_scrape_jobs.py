@@ -0,0 +1,49 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from api.jobs import claim_next_job, run_job, worker_name
+from api.metrics import start_metrics_server
+
+
+class Command(BaseCommand):
+    help = 'Runs queued scrape jobs. Start one or more of these next to the web workers.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Exit once the queue is empty instead of polling.')
+        parser.add_argument('--poll-interval', type=float, default=2.0, help='Seconds to wait between checks of an empty queue.')
+        parser.add_argument('--max-jobs', type=int, default=0, help='Exit after running this many jobs (0 = no limit).')
+        parser.add_argument('--metrics-port', type=int, default=settings.METRICS_PORT,
+                            help='Serve the Prometheus metrics of this worker on this port (0 = off).')
+
+    def handle(self, *args, **options):
+        worker = worker_name()
+        self.stdout.write(self.style.SUCCESS(f'Scrape job worker {worker} started.'))
+        if options['metrics_port']:
+            try:
+                start_metrics_server(options['metrics_port'])
+            except OSError as e:
+                self.stderr.write(f"Could not serve metrics on port {options['metrics_port']}: {e}")
+            else:
+                self.stdout.write(f"Serving metrics on port {options['metrics_port']}.")
+
+        jobs_run = 0
+        try:
+            while not options['max_jobs'] or jobs_run < options['max_jobs']:
+                job = claim_next_job(worker)
+                if job is None:
+                    if options['once']:
+                        break
+                    time.sleep(options['poll_interval'])
+                    continue
+
+                self.stdout.write(f"Running job {job.pk}: '{job.search_query.search_term}' up to page {job.pages_required}")
+                job = run_job(job)
+                jobs_run += 1
+                self.stdout.write(f"Job {job.pk} {job.status}: {job.pages_done}/{job.pages_total} pages fetched, "
+                                  f"stored up to page {job.search_query.max_page_scraped}.")
+        except KeyboardInterrupt:
+            self.stdout.write('Interrupted, stopping.')
+
+        self.stdout.write(self.style.SUCCESS(f'Scrape job worker {worker} finished after {jobs_run} job(s).'))
@@ -0,0 +1,37 @@
+"""
+Metrics of the DB writer and the exports. They share the process registry of
+scraping/metrics.py with the fetch and parse metrics of the scraper, and
+everything is served as Prometheus text by /api/metrics.
+"""
+from .fetching import SCRAPING_DIR # noqa: F401 (puts scraping/ on sys.path)
+
+from metrics import CONTENT_TYPE, REGISTRY, Counter, Histogram, start_metrics_server # noqa: F401
+
+PAGE_WRITE_SECONDS = Histogram('products_page_write_seconds', 'Time to upsert the products of one scraped page.')
+PRODUCTS_WRITTEN = Counter(
+    'products_written_total', 'Scraped products stored, by result (created, updated or unchanged).', ['result'],
+)
+SCRAPED_PAGES = Counter(
+    'scrape_pages_total', 'Pages resolved by request and job scrapes, by status (stored, empty or failed).', ['status'],
+)
+
+EXPORT_REQUESTS = Counter(
+    'export_requests_total',
+    'Export downloads by format and cache result: hit, miss (rendered from the DB), not_modified (304), '
+    'progressive (streamed while scraping) or batch (several terms, not cached).',
+    ['format', 'result'],
+)
+EXPORT_RENDER_SECONDS = Histogram(
+    'export_render_seconds', 'Time spent rendering an export from the DB, excluding the time sending it.', ['format'],
+)
+EXPORT_SIZE = Counter(
+    'export_rendered_size_total', 'Size of rendered exports: characters for csv and ndjson, bytes otherwise.', ['format'],
+)
+
+SEARCH_SECONDS = Histogram(
+    'product_search_seconds', 'Time to answer a product title search, by backend (postgresql, fts5 or like).', ['backend'],
+)
+
+
+def render_metrics():
+    return REGISTRY.render()
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:30
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0002_scrapejob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PageClaim',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('page', models.PositiveIntegerField()),
+                ('status', models.CharField(choices=[('fetching', 'Fetching'), ('stored', 'Stored'), ('empty', 'Empty'), ('failed', 'Failed')], default='fetching', max_length=16)),
+                ('owner', models.CharField(max_length=255)),
+                ('expires_at', models.DateTimeField()),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('search_query', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='page_claims', to='api.searchquery')),
+            ],
+            options={
+                'unique_together': {('search_query', 'page')},
+            },
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0003_pageclaim'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='searchquery',
+            name='last_refreshed',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='searchquery',
+            name='last_requested',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='searchquery',
+            name='request_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
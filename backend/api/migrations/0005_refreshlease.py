@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:34
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0004_searchquery_refresh_stats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RefreshLease',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('page_start', models.PositiveIntegerField()),
+                ('page_end', models.PositiveIntegerField()),
+                ('owner', models.CharField(blank=True, default='', max_length=255)),
+                ('lease_expires_at', models.DateTimeField(blank=True, null=True)),
+                ('heartbeat_at', models.DateTimeField(blank=True, null=True)),
+                ('last_refreshed_at', models.DateTimeField(blank=True, null=True)),
+                ('search_query', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='refresh_leases', to='api.searchquery')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['last_refreshed_at', 'lease_expires_at'], name='api_refresh_last_re_3393a2_idx')],
+                'unique_together': {('search_query', 'page_start')},
+            },
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:37
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_refreshlease'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PriceHistory',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('previous_price', models.CharField(max_length=100)),
+                ('price', models.CharField(max_length=100)),
+                ('changed_at', models.DateTimeField()),
+            ],
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='content_hash',
+            field=models.CharField(blank=True, default='', max_length=40),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='item_id',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+        migrations.AddConstraint(
+            model_name='product',
+            constraint=models.UniqueConstraint(condition=models.Q(('item_id', ''), _negated=True), fields=('search_query', 'item_id'), name='product_unique_item'),
+        ),
+        migrations.AddField(
+            model_name='pricehistory',
+            name='product',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='price_history', to='api.product'),
+        ),
+        migrations.AddIndex(
+            model_name='pricehistory',
+            index=models.Index(fields=['product', 'changed_at'], name='api_pricehi_product_295621_idx'),
+        ),
+    ]
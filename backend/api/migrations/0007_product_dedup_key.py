@@ -0,0 +1,79 @@
+import hashlib
+
+from django.db import migrations, models, transaction
+
+BACKFILL_BATCH_SIZE = 2000
+
+
+def key_for(product_id, item_id):
+    # Same as api.ingest.dedup_key(); rows without an item id get a key of their own
+    identity = item_id or f'legacy\x1f{product_id}'
+    return hashlib.sha1(identity.encode('utf-8')).hexdigest()
+
+
+def backfill_dedup_key(apps, schema_editor):
+    """
+    Fill dedup_key in batches by primary key, each batch in its own short
+    transaction, so a large table is never locked or held in memory at once.
+    """
+    Product = apps.get_model('api', 'Product')
+    connection = schema_editor.connection
+    update_sql = 'UPDATE {} SET dedup_key = %s WHERE id = %s'.format(connection.ops.quote_name(Product._meta.db_table))
+    last_pk = 0
+    while True:
+        batch = list(
+            Product.objects.filter(pk__gt=last_pk, dedup_key__isnull=True)
+            .order_by('pk').values_list('pk', 'item_id')[:BACKFILL_BATCH_SIZE]
+        )
+        if not batch:
+            break
+        # Plain executemany: bulk_update()'s CASE expression grows with the batch size
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.executemany(update_sql, [(key_for(pk, item_id), pk) for pk, item_id in batch])
+        last_pk = batch[-1][0]
+
+
+class Migration(migrations.Migration):
+    # The backfill commits batch by batch instead of in one long transaction
+    atomic = False
+
+    dependencies = [
+        ('api', '0006_product_item_id_price_history'),
+    ]
+
+    operations = [
+        # Nullable first: adding it needs no table rewrite on Postgres
+        migrations.AddField(
+            model_name='product',
+            name='dedup_key',
+            field=models.CharField(max_length=40, null=True),
+        ),
+        migrations.RunPython(backfill_dedup_key, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='product',
+            name='dedup_key',
+            field=models.CharField(max_length=40),
+        ),
+        migrations.AlterUniqueTogether(
+            name='product',
+            unique_together=set(),
+        ),
+        migrations.RemoveConstraint(
+            model_name='product',
+            name='product_unique_item',
+        ),
+        # Change of behaviour: the unique_together of 0001 included the page, so a
+        # listing shown on two pages of a term (sponsored or repeated listings) had
+        # a row per page. It now has one row per term, kept on the lowest page it
+        # was stored on (see ingest.upsert_page()). No existing row is merged:
+        # rows without an item id get keys of their own above, and 0006 already
+        # allowed a single row per item id and term.
+        migrations.AddConstraint(
+            model_name='product',
+            constraint=models.UniqueConstraint(fields=('search_query', 'dedup_key'), name='product_unique_dedup_key'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['search_query', 'page', 'id'], name='product_export_idx'),
+        ),
+    ]
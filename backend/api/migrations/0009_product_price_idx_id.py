@@ -0,0 +1,21 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0008_product_normalized_fields'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='product',
+            name='product_price_idx',
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['search_query', 'price_amount', 'id'], name='product_price_idx'),
+        ),
+    ]
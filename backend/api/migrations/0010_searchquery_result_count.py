@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 05:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0009_product_price_idx_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='searchquery',
+            name='results_counted_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='searchquery',
+            name='total_pages',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='searchquery',
+            name='total_results',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
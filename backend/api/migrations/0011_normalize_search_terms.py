@@ -0,0 +1,44 @@
+import re
+import unicodedata
+
+from django.db import migrations
+
+_WHITESPACE = re.compile(r'\s+')
+
+
+def normalize(term):
+    # Same as api.search.normalize_search_term()
+    kept = []
+    for char in unicodedata.normalize('NFD', term.casefold()):
+        if unicodedata.combining(char) and not (char == '\u0303' and kept and kept[-1] == 'n'):
+            continue
+        kept.append(char)
+    return _WHITESPACE.sub(' ', unicodedata.normalize('NFC', ''.join(kept))).strip()
+
+
+def normalize_search_terms(apps, schema_editor):
+    """
+    Store existing search terms in their normal form. A term whose normal
+    form is already taken keeps its old spelling: its pages are no longer
+    served, and the normalized term scrapes its own.
+    """
+    SearchQuery = apps.get_model('api', 'SearchQuery')
+    taken = set(SearchQuery.objects.values_list('search_term', flat=True))
+    for pk, search_term in SearchQuery.objects.order_by('pk').values_list('pk', 'search_term').iterator():
+        normalized = normalize(search_term)
+        if normalized == search_term or not normalized or normalized in taken:
+            continue
+        SearchQuery.objects.filter(pk=pk).update(search_term=normalized)
+        taken.discard(search_term)
+        taken.add(normalized)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0010_searchquery_result_count'),
+    ]
+
+    operations = [
+        migrations.RunPython(normalize_search_terms, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,97 @@
+from django.db import migrations
+
+# A stored generated column rather than an expression index: ranking reads
+# the tsvector of every match, and recomputing it from the title made
+# searches matching tens of thousands of rows about 5x slower. Postgres has
+# no accent folding without the unaccent extension, so accented vowels are
+# translated first. Not a model field: Django never reads or writes it.
+# Adding it rewrites api_product once.
+PG_CREATE = [
+    """
+    ALTER TABLE api_product ADD COLUMN IF NOT EXISTS title_search tsvector GENERATED ALWAYS AS (
+        to_tsvector('spanish', translate(title, 'áéíóúüÁÉÍÓÚÜàèìòùÀÈÌÒÙ', 'aeiouuAEIOUUaeiouAEIOU'))
+    ) STORED
+    """,
+    'CREATE INDEX IF NOT EXISTS product_title_search_idx ON api_product USING gin (title_search)',
+]
+PG_DROP = [
+    'DROP INDEX IF EXISTS product_title_search_idx',
+    'ALTER TABLE api_product DROP COLUMN IF EXISTS title_search',
+]
+
+# External content table: the titles are read from api_product, the FTS5
+# table only holds the index. Django rebuilds SQLite tables on some schema
+# changes (ALTER TABLE by copy), which drops these triggers: a later
+# migration altering api_product must recreate them and 'rebuild' the index.
+SQLITE_CREATE = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS api_product_fts USING fts5(
+        title, content='api_product', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS api_product_fts_insert AFTER INSERT ON api_product BEGIN
+        INSERT INTO api_product_fts(rowid, title) VALUES (new.id, new.title);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS api_product_fts_delete AFTER DELETE ON api_product BEGIN
+        INSERT INTO api_product_fts(api_product_fts, rowid, title) VALUES ('delete', old.id, old.title);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS api_product_fts_update AFTER UPDATE OF title ON api_product BEGIN
+        INSERT INTO api_product_fts(api_product_fts, rowid, title) VALUES ('delete', old.id, old.title);
+        INSERT INTO api_product_fts(rowid, title) VALUES (new.id, new.title);
+    END
+    """,
+    "INSERT INTO api_product_fts(api_product_fts) VALUES ('rebuild')",
+]
+SQLITE_DROP = [
+    'DROP TRIGGER IF EXISTS api_product_fts_insert',
+    'DROP TRIGGER IF EXISTS api_product_fts_delete',
+    'DROP TRIGGER IF EXISTS api_product_fts_update',
+    'DROP TABLE IF EXISTS api_product_fts',
+]
+
+
+def sqlite_has_fts5(connection):
+    with connection.cursor() as cursor:
+        cursor.execute('PRAGMA compile_options')
+        return any(option == 'ENABLE_FTS5' for option, in cursor.fetchall())
+
+
+def create_title_search(apps, schema_editor):
+    """Full-text index of product titles; other databases search with LIKE (see api/search.py)."""
+    connection = schema_editor.connection
+    if connection.vendor == 'postgresql':
+        statements = PG_CREATE
+    elif connection.vendor == 'sqlite' and sqlite_has_fts5(connection):
+        statements = SQLITE_CREATE
+    else:
+        return
+    for statement in statements:
+        schema_editor.execute(statement)
+
+
+def drop_title_search(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor == 'postgresql':
+        statements = PG_DROP
+    elif connection.vendor == 'sqlite':
+        statements = SQLITE_DROP
+    else:
+        return
+    for statement in statements:
+        schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0011_normalize_search_terms'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_title_search, drop_title_search),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 5.2.18 on 2026-10-18 05:49
+
+import importlib
+
+import django.utils.timezone
+from django.db import migrations, models
+
+title_search = importlib.import_module('api.migrations.0012_product_title_search')
+
+
+def restore_title_search(apps, schema_editor):
+    # Adding or removing a column rebuilds api_product on SQLite, which drops the FTS5
+    # triggers of 0012; recreating them is a no-op elsewhere (IF NOT EXISTS)
+    if schema_editor.connection.vendor == 'sqlite':
+        title_search.create_title_search(apps, schema_editor)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0012_product_title_search'),
+    ]
+
+    operations = [
+        migrations.RunPython(migrations.RunPython.noop, restore_title_search),
+        migrations.AlterModelOptions(
+            name='product',
+            options={},
+        ),
+        # Existing rows count as seen now: none of them expires before PRODUCT_RETENTION_DAYS.
+        # A constant default, so Postgres adds the column without rewriting the table.
+        migrations.AddField(
+            model_name='product',
+            name='seen_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.RunPython(restore_title_search, migrations.RunPython.noop),
+    ]
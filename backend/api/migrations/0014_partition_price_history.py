@@ -0,0 +1,106 @@
+from datetime import datetime, timezone as dt_timezone
+
+from django.db import migrations
+
+# Postgres only: api_pricehistory becomes a table partitioned by month of
+# changed_at, with a default partition, so compact_storage drops expired
+# months whole (see api/retention.py). The table is locked while its rows
+# are copied. The primary key becomes (id, changed_at), as partitioning
+# requires, and ids come from a sequence (Postgres 16 has no identity
+# columns on partitioned tables). Database only: the columns Django reads
+# and writes are unchanged and ids stay unique, so the model keeps `id` as
+# its primary key and the migration state is left as it is. A later
+# migration changing the id column of PriceHistory must take this into account.
+TABLE = 'api_pricehistory'
+DEFAULT_PARTITION = f'{TABLE}_default'
+OLD_TABLE = f'{TABLE}_unpartitioned'
+SEQUENCE = f'{TABLE}_id_seq'
+# Same as retention.PARTITIONS_AHEAD; later months are created by compact_storage
+PARTITIONS_AHEAD = 3
+
+
+def month_start(moment):
+    moment = moment.astimezone(dt_timezone.utc)
+    return datetime(moment.year, moment.month, 1, tzinfo=dt_timezone.utc)
+
+
+def next_month(start):
+    return datetime(start.year + start.month // 12, start.month % 12 + 1, 1, tzinfo=dt_timezone.utc)
+
+
+def timestamp_literal(moment):
+    # Partition bounds take no query parameters; these only ever come from month_start()
+    return f"'{moment.isoformat()}'::timestamptz"
+
+
+def partition_price_history(apps, schema_editor):
+    """Move the rows, indexes and foreign keys of api_pricehistory into a partitioned table."""
+    connection = schema_editor.connection
+    if connection.vendor != 'postgresql':
+        return
+    quote = connection.ops.quote_name
+    table, old_table = quote(TABLE), quote(OLD_TABLE)
+
+    with connection.cursor() as cursor:
+        # Partitioned by the partition_price_history command of earlier versions
+        cursor.execute('SELECT 1 FROM pg_partitioned_table WHERE partrelid = %s::regclass', [TABLE])
+        if cursor.fetchone() is not None:
+            return
+
+        cursor.execute(f'LOCK TABLE {table} IN ACCESS EXCLUSIVE MODE')
+        cursor.execute("""
+            SELECT indexdef FROM pg_indexes WHERE schemaname = current_schema() AND tablename = %s
+            AND indexname NOT IN (SELECT conname FROM pg_constraint WHERE conrelid = %s::regclass AND contype = 'p')
+        """, [TABLE, TABLE])
+        index_definitions = [definition for (definition,) in cursor.fetchall()]
+        cursor.execute(
+            "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint WHERE conrelid = %s::regclass AND contype = 'f'",
+            [TABLE],
+        )
+        foreign_keys = cursor.fetchall()
+        cursor.execute(f'SELECT min(changed_at), max(id), now() FROM {table}')
+        oldest, max_id, now = cursor.fetchone()
+
+        cursor.execute(f'ALTER TABLE {table} RENAME TO {old_table}')
+        cursor.execute(f'CREATE TABLE {table} (LIKE {old_table} INCLUDING DEFAULTS) PARTITION BY RANGE (changed_at)')
+        cursor.execute(f'CREATE TABLE {quote(DEFAULT_PARTITION)} PARTITION OF {table} DEFAULT')
+        start = month_start(oldest or now)
+        last = month_start(now)
+        for _ in range(PARTITIONS_AHEAD):
+            last = next_month(last)
+        while start <= last:
+            cursor.execute(
+                f'CREATE TABLE {quote(f"{TABLE}_p{start:%Y_%m}")} PARTITION OF {table} '
+                f'FOR VALUES FROM ({timestamp_literal(start)}) TO ({timestamp_literal(next_month(start))})'
+            )
+            start = next_month(start)
+        cursor.execute(f'INSERT INTO {table} SELECT * FROM {old_table}')
+        # Frees the names of its sequence, primary key, indexes and constraints
+        cursor.execute(f'DROP TABLE {old_table}')
+
+        cursor.execute(f'CREATE SEQUENCE {quote(SEQUENCE)} OWNED BY {table}.id')
+        if max_id is not None:
+            cursor.execute('SELECT setval(%s, %s)', [SEQUENCE, max_id])
+        cursor.execute(f"ALTER TABLE {table} ALTER COLUMN id SET DEFAULT nextval('{SEQUENCE}')")
+        cursor.execute(f'ALTER TABLE {table} ADD CONSTRAINT {quote(TABLE + "_pkey")} PRIMARY KEY (id, changed_at)')
+        for definition in index_definitions:
+            cursor.execute(definition)
+        for name, definition in foreign_keys:
+            cursor.execute(f'ALTER TABLE {table} ADD CONSTRAINT {quote(name)} {definition}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0013_product_seen_at_no_ordering'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                # Not reversed: the partitioned table serves the schema of the earlier migrations as well
+                migrations.RunPython(partition_price_history, migrations.RunPython.noop),
+            ],
+            state_operations=[],
+        ),
+    ]
@@ -1,4 +1,8 @@
+from datetime import timedelta
+
+from django.conf import settings
 from django.db import models
+from django.utils import timezone
 
 # Create your models here.
 
@@ -6,10 +10,29 @@ class SearchQuery(models.Model):
     search_term = models.CharField(max_length=255, unique=True, db_index=True)
     max_page_scraped = models.PositiveIntegerField(default=0)
     last_updated = models.DateTimeField(auto_now=True)
+    last_refreshed = models.DateTimeField(blank=True, null=True) # Last complete run of update_products
+    request_count = models.PositiveIntegerField(default=0) # Popularity, used to prioritize refreshes
+    last_requested = models.DateTimeField(blank=True, null=True)
+    # Totals MercadoLibre reports on the listing pages, null until a page of the term is scraped
+    total_results = models.PositiveIntegerField(blank=True, null=True)
+    total_pages = models.PositiveIntegerField(blank=True, null=True) # Last page with results
+    results_counted_at = models.DateTimeField(blank=True, null=True)
 
     def __str__(self):
         return f'{self.search_term} (up to page {self.max_page_scraped})'
 
+    def reachable_pages(self, pages_required):
+        """
+        `pages_required` capped at the last page of results of the term, when
+        its count is recent enough to trust (RESULT_COUNT_MAX_AGE): pages past
+        it cannot return data and are never fetched.
+        """
+        if self.total_pages is None or self.results_counted_at is None:
+            return pages_required
+        if timezone.now() - self.results_counted_at > timedelta(seconds=settings.RESULT_COUNT_MAX_AGE):
+            return pages_required
+        return min(pages_required, self.total_pages)
+
 class Product(models.Model):
     search_query = models.ForeignKey(SearchQuery, related_name='products', on_delete=models.CASCADE)
     page = models.PositiveIntegerField()
@@ -18,14 +41,144 @@ class Product(models.Model):
     seller = models.CharField(max_length=255, blank=True, null=True)
     reviews = models.CharField(max_length=255, blank=True, null=True) # Store reviews summary as text
     image_url = models.URLField(max_length=2048, blank=True, null=True)
+    item_id = models.CharField(max_length=64, blank=True, default='') # MercadoLibre item id, '' on rows stored before it was parsed
+    content_hash = models.CharField(max_length=40, blank=True, default='') # Hash of the scraped fields, see ingest.content_hash()
+    dedup_key = models.CharField(max_length=40) # Fixed-width hash of the item identity, see ingest.dedup_key()
+    # Parsed from price/seller/reviews at ingest (see normalize.py), null when the text has no value
+    price_amount = models.BigIntegerField(blank=True, null=True) # In minor units (cents)
+    currency = models.CharField(max_length=3, blank=True, default='') # ISO 4217 code
+    rating = models.DecimalField(max_digits=2, decimal_places=1, blank=True, null=True) # Out of 5
+    review_count = models.PositiveIntegerField(blank=True, null=True)
+    seller_name = models.CharField(max_length=255, blank=True, default='')
     scraped_at = models.DateTimeField(auto_now_add=True) # Timestamp of when this record was created
+    # Last scrape that listed the item, kept to within ingest.SEEN_AT_INTERVAL; see retention.py
+    seen_at = models.DateTimeField(default=timezone.now)
 
     class Meta:
-        # Prevent duplicate entries for the same product on the same page of the same search
-        # Using image_url might be more reliable if titles can change slightly or are identical
-        # Using title as part of the constraint for now
-        unique_together = ('search_query', 'page', 'title', 'image_url')
-        ordering = ['scraped_at'] # Default ordering
+        constraints = [
+            # One row per listing and search term, not per page: a listing shown on
+            # several pages is stored once, on the lowest of them (see
+            # ingest.upsert_page()), and refreshes update it in place. A 40-char
+            # hash keeps the unique index small compared to title/image_url.
+            models.UniqueConstraint(fields=['search_query', 'dedup_key'], name='product_unique_dedup_key'),
+        ]
+        indexes = [
+            # Exports filter on search_query and page and read in (page, id) order
+            models.Index(fields=['search_query', 'page', 'id'], name='product_export_idx'),
+            # Price range filters and price sorting within a search term; id makes
+            # it match the (price_amount, id) keyset order of the JSON API
+            models.Index(fields=['search_query', 'price_amount', 'id'], name='product_price_idx'),
+        ]
+        # No default ordering: every query orders by an index of its own, and a
+        # default one would add a sort on scraped_at to the rest
 
     def __str__(self):
         return f'{self.title} (Page {self.page} for \'{self.search_query.search_term}\')'
+
+class PriceHistory(models.Model):
+    """A price change of a product seen by a refresh. Unchanged prices add no rows."""
+    product = models.ForeignKey(Product, related_name='price_history', on_delete=models.CASCADE)
+    previous_price = models.CharField(max_length=100)
+    price = models.CharField(max_length=100)
+    changed_at = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['product', 'changed_at']),
+        ]
+
+    def __str__(self):
+        return f'{self.product_id}: {self.previous_price} -> {self.price} at {self.changed_at}'
+
+class ScrapeJob(models.Model):
+    """A scrape of missing pages, queued by the API and run by `manage.py run_scrape_jobs`."""
+    STATUS_PENDING = 'pending'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_DONE, 'Done'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+    ACTIVE_STATUSES = (STATUS_PENDING, STATUS_RUNNING)
+
+    search_query = models.ForeignKey(SearchQuery, related_name='jobs', on_delete=models.CASCADE)
+    pages_required = models.PositiveIntegerField()
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    pages_total = models.PositiveIntegerField(default=0) # Pages that were missing when the job started
+    pages_done = models.PositiveIntegerField(default=0) # Pages fetched so far (stored or found empty)
+    error = models.TextField(blank=True, default='')
+    worker = models.CharField(max_length=255, blank=True, default='') # host:pid of the worker running the job
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(blank=True, null=True)
+    heartbeat_at = models.DateTimeField(blank=True, null=True) # Refreshed after every page while running
+    finished_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            # Workers pick the oldest pending job
+            models.Index(fields=['status', 'created_at']),
+        ]
+
+    def __str__(self):
+        return f'Job {self.pk}: \'{self.search_query.search_term}\' up to page {self.pages_required} ({self.status})'
+
+class PageClaim(models.Model):
+    """
+    Single-flight marker for one page of a search term.
+
+    The worker that inserts (or takes over) the claim is the only one that
+    fetches the page; concurrent requests for the same page wait for the
+    claim to finish and reuse the stored rows instead of fetching it again.
+    """
+    STATUS_FETCHING = 'fetching'
+    STATUS_STORED = 'stored'
+    STATUS_EMPTY = 'empty'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_FETCHING, 'Fetching'),
+        (STATUS_STORED, 'Stored'),
+        (STATUS_EMPTY, 'Empty'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
+    search_query = models.ForeignKey(SearchQuery, related_name='page_claims', on_delete=models.CASCADE)
+    page = models.PositiveIntegerField()
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=STATUS_FETCHING)
+    owner = models.CharField(max_length=255) # Identifies the scrape run holding the claim
+    expires_at = models.DateTimeField() # A fetching claim past this time is considered abandoned
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('search_query', 'page')
+
+    def __str__(self):
+        return f'Page {self.page} of \'{self.search_query.search_term}\' ({self.status})'
+
+class RefreshLease(models.Model):
+    """
+    A range of pages of one search term, refreshed as a unit by update_products.
+
+    A worker owns the unit while `lease_expires_at` is in the future and keeps
+    extending it (heartbeat) while it works, so several hosts can run the
+    refresh at once without fetching the same pages twice.
+    """
+    search_query = models.ForeignKey(SearchQuery, related_name='refresh_leases', on_delete=models.CASCADE)
+    page_start = models.PositiveIntegerField()
+    page_end = models.PositiveIntegerField()
+    owner = models.CharField(max_length=255, blank=True, default='') # host:pid of the current holder
+    lease_expires_at = models.DateTimeField(blank=True, null=True)
+    heartbeat_at = models.DateTimeField(blank=True, null=True)
+    last_refreshed_at = models.DateTimeField(blank=True, null=True) # When every page of the unit was last refreshed
+
+    class Meta:
+        unique_together = ('search_query', 'page_start')
+        indexes = [
+            # Claims look for the least recently refreshed free units
+            models.Index(fields=['last_refreshed_at', 'lease_expires_at']),
+        ]
+
+    def __str__(self):
+        return f'Pages {self.page_start}-{self.page_end} of \'{self.search_query.search_term}\''
@@ -0,0 +1,19 @@
+from django.http import Http404
+from rest_framework.exceptions import NotAcceptable
+from rest_framework.negotiation import DefaultContentNegotiation
+
+
+class ExportContentNegotiation(DefaultContentNegotiation):
+    """
+    For views that pick their export format themselves (see
+    exports.negotiate_export_format()) and only use DRF renderers for JSON
+    errors: '?format=csv' or 'Accept: application/gzip' must reach the view
+    instead of failing with DRF's 404 (unknown format) or 406 (no renderer).
+    """
+
+    def select_renderer(self, request, renderers, format_suffix=None):
+        try:
+            return super().select_renderer(request, renderers, format_suffix)
+        except (Http404, NotAcceptable):
+            renderer = renderers[0]
+            return renderer, renderer.media_type
@@ -0,0 +1,71 @@
+"""
+Numeric fields parsed from the display strings of a listing item.
+
+MercadoLibre renders prices as '$1.054.000' (dots group thousands) and,
+with the cents superscript, as '$5.983.00050' (cents glued to the end).
+Ratings come as 'Calificación 4,8 de 5 estrellas. 1494 opiniones.'.
+"""
+import re
+from decimal import Decimal
+
+# Currency symbol -> ISO code. Plain '$' is the peso of the site being scraped (listado.mercadolibre.com.co)
+CURRENCY_SYMBOLS = {
+    '$': 'COP',
+    'US$': 'USD',
+    'U$S': 'USD',
+}
+
+# Minor units per major unit of every currency above
+MINOR_UNITS = 100
+
+_PRICE = re.compile(r'^(?P<symbol>[^\d\s]*)\s*(?P<units>\d{1,3}(?:\.\d{3})*)(?P<cents>\d{2})?$')
+_RATING = re.compile(r'(?P<rating>\d(?:[.,]\d)?) de 5')
+_REVIEW_COUNT = re.compile(r'(?P<count>\d[\d.]*) opini')
+_SELLER_PREFIX = re.compile(r'^(?:vendido por|por)\s+', re.IGNORECASE)
+
+
+def parse_price(text):
+    """(amount in minor units, currency code) of a display price, or (None, '') if it is not one."""
+    match = _PRICE.match((text or '').strip())
+    if not match:
+        return None, ''
+    currency = CURRENCY_SYMBOLS.get(match.group('symbol'))
+    if currency is None:
+        return None, ''
+    units = int(match.group('units').replace('.', ''))
+    cents = int(match.group('cents') or 0)
+    return units * MINOR_UNITS + cents, currency
+
+
+def parse_reviews(text):
+    """(rating, review count) of a reviews summary; either is None when missing."""
+    text = text or ''
+    rating = review_count = None
+    match = _RATING.search(text)
+    if match:
+        rating = Decimal(match.group('rating').replace(',', '.'))
+    match = _REVIEW_COUNT.search(text)
+    if match:
+        review_count = int(match.group('count').replace('.', ''))
+    return rating, review_count
+
+
+def parse_seller(text):
+    """Seller name without the 'Por ' / 'Vendido por ' prefix, '' when there is none."""
+    text = (text or '').strip()
+    if not _SELLER_PREFIX.match(text):
+        return '' # Includes the 'No seller info' fallback
+    return _SELLER_PREFIX.sub('', text)
+
+
+def normalized_fields(price, seller, reviews):
+    """Values of the numeric Product columns for the given display strings."""
+    price_amount, currency = parse_price(price)
+    rating, review_count = parse_reviews(reviews)
+    return {
+        'price_amount': price_amount,
+        'currency': currency,
+        'rating': rating,
+        'review_count': review_count,
+        'seller_name': parse_seller(seller),
+    }
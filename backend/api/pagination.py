@@ -0,0 +1,102 @@
+"""
+Keyset (cursor) pagination for the JSON product API.
+
+The cursor holds the sort key of the last row sent, and the next page is
+the rows after it in the queryset's order: a range scan on the matching
+index, so page 1000 costs the same as page 1 (unlike OFFSET, which reads
+and discards every row before it).
+"""
+import base64
+import json
+
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """
+    Pages through a queryset ordered by plain fields ending in a unique one,
+    e.g. order_by('page', 'id') or order_by('-price_amount', '-id'). The
+    ordering fields must not be null.
+    """
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    page_size = 50
+    max_page_size = 500
+    invalid_cursor_message = 'Invalid cursor.'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.ordering = [
+            (field[1:], True) if field.startswith('-') else (field, False)
+            for field in queryset.query.order_by
+        ]
+        page_size = self.get_page_size(request)
+
+        cursor = self.decode_cursor(request)
+        if cursor is not None:
+            try:
+                queryset = queryset.filter(self.after(cursor))
+            except (TypeError, ValueError): # Values of the wrong type for the fields
+                raise NotFound(self.invalid_cursor_message)
+
+        # One extra row tells whether there is a next page
+        rows = list(queryset[:page_size + 1])
+        self.has_next = len(rows) > page_size
+        rows = rows[:page_size]
+        self.next_position = [getattr(rows[-1], name) for name, _ in self.ordering] if self.has_next else None
+        return rows
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return min(max(page_size, 1), self.max_page_size)
+
+    def after(self, position):
+        """Rows strictly after `position` in the ordering: (a > x) or (a = x and b > y) ..."""
+        condition = Q()
+        equal = Q()
+        for (name, descending), value in zip(self.ordering, position):
+            lookup = 'lt' if descending else 'gt'
+            condition |= equal & Q(**{f'{name}__{lookup}': value})
+            equal &= Q(**{name: value})
+        # Redundant bound on the first field, so the DB can start an index range scan there
+        name, descending = self.ordering[0]
+        bound = Q(**{f"{name}__{'lte' if descending else 'gte'}": position[0]})
+        return bound & condition
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            position = json.loads(base64.urlsafe_b64decode(encoded.encode('ascii')))
+        except (TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+        if not isinstance(position, list) or len(position) != len(self.ordering):
+            raise NotFound(self.invalid_cursor_message)
+        return position
+
+    def encode_cursor(self, position):
+        return base64.urlsafe_b64encode(json.dumps(position).encode('utf-8')).decode('ascii')
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(self.next_position))
+
+    def get_first_link(self):
+        return remove_query_param(self.request.build_absolute_uri(), self.cursor_query_param)
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'first': self.get_first_link(),
+            'results': data,
+        })
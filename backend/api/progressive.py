@@ -0,0 +1,270 @@
+"""
+Progressive exports ('?progressive=true'): the stored pages of a term are
+streamed at once while the missing ones are scraped, and each scraped page
+is appended as soon as it and every page before it are stored. The time to
+first byte of a partially stored term is then a DB read instead of a fetch
+of every missing page.
+
+The scrape runs alongside the response: in a thread for ProductDataView,
+in a task for AsyncProductDataView. A client that disconnects does not stop
+it, the pages are stored for the next request. Rows are in page order, so
+only the text formats are offered and the 'sort' parameter must be 'page'.
+
+The response starts with X-Pages-Complete (pages stored when it started)
+and X-Pages-Requested. The body holds product rows only: CSV has no comment
+syntax, so a trailer line would be read as a bogus row. The pages complete
+once the response has ended are given by GET /api/products/status (see
+views.ProductStatusView). Fewer pages than requested means the term has no
+more results or a page failed.
+"""
+import asyncio
+import csv
+import json
+import logging
+import queue
+import threading
+import zlib
+
+from django.conf import settings
+from django.db import connection
+from django.http import StreamingHttpResponse
+
+from .asyncdb import run_db
+from .exports import EXPORT_FIELDS, GZIP_LEVEL, Echo, _json_value
+from .ingest import scrape_missing_pages, scrape_missing_pages_async
+from .models import PageClaim, SearchQuery
+
+logger = logging.getLogger(__name__)
+
+# Listing pages have up to 48 products: stored pages are read about EXPORT_CHUNK_SIZE rows at a time
+PRODUCTS_PER_PAGE = 48
+
+# Scrapes of async responses, referenced until they finish (the event loop only keeps weak references)
+_background_scrapes = set()
+
+
+# --- Segment Renderers ---
+
+class CsvSegments:
+    """CSV rendered a block of rows at a time."""
+
+    def __init__(self):
+        self.writer = csv.writer(Echo())
+
+    def start(self):
+        return self.writer.writerow(EXPORT_FIELDS)
+
+    def rows(self, rows):
+        return ''.join(self.writer.writerow(row) for row in rows)
+
+    def finish(self):
+        return ''
+
+
+class CsvGzipSegments(CsvSegments):
+    """
+    CsvSegments compressed as a single gzip member. Each segment ends with a
+    sync flush, so the client can decompress every row sent so far.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31) # wbits=31: gzip header and trailer
+
+    def compress(self, text):
+        return self.compressor.compress(text.encode('utf-8')) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def start(self):
+        return self.compress(super().start())
+
+    def rows(self, rows):
+        return self.compress(super().rows(rows)) if rows else b''
+
+    def finish(self):
+        return self.compressor.flush()
+
+
+class NdjsonSegments:
+    """NDJSON rendered a block of rows at a time."""
+
+    def start(self):
+        return ''
+
+    def rows(self, rows):
+        return ''.join(
+            json.dumps(dict(zip(EXPORT_FIELDS, row)), ensure_ascii=False, default=_json_value) + '\n' for row in rows
+        )
+
+    def finish(self):
+        return ''
+
+
+# Parquet is only readable once its footer is written, and Arrow IPC clients
+# mostly read whole files: progressive exports are text only
+SEGMENT_RENDERERS = {
+    'csv': CsvSegments,
+    'csv.gz': CsvGzipSegments,
+    'ndjson': NdjsonSegments,
+}
+
+
+def wants_progressive(request, options, export_format):
+    """
+    True when the export is asked for with 'progressive=true'. Raises
+    ValueError with a message for the client when the format or the sort
+    order cannot be streamed page by page.
+    """
+    value = request.GET.get('progressive', '')
+    if value.lower() not in ('1', 'true', 'yes'):
+        return False
+    if export_format.name not in SEGMENT_RENDERERS:
+        raise ValueError(f"Progressive exports are available in: {', '.join(SEGMENT_RENDERERS)}.")
+    if options['sort'] != 'page':
+        raise ValueError("Progressive exports are sorted by page, 'sort' must be 'page'.")
+    return True
+
+
+# --- Rows ---
+
+def page_rows(products, first_page, last_page):
+    """EXPORT_FIELDS tuples of `products` on pages first_page to last_page, in page order."""
+    return list(
+        products.filter(page__gte=first_page, page__lte=last_page).order_by('page', 'id').values_list(*EXPORT_FIELDS)
+    )
+
+
+def stored_page_ranges(pages_complete):
+    """(first, last) page ranges covering pages 1 to `pages_complete`, about EXPORT_CHUNK_SIZE rows each."""
+    step = max(1, settings.EXPORT_CHUNK_SIZE // PRODUCTS_PER_PAGE)
+    for first_page in range(1, pages_complete + 1, step):
+        yield first_page, min(first_page + step - 1, pages_complete)
+
+
+class PageProgress:
+    """
+    Pages of a progressive export: complete ones are exported, pages stored
+    out of order wait until every page before them is stored.
+    """
+
+    def __init__(self, pages_complete):
+        self.pages_complete = pages_complete
+        self.stored_pages = set()
+
+    def record(self, page_num, page_status):
+        """Pages that became exportable with this outcome, in order."""
+        if page_status == PageClaim.STATUS_STORED:
+            self.stored_pages.add(page_num)
+        ready = []
+        while self.pages_complete + 1 in self.stored_pages:
+            self.pages_complete += 1
+            ready.append(self.pages_complete)
+        return ready
+
+
+# --- Sync Stream ---
+
+def scrape_into_queue(search_query_pk, pages_required, events):
+    """Thread body: scrape the missing pages, putting (page_num, status) on `events`, then None."""
+    try:
+        search_query = SearchQuery.objects.get(pk=search_query_pk)
+        scrape_missing_pages(
+            search_query, pages_required,
+            on_page=lambda page_num, page_status, count: events.put((page_num, page_status)),
+        )
+    except Exception:
+        logger.exception("Progressive export scrape failed", extra={'search_query': search_query_pk})
+    finally:
+        connection.close() # The thread's own connection
+        events.put(None)
+
+
+def iter_progressive(search_query, products, pages_required, segments):
+    """Chunks of a progressive export, scraping the missing pages in a thread."""
+    progress = PageProgress(min(search_query.max_page_scraped, pages_required))
+    yield segments.start()
+    for first_page, last_page in stored_page_ranges(progress.pages_complete):
+        yield segments.rows(page_rows(products, first_page, last_page))
+
+    if progress.pages_complete < search_query.reachable_pages(pages_required):
+        events = queue.Queue()
+        threading.Thread(
+            target=scrape_into_queue, args=(search_query.pk, pages_required, events),
+            name='progressive-scrape', daemon=True,
+        ).start()
+        while (event := events.get()) is not None:
+            for page_num in progress.record(*event):
+                yield segments.rows(page_rows(products, page_num, page_num))
+
+    yield segments.finish()
+
+
+# --- Async Stream ---
+
+async def scrape_into_async_queue(search_query, pages_required, events):
+    loop = asyncio.get_running_loop()
+
+    def on_page(page_num, page_status, count):
+        # Called in the DB thread of run_db() as well as on the loop
+        loop.call_soon_threadsafe(events.put_nowait, (page_num, page_status))
+
+    try:
+        await scrape_missing_pages_async(search_query, pages_required, on_page=on_page)
+    except Exception:
+        logger.exception("Progressive export scrape failed", extra={'search_term': search_query.search_term})
+    finally:
+        # After the on_page calls: run_db() results reach the loop through call_soon_threadsafe too
+        events.put_nowait(None)
+
+
+async def aiter_progressive(search_query, products, pages_required, segments):
+    """iter_progressive() for async views: the scrape is a task, rows are read through run_db()."""
+    progress = PageProgress(min(search_query.max_page_scraped, pages_required))
+    yield segments.start()
+    for first_page, last_page in stored_page_ranges(progress.pages_complete):
+        yield segments.rows(await run_db(page_rows, products, first_page, last_page))
+
+    if progress.pages_complete < search_query.reachable_pages(pages_required):
+        events = asyncio.Queue()
+        task = asyncio.ensure_future(scrape_into_async_queue(search_query, pages_required, events))
+        _background_scrapes.add(task)
+        task.add_done_callback(_background_scrapes.discard)
+        while (event := await events.get()) is not None:
+            for page_num in progress.record(*event):
+                yield segments.rows(await run_db(page_rows, products, page_num, page_num))
+
+    yield segments.finish()
+
+
+# --- Responses ---
+
+def skip_empty(chunks):
+    for chunk in chunks:
+        if chunk:
+            yield chunk
+
+
+async def askip_empty(chunks):
+    async for chunk in chunks:
+        if chunk:
+            yield chunk
+
+
+def progressive_response(search_query, products, search_term, pages_required, export_format, async_stream=False):
+    """
+    StreamingHttpResponse of a progressive export of `products` (filtered, not
+    yet limited to pages). Not cached and without an ETag: its content
+    depends on how far the scrape got.
+    """
+    segments = SEGMENT_RENDERERS[export_format.name]()
+    if async_stream:
+        chunks = askip_empty(aiter_progressive(search_query, products, pages_required, segments))
+    else:
+        chunks = skip_empty(iter_progressive(search_query, products, pages_required, segments))
+    response = StreamingHttpResponse(chunks, content_type=export_format.content_type)
+    filename = f"products_{search_term}_pages_1_to_{pages_required}.{export_format.extension}"
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    response['X-Pages-Complete'] = str(min(search_query.max_page_scraped, pages_required))
+    response['X-Pages-Requested'] = str(pages_required)
+    response['Cache-Control'] = 'no-store'
+    response['Vary'] = 'Accept'
+    return response
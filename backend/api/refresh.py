@@ -0,0 +1,307 @@
+"""
+Scheduler for `manage.py update_products`.
+
+The stored pages of every term are split into RefreshLease units of
+REFRESH_UNIT_PAGES pages. Workers on any number of hosts claim due units
+with an expiring lease (SELECT ... FOR UPDATE SKIP LOCKED where the
+database supports it, a conditional UPDATE otherwise), stalest and most
+requested terms first, and keep the lease alive with a heartbeat after
+every page. Claimed pages are fed to the concurrent fetch engine, so one
+worker pool shared by all terms uses the whole request budget, and each
+page is committed on its own as soon as it is fetched. Only products whose
+content changed are written (see ingest.upsert_page()).
+"""
+import logging
+import math
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F, Min, Q
+from django.utils import timezone
+
+from .claims import mark_page_stored, new_owner
+from .fetching import fetch_units
+from .ingest import record_result_count, upsert_page
+from .jobs import worker_name
+from .models import RefreshLease, SearchQuery
+
+logger = logging.getLogger(__name__)
+
+# Claim candidates looked at per claimed unit, re-ranked by refresh_priority()
+CANDIDATE_FACTOR = 4
+
+
+def refresh_priority(refreshed_at, request_count, now):
+    """Seconds since the last refresh, weighted up by how often the term is requested."""
+    staleness = max(0.0, (now - refreshed_at).total_seconds())
+    return staleness * (1 + math.log1p(request_count))
+
+
+def sync_refresh_units(unit_pages=None):
+    """
+    Make sure every stored page belongs to a RefreshLease unit.
+
+    Safe to run from several hosts at once: missing units are inserted with
+    ignore_conflicts, and units only ever grow to cover new pages.
+    """
+    unit_pages = unit_pages or settings.REFRESH_UNIT_PAGES
+    existing = {
+        (search_query_id, page_start): (pk, page_end)
+        for pk, search_query_id, page_start, page_end in RefreshLease.objects.values_list(
+            'pk', 'search_query_id', 'page_start', 'page_end')
+    }
+
+    to_create = []
+    for search_query_id, max_page in SearchQuery.objects.filter(max_page_scraped__gt=0).values_list('pk', 'max_page_scraped'):
+        for page_start in range(1, max_page + 1, unit_pages):
+            page_end = min(page_start + unit_pages - 1, max_page)
+            unit = existing.get((search_query_id, page_start))
+            if unit is None:
+                to_create.append(RefreshLease(search_query_id=search_query_id, page_start=page_start, page_end=page_end))
+            elif unit[1] < page_end:
+                RefreshLease.objects.filter(pk=unit[0], page_end__lt=page_end).update(page_end=page_end)
+    RefreshLease.objects.bulk_create(to_create, ignore_conflicts=True)
+
+
+def shrink_refresh_units(search_query_id, max_page):
+    """Fit the units of a term to its pages once `max_page_scraped` was lowered to `max_page`."""
+    RefreshLease.objects.filter(search_query_id=search_query_id, page_start__gt=max_page).delete()
+    RefreshLease.objects.filter(search_query_id=search_query_id, page_end__gt=max_page).update(page_end=max_page)
+
+
+def claim_refresh_units(owner, limit, refreshed_before, search_query_ids=None, exclude_ids=()):
+    """
+    Lease up to `limit` due units for `owner`, highest priority first.
+
+    A unit is due when it was never refreshed or last refreshed before
+    `refreshed_before`, and free when it has no lease or its lease expired.
+    `search_query_ids` limits the claim to the units of those terms, and
+    units whose pk is in `exclude_ids` are never claimed.
+    """
+    now = timezone.now()
+    lease_until = now + timedelta(seconds=settings.REFRESH_LEASE_SECONDS)
+    due = Q(last_refreshed_at__isnull=True) | Q(last_refreshed_at__lt=refreshed_before)
+    free = Q(lease_expires_at__isnull=True) | Q(lease_expires_at__lt=now)
+    candidates = RefreshLease.objects.filter(due & free)
+    if search_query_ids is not None:
+        candidates = candidates.filter(search_query_id__in=search_query_ids)
+    if exclude_ids:
+        candidates = candidates.exclude(pk__in=exclude_ids)
+    candidates = candidates.order_by(
+        F('last_refreshed_at').asc(nulls_first=True), 'pk'
+    ).values_list('pk', 'lease_expires_at', 'last_refreshed_at', 'search_query__request_count', 'search_query__last_updated')
+
+    def ranked(rows):
+        return sorted(
+            rows,
+            key=lambda row: refresh_priority(row[2] or row[4], row[3], now),
+            reverse=True,
+        )
+
+    claimed = []
+    if connection.features.has_select_for_update_skip_locked:
+        # Postgres: rows locked by another host's claim are skipped, not waited for
+        with transaction.atomic():
+            rows = list(candidates.select_for_update(skip_locked=True, of=('self',))[:limit * CANDIDATE_FACTOR])
+            claimed = [row[0] for row in ranked(rows)[:limit]]
+            RefreshLease.objects.filter(pk__in=claimed).update(
+                owner=owner, lease_expires_at=lease_until, heartbeat_at=now
+            )
+    else:
+        # SQLite and friends: compare-and-swap on the lease expiry of each candidate
+        for row in ranked(candidates[:limit * CANDIDATE_FACTOR]):
+            taken = RefreshLease.objects.filter(pk=row[0], lease_expires_at=row[1]).update(
+                owner=owner, lease_expires_at=lease_until, heartbeat_at=now
+            )
+            if taken:
+                claimed.append(row[0])
+                if len(claimed) >= limit:
+                    break
+
+    units = RefreshLease.objects.filter(pk__in=claimed, owner=owner).select_related('search_query')
+    return sorted(units, key=lambda unit: claimed.index(unit.pk))
+
+
+def heartbeat(unit, owner):
+    """Extend the lease on `unit`. Returns False if `owner` lost it (it expired and was re-claimed)."""
+    now = timezone.now()
+    return bool(RefreshLease.objects.filter(pk=unit.pk, owner=owner).update(
+        lease_expires_at=now + timedelta(seconds=settings.REFRESH_LEASE_SECONDS),
+        heartbeat_at=now,
+    ))
+
+
+def complete_unit(unit, owner):
+    """Mark `unit` refreshed and release its lease."""
+    now = timezone.now()
+    RefreshLease.objects.filter(pk=unit.pk, owner=owner).update(
+        last_refreshed_at=now, owner='', lease_expires_at=None
+    )
+    # A term counts as refreshed as of its least recently refreshed unit, once every unit was refreshed
+    units = RefreshLease.objects.filter(search_query_id=unit.search_query_id)
+    if units.filter(last_refreshed_at__isnull=True).exists():
+        return
+    oldest = units.aggregate(oldest=Min('last_refreshed_at'))['oldest']
+    if oldest is not None:
+        SearchQuery.objects.filter(pk=unit.search_query_id).update(last_refreshed=oldest)
+
+
+def release_unit(unit, owner):
+    """Release the lease on `unit` without marking it refreshed, so it stays due."""
+    RefreshLease.objects.filter(pk=unit.pk, owner=owner).update(owner='', lease_expires_at=None)
+
+
+class RefreshStats:
+    def __init__(self):
+        self.pages_stored = 0
+        self.pages_empty = 0
+        self.pages_skipped = 0
+        self.pages_failed = 0
+        self.products_created = 0
+        self.products_updated = 0
+        self.products_unchanged = 0
+        self.price_changes = 0
+        self.units_completed = 0
+        self.units_failed = 0
+        self.units_lost = 0
+
+
+def run_refresh(max_workers=None, max_duration=None, min_age=0, claim_batch=None, log=logger.info,
+                search_query_ids=None):
+    """
+    Claim and refresh due units until none are left or `max_duration`
+    (seconds) has passed. Units are claimed lazily, a batch at a time, as
+    the worker pool drains, so leases are never held by queued work for long.
+    `search_query_ids` limits the refresh to those terms. Returns a RefreshStats.
+
+    A unit is only marked refreshed when each of its pages was stored or is
+    past the last page of results of its term. A unit with a page that could
+    not be fetched or saved is released still due, and not claimed again by
+    this run.
+    """
+    max_workers = max_workers or settings.SCRAPER_CONCURRENCY
+    claim_batch = claim_batch or max(1, max_workers)
+    # Unique per run, so two runs in one process never share leases
+    owner = f'{worker_name()}:{new_owner()[:8]}'
+    stats = RefreshStats()
+    # Units refreshed after this point (by this run or another host) are not due again
+    refreshed_before = timezone.now() - timedelta(seconds=min_age)
+    deadline = time.monotonic() + max_duration if max_duration else None
+
+    unit_of = {} # (search_term, page) -> RefreshLease
+    pages_left = {} # RefreshLease pk -> pages not handled yet
+    lost = set() # RefreshLease pks whose lease was taken over
+    failed = set() # RefreshLease pks with a page that was neither stored nor past the last page
+    last_pages = {} # search_term -> lowest last page of results reported by the pages fetched in this run
+
+    def past_last_page(unit, page_num):
+        last_page = last_pages.get(unit.search_query.search_term)
+        if last_page is not None:
+            return page_num > last_page
+        return unit.search_query.reachable_pages(page_num) < page_num
+
+    def leased_pages():
+        while deadline is None or time.monotonic() < deadline:
+            units = claim_refresh_units(owner, claim_batch, refreshed_before, search_query_ids, exclude_ids=failed)
+            if not units:
+                return
+            for unit in units:
+                log(f"Claimed pages {unit.page_start}-{unit.page_end} of '{unit.search_query.search_term}'")
+                # Pages past the last page of results the term now has would come back empty
+                page_end = unit.search_query.reachable_pages(unit.page_end)
+                stats.pages_skipped += unit.page_end - max(page_end, unit.page_start - 1)
+                if page_end < unit.page_start:
+                    complete_unit(unit, owner)
+                    stats.units_completed += 1
+                    log(f"  Skipped pages {unit.page_start}-{unit.page_end}: '{unit.search_query.search_term}' "
+                        f"has {unit.search_query.total_pages} page(s) of results.")
+                    continue
+                pages_left[unit.pk] = page_end - unit.page_start + 1
+                for page_num in range(unit.page_start, page_end + 1):
+                    if unit.pk in lost:
+                        break
+                    unit_of[(unit.search_query.search_term, page_num)] = unit
+                    yield unit.search_query.search_term, page_num
+
+    # Always fetch a fresh copy: refreshing from the page cache would be a no-op
+    results = fetch_units(leased_pages(), max_workers=max_workers, deadline=deadline, use_cache=False)
+    for search_term, page_num, items in results:
+        unit = unit_of.pop((search_term, page_num))
+
+        if items is not None:
+            record_result_count(unit.search_query, page_num, items)
+            # Failed fetches give a plain list, without totals (see scraper.fetch_listing_items())
+            total_pages = getattr(items, 'total_pages', None)
+            if total_pages is not None:
+                last_pages[search_term] = min(total_pages, last_pages.get(search_term, total_pages))
+        if items is None:
+            stats.pages_skipped += 1
+            if not past_last_page(unit, page_num):
+                # Not fetched because an earlier page of the term failed
+                failed.add(unit.pk)
+        elif not items:
+            if past_last_page(unit, page_num):
+                log(f"  Page {page_num} of '{search_term}' is past the last page of results.")
+                stats.pages_empty += 1
+            else:
+                log(f"  No data returned for page {page_num} of '{search_term}'. The page failed or is not a listing page.")
+                stats.pages_failed += 1
+                failed.add(unit.pk)
+        else:
+            try:
+                with transaction.atomic():
+                    result = upsert_page(unit.search_query, page_num, items)
+                    mark_page_stored(unit.search_query, page_num, owner)
+                    if result.created or result.updated:
+                        # Moves the export ETag for this term, its rows changed
+                        SearchQuery.objects.filter(pk=unit.search_query_id).update(last_updated=timezone.now())
+            except Exception as e:
+                log(f"  Error saving page {page_num} for '{search_term}': {e}")
+                stats.pages_failed += 1
+                failed.add(unit.pk)
+            else:
+                log(f"  Page {page_num} of '{search_term}': {result.created} new, {result.updated} changed "
+                    f"({result.price_changes} price changes), {result.unchanged} unchanged.")
+                stats.pages_stored += 1
+                stats.products_created += result.created
+                stats.products_updated += result.updated
+                stats.products_unchanged += result.unchanged
+                stats.price_changes += result.price_changes
+
+        if unit.pk in lost:
+            continue
+        if not heartbeat(unit, owner):
+            log(f"  Lease on pages {unit.page_start}-{unit.page_end} of '{search_term}' was lost, leaving them to its new owner.")
+            lost.add(unit.pk)
+            stats.units_lost += 1
+            continue
+        pages_left[unit.pk] -= 1
+        if pages_left[unit.pk] > 0:
+            continue
+        if unit.pk in failed:
+            release_unit(unit, owner)
+            stats.units_failed += 1
+            log(f"Failed to refresh pages {unit.page_start}-{unit.page_end} of '{search_term}', leaving them due.")
+        else:
+            complete_unit(unit, owner)
+            stats.units_completed += 1
+            log(f"Finished pages {unit.page_start}-{unit.page_end} of '{search_term}'.")
+
+    # Units cut short by the deadline: hand them back right away instead of waiting for expiry
+    RefreshLease.objects.filter(owner=owner, lease_expires_at__isnull=False).update(owner='', lease_expires_at=None)
+    return stats
+
+
+def record_request(search_query):
+    """Count a client request for `search_query` (refresh popularity)."""
+    record_requests([search_query])
+
+
+def record_requests(search_queries):
+    """Count a client request for each of `search_queries`, in one statement."""
+    SearchQuery.objects.filter(pk__in=[search_query.pk for search_query in search_queries]).update(
+        request_count=F('request_count') + 1,
+        last_requested=timezone.now(),
+    )
@@ -0,0 +1,348 @@
+"""
+Retention policy and compaction of stored rows (`manage.py compact_storage`).
+
+Products are upserted in place, one row per listing and term, so refreshes
+do not add product rows. What piles up is:
+
+- Products no longer listed, whose seen_at stops moving. One expires when it
+  has not been seen for PRODUCT_RETENTION_DAYS, every page of its term was
+  refreshed since (SearchQuery.last_refreshed), and its own page was either
+  stored again since (a STORED PageClaim) or is past the last page of results
+  counted since. Pages that failed or were skipped never expire anything, and
+  terms nobody refreshes keep their rows. The product row is the latest
+  snapshot of a listing. Pages left without rows are dropped from the term
+  (max_page_scraped, STORED claims and refresh units), so they are scraped
+  again when asked for.
+- Price changes (PriceHistory) older than PRICE_HISTORY_RETENTION_DAYS.
+- Scrape jobs finished more than SCRAPE_JOB_RETENTION_DAYS ago.
+
+Rows are deleted a primary key window of COMPACTION_BATCH_SIZE at a time,
+each window in a short transaction of its own: no statement reads or locks
+more than one window, and an interrupted run loses nothing, the next one
+evaluates the policy again. Deleted rows can be archived first as gzipped
+NDJSON (at least once: a window whose delete fails is archived again).
+
+On Postgres, PriceHistory is partitioned by month of changed_at (migration
+0014), and expired months are dropped whole.
+Product is not partitioned: rows are updated in place under a unique
+(search_query, dedup_key) constraint, which a table partitioned by time
+could not enforce.
+"""
+import gzip
+import json
+import logging
+import re
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone as dt_timezone
+from pathlib import Path
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection, transaction
+from django.db.models import Exists, F, Max, Min, OuterRef, Q
+from django.utils import timezone
+
+from .ingest import SEEN_AT_INTERVAL
+from .models import PageClaim, PriceHistory, Product, ScrapeJob, SearchQuery
+from .refresh import shrink_refresh_units
+
+logger = logging.getLogger(__name__)
+
+PARTITIONED_TABLE = PriceHistory._meta.db_table
+DEFAULT_PARTITION = f'{PARTITIONED_TABLE}_default'
+_MONTH_PARTITION = re.compile(rf'^{PARTITIONED_TABLE}_p(\d{{4}})_(\d{{2}})$')
+# Months of partitions created ahead of the current one, so inserts never wait for a compaction run
+PARTITIONS_AHEAD = 3
+
+
+# --- Policy ---
+
+def retention_cutoff(days, now):
+    """`now` minus `days` days, or None when `days` is 0 (keep forever)."""
+    return now - timedelta(days=days) if days else None
+
+
+def expired_products(now):
+    cutoff = retention_cutoff(settings.PRODUCT_RETENTION_DAYS, now)
+    if cutoff is None:
+        return Product.objects.none()
+    # seen_at lags up to SEEN_AT_INTERVAL behind the last scrape listing the item
+    seen_before = F('seen_at') + SEEN_AT_INTERVAL
+    page_stored_since = Exists(PageClaim.objects.filter(
+        search_query=OuterRef('search_query'), page=OuterRef('page'),
+        status=PageClaim.STATUS_STORED, updated_at__gt=OuterRef('seen_at') + SEEN_AT_INTERVAL,
+    ))
+    page_past_end = Q(page__gt=F('search_query__total_pages'), search_query__results_counted_at__gt=seen_before)
+    return Product.objects.filter(seen_at__lt=cutoff).filter(
+        seen_at__lt=F('search_query__last_refreshed') - SEEN_AT_INTERVAL,
+    ).filter(page_stored_since | page_past_end)
+
+
+def expired_price_history(now):
+    cutoff = retention_cutoff(settings.PRICE_HISTORY_RETENTION_DAYS, now)
+    if cutoff is None:
+        return PriceHistory.objects.none()
+    return PriceHistory.objects.filter(changed_at__lt=cutoff)
+
+
+def expired_jobs(now):
+    cutoff = retention_cutoff(settings.SCRAPE_JOB_RETENTION_DAYS, now)
+    if cutoff is None:
+        return ScrapeJob.objects.none()
+    return ScrapeJob.objects.filter(
+        status__in=(ScrapeJob.STATUS_DONE, ScrapeJob.STATUS_FAILED), finished_at__lt=cutoff,
+    )
+
+
+# --- Archive ---
+
+class Archive:
+    """Deleted rows as gzipped NDJSON, one file per table and run in `directory`."""
+
+    def __init__(self, directory, now):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.stamp = now.strftime('%Y%m%dT%H%M%S')
+        self.files = {}
+
+    def write(self, model, rows):
+        table = model._meta.db_table
+        file = self.files.get(table)
+        if file is None:
+            file = self.files[table] = gzip.open(self.directory / f'{table}-{self.stamp}.ndjson.gz', 'at', encoding='utf-8')
+        for row in rows:
+            file.write(json.dumps(row, cls=DjangoJSONEncoder, ensure_ascii=False) + '\n')
+        file.flush() # Before the rows are deleted
+
+    def close(self):
+        for file in self.files.values():
+            file.close()
+        self.files = {}
+
+
+# --- Compaction ---
+
+class CompactionStats:
+    def __init__(self):
+        self.deleted = Counter() # Rows deleted by model label, cascades included
+        self.partitions_dropped = 0
+        self.partitions_created = 0
+        self.finished = True # False when stopped by the deadline
+
+
+def compact(queryset, batch_size, stats, archive=None, deadline=None, pause=0, high=None, on_window=None):
+    """
+    Delete the rows of `queryset` a window of `batch_size` primary keys at a
+    time, each window in a transaction of its own, up to primary key `high`
+    (default: the largest). `on_window` is called with the ids about to be
+    deleted, inside the window's transaction. Returns False when `deadline`
+    (time.monotonic()) stopped it.
+    """
+    model = queryset.model
+    bounds = model.objects.aggregate(low=Min('pk'), high=Max('pk'))
+    if bounds['low'] is None:
+        return True
+    high = bounds['high'] if high is None else min(high, bounds['high'])
+    start = bounds['low']
+    while start <= high:
+        if deadline is not None and time.monotonic() >= deadline:
+            return False
+        window = queryset.filter(pk__gte=start, pk__lt=start + batch_size)
+        with transaction.atomic():
+            ids = list(window.values_list('pk', flat=True))
+            if ids:
+                if on_window is not None:
+                    on_window(ids)
+                if archive is not None:
+                    archive.write(model, model.objects.filter(pk__in=ids).values())
+                # The policy again, against rows changed since they were read
+                deleted, by_model = window.filter(pk__in=ids).delete()
+                stats.deleted.update(by_model)
+        start += batch_size
+        if ids and pause:
+            time.sleep(pause)
+    return True
+
+
+def compact_products(now, batch_size, stats, archive=None, deadline=None, pause=0):
+    touched = set()
+
+    def on_window(ids):
+        touched.update(Product.objects.filter(pk__in=ids).values_list('search_query_id', flat=True).distinct())
+        if archive is not None:
+            # Deleted with the products (cascade)
+            archive.write(PriceHistory, PriceHistory.objects.filter(product_id__in=ids).values())
+
+    finished = compact(expired_products(now), batch_size, stats, archive, deadline, pause, on_window=on_window)
+    for search_query_id in touched:
+        drop_empty_pages(search_query_id)
+    if touched:
+        # Moves the export ETag of these terms, their rows changed
+        SearchQuery.objects.filter(pk__in=touched).update(last_updated=timezone.now())
+    return finished
+
+
+def drop_empty_pages(search_query_id):
+    """
+    After products of a term were deleted: lower its max_page_scraped to the
+    last page that still has rows, and drop the STORED claims of the pages
+    left without rows, so those pages are scraped again instead of being
+    served (or reused by a scrape) as stored.
+    """
+    with transaction.atomic():
+        pages = set(Product.objects.filter(search_query_id=search_query_id).values_list('page', flat=True).distinct())
+        max_page = max(pages, default=0)
+        lowered = SearchQuery.objects.filter(pk=search_query_id, max_page_scraped__gt=max_page).update(
+            max_page_scraped=max_page)
+        if lowered:
+            shrink_refresh_units(search_query_id, max_page)
+        PageClaim.objects.filter(search_query_id=search_query_id, status=PageClaim.STATUS_STORED).exclude(
+            page__in=pages).delete()
+
+
+def compact_price_history(now, batch_size, stats, archive=None, deadline=None, pause=0):
+    cutoff = retention_cutoff(settings.PRICE_HISTORY_RETENTION_DAYS, now)
+    if price_history_partitioned():
+        stats.partitions_created += ensure_partitions(now)
+        if cutoff is not None:
+            stats.partitions_dropped += drop_expired_partitions(cutoff, stats, archive)
+    if cutoff is None:
+        return True
+    # Rows are appended as prices change, so the expired ones have the lowest ids:
+    # the sweep stops at the first row kept instead of reading the whole table
+    # (a row written out of order waits until the rows before it expire)
+    first_kept = PriceHistory.objects.filter(changed_at__gte=cutoff).order_by('pk').values_list('pk', flat=True).first()
+    high = first_kept - 1 if first_kept is not None else None
+    return compact(expired_price_history(now), batch_size, stats, archive, deadline, pause, high=high)
+
+
+def run_compaction(batch_size=None, deadline=None, archive_dir=None, pause=0, log=logger.info):
+    """Apply the retention policy to every table. Returns a CompactionStats."""
+    batch_size = batch_size or settings.COMPACTION_BATCH_SIZE
+    now = timezone.now()
+    stats = CompactionStats()
+    archive = Archive(archive_dir, now) if archive_dir else None
+    steps = (
+        ('products', lambda: compact_products(now, batch_size, stats, archive, deadline, pause)),
+        ('price history', lambda: compact_price_history(now, batch_size, stats, archive, deadline, pause)),
+        ('scrape jobs', lambda: compact(expired_jobs(now), batch_size, stats, archive, deadline, pause)),
+    )
+    try:
+        for name, step in steps:
+            log(f"Compacting {name}...")
+            if not step():
+                log(f"Stopped in {name}: out of time. The next run continues from there.")
+                stats.finished = False
+                break
+    finally:
+        if archive is not None:
+            archive.close()
+    return stats
+
+
+def expired_counts(now=None):
+    """Rows the policy would delete now, by model label (dry run; counts read whole tables)."""
+    now = now or timezone.now()
+    return {
+        queryset.model._meta.label: queryset.count()
+        for queryset in (expired_products(now), expired_price_history(now), expired_jobs(now))
+    }
+
+
+# --- Postgres partitioning of PriceHistory ---
+
+def month_start(moment):
+    moment = moment.astimezone(dt_timezone.utc)
+    return datetime(moment.year, moment.month, 1, tzinfo=dt_timezone.utc)
+
+
+def next_month(start):
+    return datetime(start.year + start.month // 12, start.month % 12 + 1, 1, tzinfo=dt_timezone.utc)
+
+
+def partition_name(start):
+    return f'{PARTITIONED_TABLE}_p{start:%Y_%m}'
+
+
+def timestamp_literal(moment):
+    # Partition bounds take no query parameters; these only ever come from month_start()
+    return f"'{moment.isoformat()}'::timestamptz"
+
+
+def price_history_partitioned():
+    if connection.vendor != 'postgresql':
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT 1 FROM pg_partitioned_table WHERE partrelid = %s::regclass', [PARTITIONED_TABLE])
+        return cursor.fetchone() is not None
+
+
+def month_partitions():
+    """{month start: partition name} of the monthly partitions of PriceHistory."""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT child.relname FROM pg_inherits JOIN pg_class child ON child.oid = pg_inherits.inhrelid '
+            'WHERE pg_inherits.inhparent = %s::regclass', [PARTITIONED_TABLE],
+        )
+        names = [name for (name,) in cursor.fetchall()]
+    partitions = {}
+    for name in names:
+        match = _MONTH_PARTITION.match(name)
+        if match:
+            partitions[datetime(int(match.group(1)), int(match.group(2)), 1, tzinfo=dt_timezone.utc)] = name
+    return partitions
+
+
+def create_month_partition(cursor, start):
+    """
+    Add the partition of the month starting at `start`. Rows that went to the
+    default partition meanwhile (compaction did not run for months) are moved in.
+    """
+    quote = connection.ops.quote_name
+    name, end = partition_name(start), next_month(start)
+    cursor.execute(f'CREATE TABLE {quote(name)} (LIKE {quote(PARTITIONED_TABLE)} INCLUDING DEFAULTS)')
+    cursor.execute(f"""
+        WITH moved AS (
+            DELETE FROM {quote(DEFAULT_PARTITION)} WHERE changed_at >= %s AND changed_at < %s RETURNING *
+        )
+        INSERT INTO {quote(name)} SELECT * FROM moved
+    """, [start, end])
+    cursor.execute(
+        f'ALTER TABLE {quote(PARTITIONED_TABLE)} ATTACH PARTITION {quote(name)} '
+        f'FOR VALUES FROM ({timestamp_literal(start)}) TO ({timestamp_literal(end)})'
+    )
+
+
+def ensure_partitions(now):
+    """Create the partitions of this month and the next PARTITIONS_AHEAD ones. Returns how many were created."""
+    existing = month_partitions()
+    created = 0
+    start = month_start(now)
+    for _ in range(PARTITIONS_AHEAD + 1):
+        if start not in existing:
+            with transaction.atomic(), connection.cursor() as cursor:
+                create_month_partition(cursor, start)
+            created += 1
+        start = next_month(start)
+    return created
+
+
+def drop_expired_partitions(cutoff, stats, archive=None):
+    """Drop the monthly partitions ending at or before `cutoff`, archiving their rows first. Returns how many."""
+    quote = connection.ops.quote_name
+    dropped = 0
+    for start, name in sorted(month_partitions().items()):
+        if next_month(start) > cutoff:
+            break
+        with transaction.atomic():
+            rows = PriceHistory.objects.filter(changed_at__gte=start, changed_at__lt=next_month(start))
+            if archive is not None:
+                archive.write(PriceHistory, rows.values().iterator(chunk_size=settings.COMPACTION_BATCH_SIZE))
+            count = rows.count()
+            with connection.cursor() as cursor:
+                cursor.execute(f'DROP TABLE {quote(name)}')
+        stats.deleted[PriceHistory._meta.label] += count
+        dropped += 1
+    return dropped
+
@@ -0,0 +1,164 @@
+"""
+Search terms and full-text search over the stored products.
+
+Search terms are stored in a normal form (normalize_search_term()), so
+'iPhone  13', 'iphone 13' and 'IPHONE 13' share one SearchQuery and its
+stored pages instead of starting a scrape each.
+
+Product titles have a full-text index (migration 0012): a GIN-indexed
+generated tsvector column on Postgres, an FTS5 table kept in sync by
+triggers on SQLite. search_products() ranks the products of every stored
+term against a free-text query, so close variants of a stored term
+('iphone 13 128gb' after 'iphone 13') are answered from the local corpus.
+Words are ORed and the rank favours titles matching more of them. Other
+databases, and SQLite builds without FTS5, fall back to LIKE matching.
+"""
+import re
+import unicodedata
+
+from django.db import connection
+from django.db.models import Case, IntegerField, Q, Value, When
+
+from .metrics import SEARCH_SECONDS
+from .models import Product
+
+# Stored tsvector of the title on Postgres, with a GIN index (migration 0012)
+PG_DOCUMENT = 'p.title_search'
+
+SQLITE_FTS_TABLE = 'api_product_fts'
+
+_WHITESPACE = re.compile(r'\s+')
+_WORD = re.compile(r'\w+')
+_TILDE = '\u0303' # Combining tilde, of ñ once decomposed
+
+_backends = {} # database alias -> search_backend()
+
+
+def normalize_search_term(term):
+    """
+    Normal form of a search term: case folded, accents removed (but not the
+    tilde of ñ) and whitespace collapsed. MercadoLibre search ignores all of
+    these, so the normal form finds the same listings.
+    """
+    kept = []
+    for char in unicodedata.normalize('NFD', term.casefold()):
+        if unicodedata.combining(char) and not (char == _TILDE and kept and kept[-1] == 'n'):
+            continue
+        kept.append(char)
+    return _WHITESPACE.sub(' ', unicodedata.normalize('NFC', ''.join(kept))).strip()
+
+
+def query_words(query):
+    """Words of a free-text query, normalized like search terms; punctuation and FTS operators are dropped."""
+    return _WORD.findall(normalize_search_term(query))
+
+
+def _detect_backend():
+    if connection.vendor == 'postgresql':
+        return 'postgresql'
+    if connection.vendor == 'sqlite' and SQLITE_FTS_TABLE in connection.introspection.table_names():
+        return 'fts5'
+    return 'like'
+
+
+def search_backend():
+    """
+    'postgresql', 'fts5' or 'like': how the default database answers
+    searches. Looked up once per database alias and process, since listing
+    the tables costs a query.
+    """
+    backend = _backends.get(connection.alias)
+    if backend is None:
+        backend = _backends[connection.alias] = _detect_backend()
+    return backend
+
+
+def price_conditions(min_price, max_price):
+    """SQL conditions and parameters of the price bounds (minor units, None for no bound)."""
+    conditions, params = [], []
+    if min_price is not None:
+        conditions.append('p.price_amount >= %s')
+        params.append(min_price)
+    if max_price is not None:
+        conditions.append('p.price_amount <= %s')
+        params.append(max_price)
+    return ''.join(f' AND {condition}' for condition in conditions), params
+
+
+def postgres_ranked_ids(words, limit, offset, min_price, max_price):
+    where, params = price_conditions(min_price, max_price)
+    # plainto_tsquery ANDs the words; ORing them lets partial matches through, ranked lower
+    sql = f"""
+        WITH q AS (SELECT replace(plainto_tsquery('spanish', %s)::text, '&', '|')::tsquery AS query)
+        SELECT p.id, ts_rank({PG_DOCUMENT}, q.query) AS rank
+        FROM api_product p, q
+        WHERE {PG_DOCUMENT} @@ q.query{where}
+        ORDER BY rank DESC, p.id
+        LIMIT %s OFFSET %s
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [' '.join(words), *params, limit, offset])
+        return cursor.fetchall()
+
+
+def sqlite_ranked_ids(words, limit, offset, min_price, max_price):
+    where, params = price_conditions(min_price, max_price)
+    # Quoted words are plain tokens to FTS5, never operators; bm25() is lower for better matches
+    match = ' OR '.join(f'"{word}"' for word in words)
+    sql = f"""
+        SELECT p.id, -bm25({SQLITE_FTS_TABLE}) AS rank
+        FROM {SQLITE_FTS_TABLE} JOIN api_product p ON p.id = {SQLITE_FTS_TABLE}.rowid
+        WHERE {SQLITE_FTS_TABLE} MATCH %s{where}
+        ORDER BY rank DESC, p.id
+        LIMIT %s OFFSET %s
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [match, *params, limit, offset])
+        return cursor.fetchall()
+
+
+def like_ranked_ids(words, limit, offset, min_price, max_price):
+    """Fallback without a full-text index: titles containing any word, ranked by the number of words found."""
+    matches = Q()
+    for word in words:
+        matches |= Q(title__icontains=word)
+    products = Product.objects.filter(matches)
+    if min_price is not None:
+        products = products.filter(price_amount__gte=min_price)
+    if max_price is not None:
+        products = products.filter(price_amount__lte=max_price)
+    rank = sum(
+        (Case(When(title__icontains=word, then=Value(1)), default=Value(0), output_field=IntegerField()) for word in words),
+        Value(0),
+    )
+    rows = products.annotate(rank=rank).order_by('-rank', 'id').values_list('id', 'rank')
+    return list(rows[offset:offset + limit])
+
+
+RANKED_IDS = {
+    'postgresql': postgres_ranked_ids,
+    'fts5': sqlite_ranked_ids,
+    'like': like_ranked_ids,
+}
+
+
+def search_products(query, limit=50, offset=0, min_price=None, max_price=None):
+    """
+    Stored products whose title matches `query`, most relevant first, with
+    `rank` set on each (higher is better; the scale depends on the backend)
+    and their search_query loaded. Prices are in minor units.
+    """
+    words = query_words(query)
+    if not words:
+        return []
+    backend = search_backend()
+    with SEARCH_SECONDS.labels(backend).time():
+        ranked = RANKED_IDS[backend](words, limit, offset, min_price, max_price)
+        products = Product.objects.select_related('search_query').in_bulk([pk for pk, _ in ranked])
+    results = []
+    for pk, rank in ranked:
+        product = products.get(pk)
+        if product is not None: # Deleted in between
+            product.rank = float(rank)
+            results.append(product)
+    return results
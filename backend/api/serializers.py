@@ -1,11 +1,24 @@
+from django.urls import reverse
 from rest_framework import serializers
-from .models import Product, SearchQuery
+from .models import Product, ScrapeJob, SearchQuery
 
 class ProductSerializer(serializers.ModelSerializer):
     class Meta:
         model = Product
         # Exclude fields managed internally or less relevant for direct API output
-        exclude = ('search_query', 'scraped_at')
+        exclude = ('search_query', 'scraped_at', 'dedup_key', 'content_hash')
+
+    def __init__(self, *args, fields=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if fields is not None:
+            # Only the requested fields (the product API's 'fields' parameter)
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+
+class ProductSearchSerializer(ProductSerializer):
+    # Products of every stored term match a search: each says which term it was scraped for
+    search_term = serializers.CharField(source='search_query.search_term', read_only=True)
+    rank = serializers.FloatField(read_only=True)
 
 class SearchQuerySerializer(serializers.ModelSerializer):
     # Optionally nest products if needed, but for the CSV export, we might handle it differently.
@@ -13,4 +26,32 @@ class SearchQuerySerializer(serializers.ModelSerializer):
 
     class Meta:
         model = SearchQuery
-        fields = ('id', 'search_term', 'max_page_scraped', 'last_updated')
\ No newline at end of file
+        fields = ('id', 'search_term', 'max_page_scraped', 'last_updated')
+
+class ScrapeJobSerializer(serializers.ModelSerializer):
+    search_term = serializers.CharField(source='search_query.search_term', read_only=True)
+    max_page_scraped = serializers.IntegerField(source='search_query.max_page_scraped', read_only=True)
+    status_url = serializers.SerializerMethodField()
+    download_url = serializers.SerializerMethodField()
+
+    class Meta:
+        model = ScrapeJob
+        fields = (
+            'id', 'search_term', 'pages_required', 'status', 'pages_done', 'pages_total',
+            'max_page_scraped', 'error', 'created_at', 'started_at', 'finished_at',
+            'status_url', 'download_url',
+        )
+
+    def _absolute_url(self, url_name, obj):
+        url = reverse(url_name, args=[obj.pk])
+        request = self.context.get('request')
+        return request.build_absolute_uri(url) if request else url
+
+    def get_status_url(self, obj):
+        return self._absolute_url('scrape-job-status', obj)
+
+    def get_download_url(self, obj):
+        # The CSV can only be downloaded once the job has finished
+        if obj.status != ScrapeJob.STATUS_DONE:
+            return None
+        return self._absolute_url('scrape-job-download', obj)
@@ -1,3 +1,1462 @@
-from django.test import TestCase
+import asyncio
+import base64
+import csv
+import gzip
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from decimal import Decimal
+from pathlib import Path
+from unittest import mock, skipUnless
+from urllib.parse import urlencode
 
-# Create your tests here.
+from django.core.management import call_command
+from django.db import IntegrityError, connection, transaction
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from .claims import claim_pages, finish_claim, wait_for_claims
+from .ingest import (
+    SEEN_AT_INTERVAL, dedup_key, item_identity, record_result_count, scrape_missing_pages,
+    store_page as store_listing_page, upsert_page,
+)
+from .jobs import claim_next_job, run_job
+from .exports import EXPORT_FIELDS, pa, pq
+from .fetching import SCRAPING_DIR, fetch_pages, fetch_pages_async, fetch_units # Also puts scraping/ on sys.path
+from .models import PageClaim, PriceHistory, Product, RefreshLease, ScrapeJob, SearchQuery
+from .normalize import MINOR_UNITS, parse_price, parse_reviews, parse_seller
+from .pagination import KeysetPagination
+from .progressive import PageProgress
+from .refresh import claim_refresh_units, complete_unit, heartbeat, run_refresh, sync_refresh_units
+from .retention import (
+    CompactionStats, compact_price_history, month_partitions, price_history_partitioned, run_compaction,
+)
+from .search import normalize_search_term, query_words
+import fetcher
+import page_cache
+import requests
+import scraper
+from fetcher import Fetcher, FileTokenBucket, TokenBucket
+from page_cache import PageCache
+from parsers import LxmlParser, SoupParser, available_parsers, get_parser
+from scraper import ListingItem, ListingItems, RESULTS_PER_PAGE
+from standin_server import StandinOptions, make_server
+
+FIXTURES_DIR = SCRAPING_DIR / 'fixtures'
+
+# Exports are cached in memory, not in the EXPORT_CACHE_DIR of the running site
+TEST_CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'tests-default'},
+    'exports': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'tests-exports'},
+}
+
+
+def listing_items(page, count=3, total_pages=None):
+    """ListingItems of a listing page, as scraper.fetch_listing_items() returns them."""
+    items = [
+        ListingItem(f'MCO{page}{n:02d}', f'Item {n} of page {page}', '$ 1.000', 'Por Tienda', '4.5 (10)',
+                    f'https://http2.mlstatic.com/{page}-{n}.webp')
+        for n in range(count)
+    ]
+    total_results = None if total_pages is None else total_pages * RESULTS_PER_PAGE
+    return ListingItems(items, total_results=total_results, total_pages=total_pages)
+
+
+class FakeListing:
+    """
+    Stand-in for scraper.fetch_listing_items() and its async twin: a term
+    with `pages` pages of results. Pages in `failing` raise, pages take
+    `delays[page]` seconds. Records the calls and how many ran at once.
+    """
+
+    def __init__(self, pages=10, failing=(), delays=None):
+        self.pages = pages
+        self.failing = set(failing)
+        self.delays = delays or {}
+        self.calls = []
+        self.running = 0
+        self.max_running = 0
+        self.lock = threading.Lock()
+
+    def start(self, search_param, page):
+        with self.lock:
+            self.calls.append((search_param, page))
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+
+    def result(self, page):
+        with self.lock:
+            self.running -= 1
+        if page in self.failing:
+            raise ConnectionError(f"page {page} failed")
+        if page > self.pages:
+            return listing_items(page, count=0, total_pages=self.pages)
+        return listing_items(page, total_pages=self.pages)
+
+    def __call__(self, search_param, page=1, use_cache=True):
+        self.start(search_param, page)
+        time.sleep(self.delays.get(page, 0))
+        return self.result(page)
+
+    async def fetch_async(self, search_param, page=1, use_cache=True):
+        self.start(search_param, page)
+        await asyncio.sleep(self.delays.get(page, 0))
+        return self.result(page)
+
+    def patch(self):
+        """Patches both fetch functions as the backend sees them (api.fetching)."""
+        sync = mock.patch('api.fetching.fetch_listing_items', self)
+        coroutine = mock.patch('api.fetching.fetch_listing_items_async', self.fetch_async)
+        return sync, coroutine
+
+
+class FakeListingMixin:
+    """setUp() helper: `self.listing` answers every page fetch of the test."""
+
+    def use_listing(self, listing):
+        for patcher in listing.patch():
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.listing = listing
+        return listing
+
+
+def make_product(search_query, page, item_id, **fields):
+    """A stored product of `search_query`, keyed by `item_id`."""
+    fields.setdefault('title', f'Item {item_id}')
+    fields.setdefault('price', '$ 1.000')
+    return Product.objects.create(search_query=search_query, page=page, item_id=item_id, dedup_key=dedup_key(item_id),
+                                  **fields)
+
+
+def store_page(search_query, page, updated_at):
+    PageClaim.objects.create(
+        search_query=search_query, page=page, status=PageClaim.STATUS_STORED, owner='test', expires_at=updated_at,
+    )
+    # updated_at is auto_now
+    PageClaim.objects.filter(search_query=search_query, page=page).update(updated_at=updated_at)
+
+
+class StandinServerMixin:
+    """
+    Runs scraping/standin_server.py for the tests of the class, with
+    `standin_options`, and points the scraper at it (scraper.BASE_URL).
+    """
+    standin_options = None
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.standin = make_server(cls.standin_options or StandinOptions())
+        threading.Thread(target=cls.standin.serve_forever, name='standin', daemon=True).start()
+        cls.addClassCleanup(cls.standin.server_close)
+        cls.addClassCleanup(cls.standin.shutdown)
+        host, port = cls.standin.server_address[:2]
+        cls.standin_url = f'http://{host}:{port}/'
+        patcher = mock.patch.object(scraper, 'BASE_URL', cls.standin_url)
+        patcher.start()
+        cls.addClassCleanup(patcher.stop)
+
+    def standin_stats(self):
+        return requests.get(f'{self.standin_url}_stats', timeout=5).json()
+
+
+def csv_rows(response):
+    """Rows of a CSV export, streamed or not, as dicts."""
+    content = b''.join(response.streaming_content) if response.streaming else response.content
+    return list(csv.DictReader(io.StringIO(content.decode('utf-8'))))
+
+
+# --- Fetching ---
+
+class FetchEngineTests(FakeListingMixin, SimpleTestCase):
+    """fetch_units() and fetch_pages(): concurrent, bounded, and stopping at the end of a term."""
+
+    def test_pages_yielded_as_they_complete(self):
+        self.use_listing(FakeListing(delays={1: 0.3}))
+        pages = [page_num for page_num, items in fetch_pages('iphone', [1, 2, 3], max_workers=3)]
+        self.assertEqual(sorted(pages), [1, 2, 3])
+        self.assertEqual(pages[-1], 1) # The slow first page does not hold back the others
+
+    def test_at_most_max_workers_in_flight(self):
+        listing = self.use_listing(FakeListing(delays={page: 0.05 for page in range(1, 7)}))
+        results = list(fetch_pages('iphone', range(1, 7), max_workers=2))
+        self.assertEqual(len(results), 6)
+        self.assertEqual(listing.max_running, 2)
+
+    def test_failed_page_stops_its_term_only(self):
+        listing = self.use_listing(FakeListing(failing={2}))
+        units = [('iphone', 1), ('iphone', 2), ('iphone', 3), ('iphone', 4), ('xiaomi', 1), ('xiaomi', 3)]
+        results = {(term, page): items for term, page, items in fetch_units(units, max_workers=1)}
+
+        self.assertEqual(len(results[('iphone', 1)]), 3)
+        self.assertEqual(results[('iphone', 2)], []) # The error is logged, not raised
+        self.assertIsNone(results[('iphone', 3)])
+        self.assertIsNone(results[('iphone', 4)])
+        self.assertEqual(len(results[('xiaomi', 3)]), 3)
+        self.assertNotIn(('iphone', 3), listing.calls)
+
+    def test_pages_past_the_last_page_are_not_fetched(self):
+        listing = self.use_listing(FakeListing(pages=2))
+        pages = [page_num for page_num, items in fetch_pages('iphone', range(1, 6), max_workers=1)]
+        self.assertEqual(pages, [1, 2])
+        self.assertEqual(listing.calls, [('iphone', 1), ('iphone', 2)])
+
+    def test_async_engine(self):
+        listing = self.use_listing(FakeListing(failing={3}, delays={1: 0.1}))
+
+        async def collect():
+            return [(page_num, items) async for page_num, items in fetch_pages_async('iphone', range(1, 6), max_workers=2)]
+
+        results = asyncio.run(collect())
+        self.assertEqual(results[0][0], 2)
+        self.assertEqual(dict(results)[3], [])
+        self.assertEqual(sorted(dict(results)), [1, 2, 3])
+        self.assertLessEqual(listing.max_running, 2)
+
+
+@override_settings(CACHES=TEST_CACHES, SCRAPE_JOBS_ASYNC=False)
+class ProductDataViewTests(FakeListingMixin, TestCase):
+    """GET /api/products scrapes the missing pages concurrently and exports them in page order."""
+
+    def get_products(self, **params):
+        return self.client.get(reverse('product-data'), {'search_term': 'iphone', **params})
+
+    def test_pages_exported_in_page_order(self):
+        self.use_listing(FakeListing(delays={1: 0.2}))
+        response = self.get_products(pages_required=3)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([int(row['page']) for row in csv_rows(response)], [1, 1, 1, 2, 2, 2, 3, 3, 3])
+        self.assertEqual(SearchQuery.objects.get(search_term='iphone').max_page_scraped, 3)
+
+    def test_stored_pages_are_not_fetched_again(self):
+        listing = self.use_listing(FakeListing())
+        self.get_products(pages_required=2)
+        self.get_products(pages_required=3)
+        self.assertEqual(sorted(listing.calls), [('iphone', 1), ('iphone', 2), ('iphone', 3)])
+
+    def test_failed_page_is_not_reported_as_scraped(self):
+        self.use_listing(FakeListing(failing={2}))
+        response = self.get_products(pages_required=3)
+        self.assertEqual([int(row['page']) for row in csv_rows(response)], [1, 1, 1])
+        self.assertEqual(SearchQuery.objects.get(search_term='iphone').max_page_scraped, 1)
+
+    def test_parameters_are_required(self):
+        self.assertEqual(self.get_products().status_code, 400)
+        self.assertEqual(self.get_products(pages_required=0).status_code, 400)
+
+
+# --- Rate limiting ---
+
+class FakeClock:
+    """Stands in for the time module of fetcher.py: sleep() moves the clock instead of waiting."""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = 0.0
+
+    def monotonic(self):
+        return self.now
+
+    perf_counter = time = monotonic
+
+    def sleep(self, seconds):
+        self.now += seconds
+        self.slept += seconds
+
+
+class TokenBucketTests(SimpleTestCase):
+    """Requests are allowed in bursts of `capacity`, then at `rate` per second."""
+
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = mock.patch.object(fetcher, 'time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_burst_then_rate(self):
+        bucket = TokenBucket(rate=2, capacity=3)
+        for _ in range(3):
+            bucket.acquire()
+        self.assertEqual(self.clock.slept, 0)
+        for _ in range(4):
+            bucket.acquire()
+        self.assertAlmostEqual(self.clock.slept, 2.0) # 4 more requests at 2 per second
+
+    def test_tokens_refill_up_to_capacity(self):
+        bucket = TokenBucket(rate=1, capacity=2)
+        bucket.acquire()
+        bucket.acquire()
+        self.clock.now += 3600 # Idle for an hour: still only a burst of 2
+        for _ in range(3):
+            bucket.acquire()
+        self.assertAlmostEqual(self.clock.slept, 1.0)
+
+    def test_async_acquire_waits_on_the_loop(self):
+        bucket = TokenBucket(rate=4, capacity=1)
+        waits = []
+
+        async def sleep(seconds):
+            waits.append(seconds)
+            self.clock.now += seconds
+
+        async def acquire_three():
+            with mock.patch('asyncio.sleep', sleep):
+                for _ in range(3):
+                    await bucket.acquire_async()
+
+        asyncio.run(acquire_three())
+        self.assertAlmostEqual(sum(waits), 0.5)
+        self.assertEqual(self.clock.slept, 0) # The thread never slept
+
+    def test_file_bucket_is_shared(self):
+        # Two processes are two buckets on the same file
+        with tempfile.TemporaryDirectory() as directory:
+            path = f'{directory}/rate'
+            first, second = FileTokenBucket(path, rate=1, capacity=2), FileTokenBucket(path, rate=1, capacity=2)
+            self.assertEqual(first._take(), 0)
+            self.assertEqual(second._take(), 0)
+            self.assertAlmostEqual(first._take(), 1.0, places=2)
+            self.assertAlmostEqual(second._take(), 1.0, places=2)
+
+
+class CountingBucket(TokenBucket):
+    def __init__(self):
+        super().__init__(rate=1000, capacity=1000)
+        self.acquired = 0
+
+    def acquire(self):
+        self.acquired += 1
+        super().acquire()
+
+
+class FetcherTests(StandinServerMixin, SimpleTestCase):
+    """Fetcher sends every request through its limiter and raises on HTTP errors."""
+    standin_options = StandinOptions(pages=2)
+
+    def test_every_request_takes_a_token(self):
+        limiter = CountingBucket()
+        client = Fetcher(limiter)
+        for page in (1, 2, 3):
+            self.assertEqual(client.get(scraper.listing_url('iphone', page)).status_code, 200)
+        self.assertEqual(limiter.acquired, 3)
+        self.assertEqual(self.standin_stats()['200'], 3)
+
+    def test_http_errors_raise(self):
+        client = Fetcher(CountingBucket())
+        with self.assertRaises(requests.HTTPError):
+            client.get(f'{self.standin_url}not-a-listing')
+
+    def test_listing_items_through_the_fetcher(self):
+        limiter = CountingBucket()
+        with (
+            mock.patch.object(scraper, 'get_default_fetcher', return_value=Fetcher(limiter)),
+            mock.patch.object(scraper, 'get_default_cache', return_value=None), # Nothing written to the page cache
+        ):
+            items = scraper.fetch_listing_items('iphone', 2)
+        self.assertTrue(items)
+        self.assertEqual(items.total_pages, 2)
+        self.assertEqual(limiter.acquired, 1)
+
+
+# --- Parsing ---
+
+class ParserEquivalenceTests(SimpleTestCase):
+    """The lxml parser must give the same items as BeautifulSoup on the saved listing pages."""
+
+    def test_fixture_pages(self):
+        # lxml is in the Pipfile: a missing install is a broken environment, not a reason to skip
+        self.assertIn(LxmlParser.name, available_parsers(), "lxml is not installed (pipenv install)")
+        fixtures = sorted(FIXTURES_DIR.glob('*.html'))
+        self.assertTrue(fixtures, f"No fixture pages in {FIXTURES_DIR}")
+        reference = SoupParser()
+        for path in fixtures:
+            html = path.read_text(encoding='utf-8')
+            with self.subTest(page=path.name):
+                self.assertEqual(get_parser(LxmlParser.name).parse(html), reference.parse(html))
+
+
+# --- Raw page cache ---
+
+class PageCacheTests(SimpleTestCase):
+    """PageCache serves fresh pages, keeps stale ones for re-parsing, and evicts the least recently used."""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = Path(directory.name)
+        self.cache = PageCache(self.directory, ttl=60)
+
+    def entry(self, search_term, offset):
+        return next(self.directory.glob(f'*/{PageCache.key(search_term, offset)}.html.*'))
+
+    def test_round_trip(self):
+        self.cache.put('iphone', 49, '<html>página 2</html>', url='https://example.com/iphone_Desde_49')
+        self.assertEqual(self.cache.get('iphone', 49), '<html>página 2</html>')
+        self.assertIsNone(self.cache.get('iphone', 1))
+        self.assertLess(self.entry('iphone', 49).stat().st_size, 200)
+
+    def test_stale_pages_are_only_served_for_reparsing(self):
+        self.cache.put('iphone', 1, '<html></html>')
+        with mock.patch.object(page_cache.time, 'time', return_value=time.time() + 61):
+            self.assertIsNone(self.cache.get('iphone', 1))
+            self.assertEqual(self.cache.get('iphone', 1, allow_stale=True), '<html></html>')
+
+    def test_least_recently_used_entries_are_evicted(self):
+        pages = {offset: os.urandom(2000).hex() for offset in (1, 49, 97, 145)} # Incompressible, the same size
+        self.cache.put('iphone', 1, pages[1])
+        entry_size = self.entry('iphone', 1).stat().st_size
+        self.cache.max_bytes = int(entry_size * 3.5)
+        self.cache.put('iphone', 49, pages[49])
+        self.cache.put('iphone', 97, pages[97])
+        for age, offset in enumerate((1, 49, 97)):
+            os.utime(self.entry('iphone', offset), (1000 + age, 1000 + age))
+        self.cache.get('iphone', 1) # Now the most recently used
+
+        self.cache.put('iphone', 145, pages[145])
+
+        self.assertIsNone(self.cache.get('iphone', 49))
+        for offset in (1, 97, 145):
+            self.assertEqual(self.cache.get('iphone', offset), pages[offset])
+
+    def test_unreadable_entries_are_discarded(self):
+        self.cache.put('iphone', 1, '<html></html>')
+        self.entry('iphone', 1).write_bytes(b'not compressed')
+        with self.assertLogs('page_cache', 'WARNING'):
+            self.assertIsNone(self.cache.get('iphone', 1))
+        self.assertEqual(list(self.directory.glob('*/*.html.*')), [])
+
+
+class ScraperPageCacheTests(StandinServerMixin, SimpleTestCase):
+    """A cached page is not fetched again while it is fresh."""
+
+    def test_fetch_reads_the_cache(self):
+        with tempfile.TemporaryDirectory() as directory, mock.patch.object(
+            scraper, 'get_default_cache', return_value=PageCache(directory, ttl=60),
+        ):
+            first = scraper.fetch_listing_items('iphone', 1)
+            self.assertEqual(scraper.fetch_listing_items('iphone', 1), first)
+            self.assertEqual(self.standin_stats()['200'], 1)
+            scraper.fetch_listing_items('iphone', 1, use_cache=False)
+            self.assertEqual(self.standin_stats()['200'], 2)
+            self.assertEqual(scraper.parse_cached_listing('iphone', 1), first)
+            self.assertIsNone(scraper.parse_cached_listing('iphone', 2)) # Never fetched: no network access
+
+
+class ReparseProductsTests(TestCase):
+    """reparse_products rebuilds stored rows from the cached pages, in place."""
+
+    def setUp(self):
+        self.search_query = SearchQuery.objects.create(search_term='iphone', max_page_scraped=2)
+        for page in (1, 2):
+            store_listing_page(self.search_query, page, listing_items(page))
+        self.search_query.refresh_from_db()
+
+    def test_reparse(self):
+        reparsed = listing_items(1)
+        reparsed[0].title = 'Fixed title'
+        del reparsed[2]
+        cached = {1: reparsed} # Page 2 is not in the cache
+
+        with mock.patch('api.management.commands.reparse_products.parse_cached_listing',
+                        side_effect=lambda search_term, page: cached.get(page)):
+            call_command('reparse_products', 'iPhone', stdout=io.StringIO())
+
+        products = Product.objects.filter(search_query=self.search_query)
+        self.assertEqual(products.get(item_id='MCO100').title, 'Fixed title')
+        self.assertFalse(products.filter(item_id='MCO102').exists()) # No longer produced by the parser
+        self.assertEqual(products.filter(page=2).count(), 3) # Kept, its page could not be re-parsed
+        last_updated = self.search_query.last_updated
+        self.search_query.refresh_from_db()
+        self.assertGreater(self.search_query.last_updated, last_updated)
+
+
+# --- Scrape jobs ---
+
+@override_settings(CACHES=TEST_CACHES, SCRAPE_JOBS_ASYNC=False)
+class ScrapeJobTests(FakeListingMixin, TestCase):
+    """async=true queues missing pages as a job: 202, then the status URL is polled until the export is ready."""
+
+    def setUp(self):
+        self.use_listing(FakeListing(pages=10))
+
+    def queue(self, pages_required=3):
+        return self.client.get(reverse('product-data'), {'search_term': 'iphone', 'pages_required': pages_required,
+                                                         'async': 'true'})
+
+    def test_missing_pages_are_queued(self):
+        response = self.queue()
+        self.assertEqual(response.status_code, 202)
+        job = response.json()
+        self.assertEqual((job['status'], job['pages_required'], job['download_url']), ('pending', 3, None))
+        self.assertEqual(self.listing.calls, []) # Nothing fetched inside the request
+        # A job covering the pages is reused
+        self.assertEqual(self.queue(pages_required=2).json()['id'], job['id'])
+        self.assertNotEqual(self.queue(pages_required=4).json()['id'], job['id'])
+
+    def test_job_progress_and_download(self):
+        job = self.queue().json()
+        self.assertEqual(self.client.get(job['status_url']).json()['status'], 'pending')
+        self.assertEqual(self.client.get(reverse('scrape-job-download', args=[job['id']])).status_code, 409)
+
+        claimed = claim_next_job('worker-1')
+        self.assertEqual((claimed.pk, claimed.status, claimed.worker), (job['id'], ScrapeJob.STATUS_RUNNING, 'worker-1'))
+        self.assertIsNone(claim_next_job('worker-2'))
+        self.assertEqual(self.client.get(job['status_url']).json()['status'], 'running')
+
+        finished = run_job(claimed)
+        self.assertEqual((finished.status, finished.pages_done, finished.pages_total), (ScrapeJob.STATUS_DONE, 3, 3))
+        status = self.client.get(job['status_url']).json()
+        self.assertEqual((status['status'], status['max_page_scraped']), ('done', 3))
+        response = self.client.get(status['download_url'])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(csv_rows(response)), 9)
+
+    def test_failed_job(self):
+        self.queue()
+        with (
+            mock.patch('api.jobs.scrape_missing_pages', side_effect=RuntimeError("database went away")),
+            self.assertLogs('api.jobs', 'ERROR'),
+        ):
+            job = run_job(claim_next_job('worker-1'))
+        self.assertEqual((job.status, job.error), (ScrapeJob.STATUS_FAILED, "database went away"))
+        self.assertIsNotNone(job.finished_at)
+
+    @override_settings(SCRAPE_JOB_STALE_AFTER=60)
+    def test_job_of_a_dead_worker_is_taken_over(self):
+        job_id = self.queue().json()['id']
+        claim_next_job('worker-1')
+        self.assertIsNone(claim_next_job('worker-2')) # Its heartbeat is fresh
+        ScrapeJob.objects.filter(pk=job_id).update(heartbeat_at=timezone.now() - timedelta(seconds=120))
+        self.assertEqual(claim_next_job('worker-2').worker, 'worker-2')
+
+    def test_pages_tried_recently_are_not_queued_again(self):
+        self.listing.failing = {3}
+        self.queue()
+        run_job(claim_next_job('worker-1'))
+        # The job could only store 2 pages: the stored ones are exported rather than queuing again
+        response = self.queue()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(csv_rows(response)), 6)
+
+
+# --- Single-flight page claims ---
+
+@override_settings(PAGE_CLAIM_TTL=120, PAGE_CLAIM_REUSE_TTL=900)
+class PageClaimTests(FakeListingMixin, TestCase):
+    """One run fetches a page, concurrent runs wait for it and reuse what it stored."""
+
+    def setUp(self):
+        self.search_query = SearchQuery.objects.create(search_term='iphone')
+
+    def test_claimed_pages_are_waited_for(self):
+        self.assertEqual(claim_pages(self.search_query, [1, 2], 'first'), ([1, 2], {}, []))
+        self.assertEqual(claim_pages(self.search_query, [1, 2, 3], 'second'), ([3], {}, [1, 2]))
+
+    def test_finished_pages_are_reused(self):
+        claim_pages(self.search_query, [1, 2, 3], 'first')
+        finish_claim(self.search_query, 1, 'first', PageClaim.STATUS_STORED)
+        finish_claim(self.search_query, 2, 'first', PageClaim.STATUS_EMPTY)
+        claimed, finished, waiting = claim_pages(self.search_query, [1, 2, 3], 'second')
+        self.assertEqual(finished, {1: PageClaim.STATUS_STORED, 2: PageClaim.STATUS_EMPTY})
+        self.assertEqual((claimed, waiting), ([], [3]))
+
+    def test_failed_abandoned_and_old_claims_are_taken_over(self):
+        claim_pages(self.search_query, [1, 2, 3], 'first')
+        finish_claim(self.search_query, 1, 'first', PageClaim.STATUS_FAILED)
+        claims = PageClaim.objects.filter(search_query=self.search_query)
+        claims.filter(page=2).update(expires_at=timezone.now() - timedelta(seconds=1)) # Its run died
+        claims.filter(page=3).update(status=PageClaim.STATUS_STORED, updated_at=timezone.now() - timedelta(hours=1))
+
+        self.assertEqual(claim_pages(self.search_query, [1, 2, 3], 'second'), ([1, 2, 3], {}, []))
+        self.assertEqual(set(claims.values_list('owner', 'status')), {('second', PageClaim.STATUS_FETCHING)})
+
+    def test_wait_until_the_claims_finish(self):
+        claim_pages(self.search_query, [1, 2], 'first')
+
+        def other_run_finishes(seconds):
+            # The first run stores page 1 while we wait, and gives up on page 2 (its claim expires)
+            finish_claim(self.search_query, 1, 'first', PageClaim.STATUS_STORED)
+            PageClaim.objects.filter(page=2).update(expires_at=timezone.now() - timedelta(seconds=1))
+
+        with mock.patch('api.claims.time') as claims_time:
+            claims_time.sleep.side_effect = other_run_finishes
+            outcomes = list(wait_for_claims(self.search_query, [1, 2]))
+        self.assertEqual(outcomes, [(1, PageClaim.STATUS_STORED), (2, PageClaim.STATUS_FAILED)])
+        self.assertEqual(claims_time.sleep.call_count, 1)
+
+    def test_concurrent_scrape_reuses_the_pages_of_another_run(self):
+        listing = self.use_listing(FakeListing())
+        claim_pages(self.search_query, [1, 2], 'other')
+
+        def other_run_stores(seconds):
+            for page in (1, 2):
+                store_listing_page(self.search_query, page, listing_items(page))
+                finish_claim(self.search_query, page, 'other', PageClaim.STATUS_STORED)
+
+        with mock.patch('api.claims.time') as claims_time:
+            claims_time.sleep.side_effect = other_run_stores
+            max_page = scrape_missing_pages(self.search_query, 3)
+
+        self.assertEqual(max_page, 3)
+        self.assertEqual(listing.calls, [('iphone', 3)]) # Pages 1 and 2 were fetched once, by the other run
+        self.assertEqual(Product.objects.filter(search_query=self.search_query).count(), 9)
+
+
+# --- Export cache and ETags ---
+
+@override_settings(CACHES=TEST_CACHES)
+class ExportCacheTests(TestCase):
+    """Exports carry a strong ETag: 304 while it matches, a cached body until the stored rows change."""
+
+    def setUp(self):
+        self.search_query = SearchQuery.objects.create(search_term='iphone', max_page_scraped=2)
+        for page in (1, 2):
+            store_listing_page(self.search_query, page, listing_items(page))
+
+    def export(self, pages_required=2, **headers):
+        response = self.client.get(reverse('product-data'), {'search_term': 'iphone', 'pages_required': pages_required},
+                                   headers=headers)
+        if response.streaming:
+            response.content_bytes = b''.join(response.streaming_content) # Read to the end: fills the cache
+        else:
+            response.content_bytes = response.content
+        return response
+
+    def test_not_modified(self):
+        etag = self.export()['ETag']
+        for if_none_match in (etag, f'"other", {etag}', '*'):
+            response = self.export(**{'If-None-Match': if_none_match})
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response['ETag'], etag)
+        self.assertEqual(self.export(**{'If-None-Match': '"other"'}).status_code, 200)
+
+    def test_second_download_is_served_from_the_cache(self):
+        first = self.export()
+        self.assertTrue(first.streaming)
+        second = self.export()
+        self.assertFalse(second.streaming)
+        self.assertEqual(second.content_bytes, first.content_bytes)
+        self.assertEqual((second['ETag'], second['Content-Disposition']), (first['ETag'], first['Content-Disposition']))
+
+    def test_etag_changes_with_the_rows(self):
+        etag = self.export()['ETag']
+        self.assertNotEqual(self.export(pages_required=1)['ETag'], etag)
+        self.assertNotEqual(self.export(Accept='application/x-ndjson')['ETag'], etag)
+
+        SearchQuery.objects.filter(pk=self.search_query.pk).update(last_updated=timezone.now()) # A page was stored
+        response = self.export(**{'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    @override_settings(EXPORT_CACHE_MAX_BYTES=100)
+    def test_large_exports_are_not_cached(self):
+        self.export()
+        self.assertTrue(self.export().streaming)
+
+
+@override_settings(CACHES=TEST_CACHES)
+class ExportFormatTests(TestCase):
+    """The export format comes from '?format=', else from the Accept header, else it is CSV."""
+
+    def setUp(self):
+        self.search_query = SearchQuery.objects.create(search_term='iphone', max_page_scraped=2)
+        for page in (1, 2):
+            store_listing_page(self.search_query, page, listing_items(page))
+
+    def export(self, export_format=None, **headers):
+        params = {'search_term': 'iphone', 'pages_required': 2}
+        if export_format is not None:
+            params['format'] = export_format
+        response = self.client.get(reverse('product-data'), params, headers=headers)
+        if response.streaming:
+            response.content_bytes = b''.join(response.streaming_content)
+        else: # Cached by an earlier download
+            response.content_bytes = response.content
+        return response
+
+    def test_csv_by_default(self):
+        for headers in ({}, {'Accept': 'application/json'}, {'Accept': '*/*'}):
+            response = self.export(**headers)
+            self.assertEqual(response['Content-Type'], 'text/csv')
+            self.assertTrue(response['Content-Disposition'].endswith('.csv"'))
+            self.assertIn('Accept', response['Vary'])
+
+    def test_gzip(self):
+        response = self.export(Accept='application/gzip')
+        self.assertEqual(response['Content-Type'], 'application/gzip')
+        self.assertTrue(response['Content-Disposition'].endswith('.csv.gz"'))
+        rows = list(csv.DictReader(io.StringIO(gzip.decompress(response.content_bytes).decode('utf-8'))))
+        self.assertEqual(len(rows), 6)
+        self.assertEqual(list(rows[0]), list(EXPORT_FIELDS))
+
+    def test_ndjson(self):
+        # The first Accept media type naming a format wins, and '?format=' beats the header
+        for export_format, headers in (('ndjson', {}), (None, {'Accept': 'text/html, application/x-ndjson;q=0.9'})):
+            response = self.export(export_format, **headers)
+            self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+            rows = [json.loads(line) for line in response.content_bytes.decode('utf-8').splitlines()]
+            self.assertEqual(len(rows), 6)
+            self.assertEqual((rows[0]['title'], rows[0]['price_amount']), ('Item 0 of page 1', 100000))
+        self.assertEqual(self.export('csv', Accept='application/x-ndjson')['Content-Type'], 'text/csv')
+
+    @skipUnless(pa is not None, "pyarrow is not installed")
+    def test_parquet_and_arrow(self):
+        table = pq.read_table(io.BytesIO(self.export('parquet').content_bytes))
+        self.assertEqual((table.num_rows, table.column_names), (6, list(EXPORT_FIELDS)))
+        response = self.export(Accept='application/vnd.apache.arrow.stream')
+        self.assertEqual(response['Content-Type'], 'application/vnd.apache.arrow.stream')
+        table = pa.ipc.open_stream(response.content_bytes).read_all()
+        self.assertEqual(table.column('price_amount').to_pylist(), [100000] * 6)
+
+    def test_unavailable_formats(self):
+        self.assertEqual(self.export('xlsx').status_code, 400) # From the view, not DRF's 404 for unknown formats
+        with mock.patch('api.exports.pa', None):
+            response = self.export('parquet')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('pyarrow', response.json()['error'])
+
+
+# --- Distributed refresh ---
+
+@override_settings(REFRESH_UNIT_PAGES=2, REFRESH_LEASE_SECONDS=60)
+class RefreshLeaseTests(FakeListingMixin, TestCase):
+    """update_products workers lease units of pages: one holder at a time, expired leases are taken over."""
+
+    def setUp(self):
+        self.search_query = SearchQuery.objects.create(search_term='iphone', max_page_scraped=5)
+        for page in range(1, 6):
+            store_listing_page(self.search_query, page, listing_items(page))
+        sync_refresh_units()
+        self.long_ago = timezone.now() - timedelta(days=1)
+
+    def units(self):
+        return list(RefreshLease.objects.order_by('page_start').values_list('page_start', 'page_end'))
+
+    def test_units_cover_the_stored_pages(self):
+        self.assertEqual(self.units(), [(1, 2), (3, 4), (5, 5)])
+        SearchQuery.objects.filter(pk=self.search_query.pk).update(max_page_scraped=7)
+        sync_refresh_units()
+        self.assertEqual(self.units(), [(1, 2), (3, 4), (5, 6), (7, 7)])
+
+    def test_a_unit_has_one_holder(self):
+        now = timezone.now()
+        first = claim_refresh_units('host-a', 2, now)
+        second = claim_refresh_units('host-b', 2, now)
+        self.assertEqual(len(first), 2)
+        self.assertEqual(len(second), 1)
+        self.assertFalse({unit.pk for unit in first} & {unit.pk for unit in second})
+        self.assertEqual(claim_refresh_units('host-c', 2, now), [])
+
+    def test_expired_lease_is_taken_over(self):
+        unit, = claim_refresh_units('host-a', 1, timezone.now())
+        self.assertTrue(heartbeat(unit, 'host-a'))
+        RefreshLease.objects.filter(pk=unit.pk).update(lease_expires_at=timezone.now() - timedelta(seconds=1))
+
+        taken = claim_refresh_units('host-b', 1, timezone.now())
+        self.assertEqual([other.pk for other in taken], [unit.pk])
+        # The first holder finds out at its next heartbeat, and can no longer complete the unit
+        self.assertFalse(heartbeat(unit, 'host-a'))
+        complete_unit(unit, 'host-a')
+        self.assertIsNone(RefreshLease.objects.get(pk=unit.pk).last_refreshed_at)
+
+    def test_recently_refreshed_units_are_not_due(self):
+        RefreshLease.objects.update(last_refreshed_at=timezone.now())
+        self.assertEqual(claim_refresh_units('host-a', 5, self.long_ago), [])
+
+    def test_stalest_and_most_requested_first(self):
+        popular = SearchQuery.objects.create(search_term='xiaomi', max_page_scraped=2, request_count=50)
+        sync_refresh_units()
+        RefreshLease.objects.update(last_refreshed_at=self.long_ago)
+        RefreshLease.objects.filter(search_query=self.search_query, page_start=3).update(
+            last_refreshed_at=self.long_ago - timedelta(days=1))
+
+        order = [(unit.search_query.search_term, unit.page_start) for unit in claim_refresh_units('host-a', 5, timezone.now())]
+        # Requested 50 times, it outweighs a unit twice as stale; that one comes before the rest of its term
+        self.assertEqual(order[:2], [(popular.search_term, 1), ('iphone', 3)])
+
+    def test_run_refresh(self):
+        listing = self.use_listing(FakeListing(pages=5))
+        stats = run_refresh(max_workers=2, log=lambda message: None)
+        self.assertEqual((stats.units_completed, stats.pages_stored, stats.products_unchanged), (3, 5, 15))
+        self.assertEqual(len(listing.calls), 5)
+        self.assertFalse(RefreshLease.objects.filter(last_refreshed_at__isnull=True).exists())
+        self.search_query.refresh_from_db()
+        self.assertIsNotNone(self.search_query.last_refreshed)
+        self.assertEqual(run_refresh(max_workers=2, min_age=3600, log=lambda message: None).pages_stored, 0)
+
+    def test_unit_with_a_failed_page_stays_due(self):
+        self.use_listing(FakeListing(pages=5, failing={4}))
+        stats = run_refresh(max_workers=1, log=lambda message: None)
+        # Page 5 is not fetched after page 4 failed: both units stay due
+        self.assertEqual((stats.units_completed, stats.units_failed), (1, 2))
+        for failed in RefreshLease.objects.filter(page_start__gt=1):
+            self.assertEqual((failed.last_refreshed_at, failed.owner, failed.lease_expires_at), (None, '', None))
+        self.assertIsNone(SearchQuery.objects.get(pk=self.search_query.pk).last_refreshed)
+
+
+# --- Incremental upsert ---
+
+class UpsertTests(TestCase):
+    """
+    upsert_page() writes new and changed items only, logs price changes, and
+    keeps each item on the lowest page it was stored on. Runs the COPY merge
+    on PostgreSQL and the ORM path elsewhere (see OrmUpsertTests).
+    """
+
+    def setUp(self):
+        self.search_query = SearchQuery.objects.create(search_term='iphone')
+
+    def upsert(self, page, items):
+        result = upsert_page(self.search_query, page, items)
+        return result.created, result.updated, result.unchanged, result.price_changes
+
+    def test_only_changes_are_written(self):
+        items = listing_items(1)
+        self.assertEqual(self.upsert(1, items), (3, 0, 0, 0))
+        self.assertEqual(self.upsert(1, items), (0, 0, 3, 0))
+
+        items[0].price = '$ 1.200'
+        items[1].title = 'New title'
+        self.assertEqual(self.upsert(1, items), (0, 2, 1, 1))
+        product = Product.objects.get(item_id='MCO100')
+        self.assertEqual((product.price, product.price_amount), ('$ 1.200', 120000))
+        self.assertEqual(Product.objects.get(item_id='MCO101').title, 'New title')
+        change = PriceHistory.objects.get()
+        self.assertEqual((change.product_id, change.previous_price, change.price), (product.pk, '$ 1.000', '$ 1.200'))
+        self.assertEqual(Product.objects.count(), 3)
+
+    def test_ids_are_kept(self):
+        self.upsert(1, listing_items(1))
+        ids = dict(Product.objects.values_list('item_id', 'pk'))
+        items = listing_items(1)
+        for item in items:
+            item.price = '$ 900'
+        self.upsert(1, items)
+        self.assertEqual(dict(Product.objects.values_list('item_id', 'pk')), ids)
+        self.assertEqual(PriceHistory.objects.count(), 3)
+
+    def test_item_keeps_its_lowest_page(self):
+        moved = listing_items(2, count=1)[0] # MCO200
+        self.upsert(2, [moved])
+        self.upsert(1, listing_items(1) + [moved]) # Moved up to page 1
+        self.assertEqual(Product.objects.get(item_id='MCO200').page, 1)
+        self.assertEqual(self.upsert(3, [moved]), (0, 0, 1, 0)) # Also shown on page 3: stays on page 1
+        self.assertEqual(Product.objects.get(item_id='MCO200').page, 1)
+        self.assertEqual(Product.objects.filter(page=1).count(), 4)
+
+    def test_seen_at_is_only_moved_when_due(self):
+        self.upsert(1, listing_items(1))
+        long_ago = timezone.now() - SEEN_AT_INTERVAL - timedelta(minutes=1)
+        recently = timezone.now() - timedelta(minutes=1)
+        Product.objects.filter(item_id='MCO100').update(seen_at=long_ago)
+        Product.objects.filter(item_id='MCO101').update(seen_at=recently)
+        self.upsert(1, listing_items(1))
+        self.assertGreater(Product.objects.get(item_id='MCO100').seen_at, recently)
+        self.assertEqual(Product.objects.get(item_id='MCO101').seen_at, recently)
+
+
+@skipUnless(connection.vendor == 'postgresql', "The ORM path is the only one on other databases")
+@override_settings(INGEST_USE_COPY=False)
+class OrmUpsertTests(UpsertTests):
+    """UpsertTests through the ORM on PostgreSQL."""
+
+
+class ReparseLowestPageTests(TestCase):
+    """reparse_products keeps the rows of items shown on a lower rebuilt page than the one being rebuilt."""
+
+    def test_item_moved_to_a_lower_page(self):
+        search_query = SearchQuery.objects.create(search_term='iphone', max_page_scraped=2)
+        moved = listing_items(2, count=1)[0]
+        cached = {1: listing_items(1), 2: listing_items(2)}
+        cached[1].append(moved)
+        store_listing_page(search_query, 2, listing_items(2))
+        store_listing_page(search_query, 1, listing_items(1))
+
+        with mock.patch('api.management.commands.reparse_products.parse_cached_listing',
+                        side_effect=lambda search_term, page: cached.get(page)):
+            call_command('reparse_products', stdout=io.StringIO())
+
+        self.assertEqual(Product.objects.get(item_id='MCO200').page, 1)
+        self.assertEqual(Product.objects.count(), 6)
+
+
+class DedupKeyTests(TestCase):
+    """One row per listing and search term, keyed by a fixed-width hash of the item identity."""
+
+    def setUp(self):
+        self.search_query = SearchQuery.objects.create(search_term='iphone')
+
+    def test_identity(self):
+        item = listing_items(1, count=1)[0]
+        self.assertEqual(item_identity(item), 'MCO100')
+        self.assertEqual(len(dedup_key('MCO100')), 40)
+        item.item_id = '' # Not parsed: title and image stand in
+        identity = item_identity(item)
+        self.assertTrue(identity.startswith('h:'))
+        item.title = 'Other title'
+        self.assertNotEqual(item_identity(item), identity)
+
+    def test_repeated_listing_is_stored_once(self):
+        items = listing_items(1)
+        result = upsert_page(self.search_query, 1, items + [items[0]]) # Sponsored copy further down
+        self.assertEqual(result.created, 3)
+        self.assertEqual(Product.objects.count(), 3)
+
+    def test_one_row_per_term(self):
+        other = SearchQuery.objects.create(search_term='iphone 13')
+        upsert_page(self.search_query, 1, listing_items(1))
+        upsert_page(other, 1, listing_items(1))
+        self.assertEqual(Product.objects.filter(item_id='MCO100').count(), 2)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            make_product(self.search_query, 2, 'MCO100')
+
+    def test_rows_without_item_id_are_adopted(self):
+        item = listing_items(1, count=1)[0]
+        legacy = Product.objects.create(search_query=self.search_query, page=1, title=item.title, price=item.price,
+                                        image_url=item.image_url, dedup_key='legacy-row')
+        result = upsert_page(self.search_query, 1, [item])
+        self.assertEqual((result.created, result.updated), (0, 1))
+        legacy.refresh_from_db()
+        self.assertEqual((legacy.item_id, legacy.dedup_key), ('MCO100', dedup_key('MCO100')))
+
+
+# --- Normalized fields ---
+
+class NormalizeTests(SimpleTestCase):
+    """Numeric price, rating and seller columns parsed from the display strings."""
+
+    def test_price(self):
+        self.assertEqual(parse_price('$1.054.000'), (105400000, 'COP'))
+        self.assertEqual(parse_price('$ 1.000'), (100000, 'COP'))
+        self.assertEqual(parse_price('$5.983.00050'), (598300050, 'COP')) # Cents glued to the end
+        self.assertEqual(parse_price('US$ 25'), (2500, 'USD'))
+        self.assertEqual(parse_price('U$S 1.200'), (120000, 'USD'))
+        for text in ('', None, 'Precio a convenir', '€ 5', '$1.2.3', '$ 10.5'):
+            self.assertEqual(parse_price(text), (None, ''), text)
+
+    def test_reviews(self):
+        self.assertEqual(parse_reviews('Calificación 4,8 de 5 estrellas. 1494 opiniones.'), (Decimal('4.8'), 1494))
+        self.assertEqual(parse_reviews('Calificación 5 de 5 estrellas. 1.203 opiniones.'), (Decimal('5'), 1203))
+        self.assertEqual(parse_reviews('4.5 (10)'), (None, None))
+        self.assertEqual(parse_reviews(None), (None, None))
+
+    def test_seller(self):
+        self.assertEqual(parse_seller('Por Tienda Oficial'), 'Tienda Oficial')
+        self.assertEqual(parse_seller('Vendido por Mi Tienda'), 'Mi Tienda')
+        self.assertEqual(parse_seller('No seller info'), '')
+        self.assertEqual(parse_seller(None), '')
+
+
+class NormalizeProductsTests(TestCase):
+    """normalize_products fills the numeric columns of rows stored before they existed."""
+
+    def test_backfill(self):
+        search_query = SearchQuery.objects.create(search_term='iphone')
+        product = make_product(search_query, 1, 'MCO1', price='$5.983.00050', seller='Por Tienda',
+                               reviews='Calificación 4,8 de 5 estrellas. 1494 opiniones.')
+        make_product(search_query, 1, 'MCO2', price='Precio a convenir')
+        last_updated = SearchQuery.objects.get().last_updated
+
+        call_command('normalize_products', stdout=io.StringIO())
+        product.refresh_from_db()
+        self.assertEqual(
+            (product.price_amount, product.currency, product.rating, product.review_count, product.seller_name),
+            (598300050, 'COP', Decimal('4.8'), 1494, 'Tienda'),
+        )
+        self.assertIsNone(Product.objects.get(item_id='MCO2').price_amount)
+        self.assertGreater(SearchQuery.objects.get().last_updated, last_updated) # Exports get new ETags
+
+        out = io.StringIO()
+        call_command('normalize_products', 'iphone', stdout=out)
+        self.assertIn('0 of 2 row(s) updated', out.getvalue())
+
+
+# --- JSON product list ---
+
+class ProductListTests(TestCase):
+    """/api/products/list pages through the stored rows with a keyset cursor, in every sort order."""
+
+    # Prices (in pesos) of the items on each page; page 4 is stored but not complete
+    PRICES = {1: [3, 1, 2], 2: [1, None, 5], 3: [2, 4, 1], 4: [0]}
+
+    def setUp(self):
+        self.search_query = SearchQuery.objects.create(search_term='iphone', max_page_scraped=3)
+        for page, prices in self.PRICES.items():
+            for n, price in enumerate(prices):
+                make_product(self.search_query, page, f'MCO{page}{n}',
+                             price_amount=None if price is None else price * MINOR_UNITS)
+
+    def get(self, **params):
+        return self.client.get(reverse('product-list'), {'search_term': 'iphone', **params})
+
+    def walk(self, **params):
+        """item_ids of every row, following the 'next' links."""
+        response = self.get(**params)
+        item_ids = []
+        while True:
+            self.assertEqual(response.status_code, 200)
+            item_ids += [row['item_id'] for row in response.json()['results']]
+            next_link = response.json()['next']
+            if next_link is None:
+                return item_ids
+            response = self.client.get(next_link)
+
+    def ordered(self, *ordering, **filters):
+        products = Product.objects.filter(page__lte=3, **filters).order_by(*ordering)
+        return list(products.values_list('item_id', flat=True))
+
+    def test_cursor_walks_every_row_once(self):
+        self.assertEqual(self.walk(page_size=2), self.ordered('page', 'id'))
+        body = self.get(page_size=2).json()
+        self.assertEqual(len(body['results']), 2)
+        self.assertNotIn('cursor=', body['first'])
+        self.assertIn('cursor=', body['next'])
+        self.assertIsNone(self.get().json()['next'])
+
+    def test_price_sorts(self):
+        # Ties on price are broken by id, rows without a price are left out
+        self.assertEqual(self.walk(sort='price', page_size=2),
+                         self.ordered('price_amount', 'id', price_amount__isnull=False))
+        self.assertEqual(self.walk(sort='-price', page_size=2),
+                         self.ordered('-price_amount', '-id', price_amount__isnull=False))
+
+    def test_filters_and_fields(self):
+        self.assertEqual(self.walk(page_min=2, page_max=2), ['MCO20', 'MCO21', 'MCO22'])
+        self.assertEqual(self.walk(page_max=9), self.ordered('page', 'id')) # Page 4 is not complete
+        self.assertEqual(self.walk(min_price=2, max_price=3, sort='price'), ['MCO12', 'MCO30', 'MCO10'])
+        row = self.get(fields='item_id,price_amount').json()['results'][0]
+        self.assertEqual(row, {'item_id': 'MCO10', 'price_amount': 300})
+
+    @mock.patch.object(KeysetPagination, 'max_page_size', 4)
+    def test_page_size(self):
+        self.assertEqual(len(self.get(page_size=1000).json()['results']), 4)
+        self.assertEqual(len(self.get(page_size=0).json()['results']), 1)
+        self.assertEqual(len(self.get(page_size='many').json()['results']), 9) # Default page size: every row
+
+    def test_errors(self):
+        for params in ({'search_term': ''}, {'page_min': '0'}, {'sort': 'title'}, {'fields': 'item_id,secret'},
+                       {'min_price': 'cheap'}):
+            self.assertEqual(self.get(**params).status_code, 400, params)
+        self.assertEqual(self.get(search_term='ipad').status_code, 404)
+        wrong_length = base64.urlsafe_b64encode(b'[1]').decode('ascii')
+        wrong_type = base64.urlsafe_b64encode(b'["one", 1]').decode('ascii')
+        for cursor in ('not-a-cursor', wrong_length, wrong_type):
+            self.assertEqual(self.get(cursor=cursor).status_code, 404, cursor)
+
+
+# --- Progressive exports ---
+
+class PageProgressTests(SimpleTestCase):
+    """Pages stored out of order are exported once every page before them is."""
+
+    def test_in_order(self):
+        progress = PageProgress(2)
+        self.assertEqual(progress.record(4, PageClaim.STATUS_STORED), [])
+        self.assertEqual(progress.record(3, PageClaim.STATUS_STORED), [3, 4])
+        self.assertEqual(progress.record(6, PageClaim.STATUS_STORED), [])
+        self.assertEqual(progress.record(5, PageClaim.STATUS_FAILED), []) # Page 6 never becomes exportable
+        self.assertEqual(progress.pages_complete, 4)
+
+
+class InlineThread(threading.Thread):
+    """A thread whose start() runs it in the calling thread."""
+
+    def start(self):
+        self.run()
+
+
+# TransactionTestCase: the scrape runs in a thread, with a connection of its own
+@override_settings(CACHES=TEST_CACHES)
+class ProgressiveExportTests(FakeListingMixin, TransactionTestCase):
+    """'progressive=true' streams the stored pages, then each scraped page, with nothing but rows in the body."""
+
+    def setUp(self):
+        self.use_listing(FakeListing(pages=10))
+        if connection.vendor == 'sqlite':
+            # The shared in-memory test database fails a read that overlaps the scrape's writes
+            # ("table is locked") instead of waiting for them: the scrape runs before the rows are read
+            patcher = mock.patch('api.progressive.threading', mock.Mock(Thread=InlineThread))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.search_query = SearchQuery.objects.create(search_term='iphone', max_page_scraped=2)
+        for page in (1, 2):
+            store_listing_page(self.search_query, page, listing_items(page))
+
+    def export(self, pages_required=4, **params):
+        return self.client.get(reverse('product-data'),
+                               {'search_term': 'iphone', 'pages_required': pages_required, 'progressive': 'true', **params})
+
+    def status(self, pages_required):
+        response = self.client.get(reverse('product-status'), {'search_term': 'iphone', 'pages_required': pages_required})
+        return response.json()
+
+    def test_stored_then_scraped_pages(self):
+        response = self.export()
+        self.assertEqual((response['X-Pages-Complete'], response['X-Pages-Requested']), ('2', '4'))
+        self.assertEqual(response['Cache-Control'], 'no-store')
+        self.assertNotIn('ETag', response)
+        rows = csv_rows(response)
+        self.assertEqual([row['page'] for row in rows], [str(page) for page in range(1, 5) for _ in range(3)])
+        self.assertEqual(sorted(page for _, page in self.listing.calls), [3, 4])
+        self.assertEqual(self.status(4)['pages_complete'], 4)
+
+    def test_failed_page(self):
+        self.listing.failing = {4}
+        rows = csv_rows(self.export(pages_required=6))
+        # Every line of the body is a product: no trailer to mistake for a row
+        self.assertEqual(len(rows), 9)
+        self.assertTrue(all(row['title'].startswith('Item ') for row in rows))
+        status = self.status(6)
+        self.assertEqual((status['pages_complete'], status['pages_requested']), (3, 6))
+
+    def test_text_formats(self):
+        response = self.export(format='csv.gz')
+        content = gzip.decompress(b''.join(response.streaming_content)).decode('utf-8')
+        self.assertEqual(len(list(csv.DictReader(io.StringIO(content)))), 12)
+
+        response = self.export(pages_required=5, format='ndjson')
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).decode('utf-8').splitlines()]
+        self.assertEqual([row['page'] for row in rows], [page for page in range(1, 6) for _ in range(3)])
+
+    def test_errors(self):
+        self.assertEqual(self.export(format='parquet').status_code, 400)
+        self.assertEqual(self.export(sort='price').status_code, 400)
+        self.assertEqual(self.listing.calls, [])
+
+
+class ProductStatusTests(TestCase):
+    """/api/products/status reports the pages of a term stored so far, and never scrapes."""
+
+    def get(self, **params):
+        return self.client.get(reverse('product-status'), params)
+
+    def test_status(self):
+        search_query = SearchQuery.objects.create(search_term='iphone', max_page_scraped=3)
+        self.assertEqual(self.get(search_term='IPhone ', pages_required=5).json(), {
+            'search_term': 'iphone', 'pages_complete': 3, 'pages_requested': 5, 'pages_reachable': 5,
+        })
+        self.assertEqual(self.get(search_term='iphone', pages_required=2).json()['pages_complete'], 2)
+
+        record_result_count(search_query, 1, listing_items(1, total_pages=4))
+        self.assertEqual(self.get(search_term='iphone', pages_required=5).json()['pages_reachable'], 4)
+
+    def test_errors(self):
+        self.assertEqual(self.get(search_term='iphone', pages_required=2).status_code, 404)
+        SearchQuery.objects.create(search_term='iphone')
+        for params in ({'pages_required': 2}, {'search_term': 'iphone', 'pages_required': 0},
+                       {'search_term': 'iphone', 'pages_required': 'two'}):
+            self.assertEqual(self.get(**params).status_code, 400, params)
+
+
+# --- Batch exports ---
+
+@override_settings(CACHES=TEST_CACHES, BATCH_SCRAPE_CONCURRENCY=4, BATCH_MAX_TERMS=3)
+class ProductBatchTests(FakeListingMixin, TestCase):
+    """POST /api/products/batch scrapes the missing pages of every term on one pool and exports them together."""
+
+    def setUp(self):
+        self.use_listing(FakeListing(delays={1: 0.1, 2: 0.1, 3: 0.1}))
+        search_query = SearchQuery.objects.create(search_term='iphone', max_page_scraped=2)
+        for page in (1, 2):
+            store_listing_page(search_query, page, listing_items(page))
+
+    def post(self, data, **params):
+        url = reverse('product-batch')
+        if params:
+            url = f'{url}?{urlencode(params)}'
+        return self.client.post(url, data, content_type='application/json')
+
+    def test_terms_share_the_fetch_pool(self):
+        response = self.post({'terms': [
+            {'search_term': 'iphone', 'pages_required': 3},
+            {'search_term': 'Xiaomi ', 'pages_required': 1},
+            {'search_term': 'xiaomi', 'pages_required': '2'}, # Same term: the largest page count is kept
+        ]})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(sorted(self.listing.calls), [('iphone', 3), ('xiaomi', 1), ('xiaomi', 2)])
+        self.assertEqual(self.listing.max_running, 3) # Pages of both terms in flight at once
+
+        rows = csv_rows(response)
+        self.assertEqual(list(rows[0]), ['search_term', *EXPORT_FIELDS])
+        self.assertEqual([(row['search_term'], row['page']) for row in rows][::3],
+                         [('iphone', '1'), ('iphone', '2'), ('iphone', '3'), ('xiaomi', '1'), ('xiaomi', '2')])
+        self.assertEqual(SearchQuery.objects.get(search_term='xiaomi').max_page_scraped, 2)
+
+    def test_export_options(self):
+        terms = {'terms': [{'search_term': 'iphone', 'pages_required': 1}]}
+        response = self.post(terms, format='ndjson', max_price=1000)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).decode('utf-8').splitlines()]
+        self.assertEqual([(row['search_term'], row['page']) for row in rows], [('iphone', 1)] * 3)
+        self.assertEqual(csv_rows(self.post(terms, min_price=2000)), [])
+
+    def test_invalid_bodies(self):
+        terms = [{'search_term': term, 'pages_required': 1} for term in ('a', 'b', 'c', 'd')]
+        for data in ({}, {'terms': []}, {'terms': 'iphone'}, {'terms': terms},
+                     {'terms': [{'pages_required': 1}]}, {'terms': [{'search_term': ' ', 'pages_required': 1}]},
+                     {'terms': [{'search_term': 'iphone'}]}, {'terms': [{'search_term': 'iphone', 'pages_required': 0}]},
+                     {'terms': [{'search_term': 'iphone', 'pages_required': True}]}):
+            self.assertEqual(self.post(data).status_code, 400, data)
+        self.assertEqual(self.post({'terms': terms[:1]}, format='xlsx').status_code, 400)
+        self.assertEqual(self.listing.calls, [])
+        self.assertFalse(SearchQuery.objects.filter(search_term='a').exists())
+
+
+# --- Result count ---
+
+@override_settings(RESULT_COUNT_MAX_AGE=3600)
+class ResultCountTests(FakeListingMixin, TestCase):
+    """The result count a listing page reports stops scrapes at the last page of results."""
+
+    def setUp(self):
+        self.search_query = SearchQuery.objects.create(search_term='iphone')
+
+    def test_record_result_count(self):
+        record_result_count(self.search_query, 2, listing_items(2, total_pages=4))
+        self.search_query.refresh_from_db()
+        self.assertEqual((self.search_query.total_results, self.search_query.total_pages), (4 * RESULTS_PER_PAGE, 4))
+        with self.assertNumQueries(0): # Same totals, recently counted
+            record_result_count(self.search_query, 3, listing_items(3, total_pages=4))
+            record_result_count(self.search_query, 5, listing_items(5, count=0, total_pages=0)) # Past the end
+            record_result_count(self.search_query, 1, listing_items(1)) # No count on the page
+        record_result_count(self.search_query, 1, listing_items(1, count=0, total_pages=0)) # No results at all
+        self.search_query.refresh_from_db()
+        self.assertEqual(self.search_query.total_pages, 0)
+
+    def test_reachable_pages(self):
+        self.assertEqual(self.search_query.reachable_pages(5), 5) # Not counted yet
+        record_result_count(self.search_query, 1, listing_items(1, total_pages=3))
+        self.assertEqual((self.search_query.reachable_pages(5), self.search_query.reachable_pages(2)), (3, 2))
+        self.search_query.results_counted_at = timezone.now() - timedelta(hours=2)
+        self.assertEqual(self.search_query.reachable_pages(5), 5) # Too old to trust
+
+    @override_settings(SCRAPER_CONCURRENCY=1)
+    def test_no_fetch_past_the_last_page(self):
+        listing = self.use_listing(FakeListing(pages=3))
+        self.assertEqual(scrape_missing_pages(self.search_query, 6), 3)
+        self.assertEqual(listing.calls, [('iphone', 1), ('iphone', 2), ('iphone', 3)])
+        listing.calls.clear()
+        self.assertEqual(scrape_missing_pages(self.search_query, 6), 3)
+        self.assertEqual(listing.calls, [])
+
+    @override_settings(CACHES=TEST_CACHES, SCRAPE_JOBS_ASYNC=True)
+    def test_complete_term_is_exported_without_a_job(self):
+        listing = self.use_listing(FakeListing(pages=2))
+        for page in (1, 2):
+            store_listing_page(self.search_query, page, listing_items(page))
+        SearchQuery.objects.filter(pk=self.search_query.pk).update(max_page_scraped=2)
+        record_result_count(self.search_query, 2, listing_items(2, total_pages=2))
+
+        response = self.client.get(reverse('product-data'), {'search_term': 'iphone', 'pages_required': 5})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(csv_rows(response)), 6)
+        self.assertEqual((listing.calls, ScrapeJob.objects.count()), ([], 0))
+
+
+# --- Search ---
+
+class NormalizeSearchTermTests(SimpleTestCase):
+    """Search terms are case folded, stripped of accents (not of the ñ) and single spaced."""
+
+    def test_normal_form(self):
+        self.assertEqual(normalize_search_term('  iPhone \t 13  '), 'iphone 13')
+        self.assertEqual(normalize_search_term('Cámara CANÓN'), 'camara canon')
+        self.assertEqual(normalize_search_term('NIÑO Pingüino'), 'niño pinguino')
+        self.assertEqual(normalize_search_term('nin\u0303o'), 'niño') # Decomposed ñ
+        self.assertEqual(query_words('iphone-13 "pro" OR *'), ['iphone', '13', 'pro', 'or'])
+
+
+class SearchTermVariantsTests(FakeListingMixin, TestCase):
+    """Variants of a term share one SearchQuery and its stored pages."""
+
+    @override_settings(CACHES=TEST_CACHES)
+    def test_variants_are_not_scraped_again(self):
+        listing = self.use_listing(FakeListing())
+        for term in ('iPhone 13', 'iphone  13', 'IPHONE 13 '):
+            response = self.client.get(reverse('product-data'), {'search_term': term, 'pages_required': 1})
+            self.assertEqual(len(csv_rows(response)), 3)
+        self.assertEqual(list(SearchQuery.objects.values_list('search_term', flat=True)), ['iphone 13'])
+        self.assertEqual(listing.calls, [('iphone 13', 1)])
+
+
+class ProductSearchTests(TestCase):
+    """/api/products/search ranks the stored titles of every term against a free-text query."""
+
+    def setUp(self):
+        phones = SearchQuery.objects.create(search_term='iphone')
+        cameras = SearchQuery.objects.create(search_term='camara')
+        make_product(phones, 1, 'MCO1', title='Apple iPhone 13 128GB Azul', price_amount=400000000)
+        make_product(phones, 1, 'MCO2', title='Funda Apple iPhone 13', price_amount=3000000)
+        make_product(phones, 2, 'MCO3', title='Funda silicona', price_amount=1500000)
+        make_product(cameras, 1, 'MCO4', title='Cámara Canon EOS', price_amount=250000000)
+
+    def search(self, **params):
+        response = self.client.get(reverse('product-search'), params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def item_ids(self, **params):
+        return [row['item_id'] for row in self.search(**params)['results']]
+
+    def check_search(self):
+        self.assertEqual(self.item_ids(q='iphone 13 128gb'), ['MCO1', 'MCO2']) # More words matched first
+        self.assertEqual(self.item_ids(q='CANON'), ['MCO4'])
+        self.assertEqual(sorted(self.item_ids(q='funda')), ['MCO2', 'MCO3'])
+        self.assertEqual(self.item_ids(q='funda', max_price=20000), ['MCO3']) # In pesos
+        self.assertEqual(self.item_ids(q='apple', min_price=1000000), ['MCO1'])
+        self.assertEqual(self.item_ids(q='"!!"'), [])
+
+    def test_search(self):
+        self.check_search()
+        # The full-text indexes fold accents, LIKE matching does not
+        self.assertEqual(self.item_ids(q='CAMARA'), ['MCO4'])
+        self.assertEqual(self.item_ids(q='cámara'), ['MCO4'])
+        row = self.search(q='canon')['results'][0]
+        self.assertEqual(row['search_term'], 'camara')
+        self.assertGreater(row['rank'], 0)
+
+    def test_like_fallback(self):
+        with mock.patch.dict('api.search._backends', {connection.alias: 'like'}):
+            self.check_search()
+
+    def test_offset_pages(self):
+        body = self.search(q='apple', page_size=1)
+        self.assertEqual(len(body['results']), 1)
+        seen = [body['results'][0]['item_id']]
+        body = self.client.get(body['next']).json()
+        seen.append(body['results'][0]['item_id'])
+        self.assertIsNone(body['next'])
+        self.assertEqual(sorted(seen), ['MCO1', 'MCO2'])
+
+    def test_errors(self):
+        for params in ({}, {'q': ' '}, {'q': 'iphone', 'offset': 'x'}, {'q': 'iphone', 'min_price': '-1'}):
+            self.assertEqual(self.client.get(reverse('product-search'), params).status_code, 400, params)
+
+
+# --- Retention ---
+
+@override_settings(PRODUCT_RETENTION_DAYS=30, PRICE_HISTORY_RETENTION_DAYS=365, SCRAPE_JOB_RETENTION_DAYS=7)
+class RetentionTests(TestCase):
+    """compact_storage deletes what the retention policy of retention.py says, and nothing else."""
+
+    def setUp(self):
+        self.now = timezone.now()
+        self.search_query = SearchQuery.objects.create(
+            search_term='iphone', max_page_scraped=2, last_refreshed=self.now,
+        )
+
+    def test_unlisted_product_expires_once_its_page_was_stored_again(self):
+        gone = make_product(self.search_query, 1, 'MCO1', seen_at=self.now - timedelta(days=40))
+        listed = make_product(self.search_query, 1, 'MCO2', seen_at=self.now)
+        store_page(self.search_query, 1, self.now)
+
+        stats = run_compaction(log=lambda message: None)
+
+        self.assertEqual(stats.deleted['api.Product'], 1)
+        self.assertFalse(Product.objects.filter(pk=gone.pk).exists())
+        self.assertTrue(Product.objects.filter(pk=listed.pk).exists())
+
+    def test_products_kept_while_their_page_was_not_stored_again(self):
+        # The refresh of page 1 failed: not being listed proves nothing
+        make_product(self.search_query, 1, 'MCO1', seen_at=self.now - timedelta(days=40))
+        run_compaction(log=lambda message: None)
+        self.assertEqual(Product.objects.count(), 1)
+
+    def test_products_kept_when_the_term_was_not_refreshed_since(self):
+        SearchQuery.objects.filter(pk=self.search_query.pk).update(last_refreshed=self.now - timedelta(days=50))
+        make_product(self.search_query, 1, 'MCO1', seen_at=self.now - timedelta(days=40))
+        store_page(self.search_query, 1, self.now)
+        run_compaction(log=lambda message: None)
+        self.assertEqual(Product.objects.count(), 1)
+
+    def test_pages_left_empty_are_scraped_again(self):
+        make_product(self.search_query, 1, 'MCO1', seen_at=self.now)
+        make_product(self.search_query, 2, 'MCO2', seen_at=self.now - timedelta(days=40))
+        store_page(self.search_query, 1, self.now)
+        store_page(self.search_query, 2, self.now)
+
+        run_compaction(log=lambda message: None)
+
+        self.search_query.refresh_from_db()
+        self.assertEqual(self.search_query.max_page_scraped, 1)
+        self.assertEqual(list(PageClaim.objects.values_list('page', flat=True)), [1])
+
+    def test_old_price_changes_and_finished_jobs_expire(self):
+        product = make_product(self.search_query, 1, 'MCO1', seen_at=self.now)
+        PriceHistory.objects.create(product=product, previous_price='$ 1', price='$ 2',
+                                    changed_at=self.now - timedelta(days=400))
+        kept_change = PriceHistory.objects.create(product=product, previous_price='$ 2', price='$ 3',
+                                                  changed_at=self.now - timedelta(days=10))
+        for status, finished_days_ago in ((ScrapeJob.STATUS_DONE, 10), (ScrapeJob.STATUS_DONE, 1),
+                                          (ScrapeJob.STATUS_PENDING, None)):
+            finished_at = self.now - timedelta(days=finished_days_ago) if finished_days_ago else None
+            ScrapeJob.objects.create(search_query=self.search_query, pages_required=1, status=status,
+                                     finished_at=finished_at)
+
+        stats = run_compaction(batch_size=1, log=lambda message: None)
+
+        self.assertTrue(stats.finished)
+        self.assertEqual(list(PriceHistory.objects.values_list('pk', flat=True)), [kept_change.pk])
+        self.assertEqual(ScrapeJob.objects.count(), 2)
+        self.assertFalse(ScrapeJob.objects.filter(finished_at__lt=self.now - timedelta(days=7)).exists())
+
+    @override_settings(PRODUCT_RETENTION_DAYS=0, PRICE_HISTORY_RETENTION_DAYS=0, SCRAPE_JOB_RETENTION_DAYS=0)
+    def test_zero_keeps_rows_forever(self):
+        product = make_product(self.search_query, 1, 'MCO1', seen_at=self.now - timedelta(days=4000))
+        store_page(self.search_query, 1, self.now)
+        PriceHistory.objects.create(product=product, previous_price='$ 1', price='$ 2',
+                                    changed_at=self.now - timedelta(days=4000))
+        stats = run_compaction(log=lambda message: None)
+        self.assertFalse(any(stats.deleted.values()))
+
+
+@skipUnless(connection.vendor == 'postgresql', "Price history is only partitioned on PostgreSQL")
+@override_settings(PRICE_HISTORY_RETENTION_DAYS=365)
+class PriceHistoryPartitionTests(TransactionTestCase):
+    """
+    Migration 0014 partitions api_pricehistory; the ORM and compaction must
+    work on it. Not a TestCase: a partition cannot be dropped in the
+    transaction that inserted its rows (deferred foreign key checks).
+    """
+
+    def setUp(self):
+        self.now = timezone.now()
+        search_query = SearchQuery.objects.create(search_term='iphone', max_page_scraped=1)
+        self.product = make_product(search_query, 1, 'MCO1')
+
+    def test_orm_inserts(self):
+        self.assertTrue(price_history_partitioned())
+        changes = [
+            PriceHistory.objects.create(product=self.product, previous_price='$ 1', price='$ 2', changed_at=moment)
+            for moment in (self.now, self.now - timedelta(days=800)) # A month partition, the default partition
+        ]
+        changes += PriceHistory.objects.bulk_create([
+            PriceHistory(product=self.product, previous_price='$ 2', price='$ 3', changed_at=self.now),
+        ])
+        self.assertTrue(all(change.pk for change in changes))
+        self.assertEqual(len({change.pk for change in changes}), 3)
+        self.assertEqual(self.product.price_history.count(), 3)
+
+    def test_compaction_drops_expired_months(self):
+        PriceHistory.objects.create(product=self.product, previous_price='$ 1', price='$ 2', changed_at=self.now)
+        old = PriceHistory.objects.create(product=self.product, previous_price='$ 2', price='$ 3',
+                                          changed_at=self.now - timedelta(days=800))
+        current_month = min(month_partitions())
+
+        # Two years on: this month's partition is past retention, the row in the default one too
+        later = self.now + timedelta(days=730)
+        stats = CompactionStats()
+        self.assertTrue(compact_price_history(later, 100, stats))
+
+        self.assertGreater(stats.partitions_created, 0)
+        self.assertGreater(stats.partitions_dropped, 0)
+        self.assertNotIn(current_month, month_partitions())
+        self.assertEqual(stats.deleted['api.PriceHistory'], 2)
+        self.assertFalse(PriceHistory.objects.exists())
+        self.assertFalse(PriceHistory.objects.filter(pk=old.pk).exists())
@@ -1,6 +1,22 @@
+from django.conf import settings
 from django.urls import path
-from .views import ProductDataView
+from .views import (
+    AsyncProductBatchView, AsyncProductDataView, AsyncScrapeJobDownloadView, MetricsView, ProductBatchView,
+    ProductDataView, ProductListView, ProductSearchView, ProductStatusView, ScrapeJobDownloadView, ScrapeJobStatusView,
+)
+
+# Under an ASGI server the endpoints that scrape or stream exports are native async views
+product_data_view = AsyncProductDataView if settings.ASGI_VIEWS else ProductDataView
+product_batch_view = AsyncProductBatchView if settings.ASGI_VIEWS else ProductBatchView
+job_download_view = AsyncScrapeJobDownloadView if settings.ASGI_VIEWS else ScrapeJobDownloadView
 
 urlpatterns = [
-    path('products', ProductDataView.as_view(), name='product-data'),
-]
\ No newline at end of file
+    path('products', product_data_view.as_view(), name='product-data'),
+    path('products/batch', product_batch_view.as_view(), name='product-batch'),
+    path('products/list', ProductListView.as_view(), name='product-list'),
+    path('products/status', ProductStatusView.as_view(), name='product-status'),
+    path('products/search', ProductSearchView.as_view(), name='product-search'),
+    path('jobs/<int:pk>', ScrapeJobStatusView.as_view(), name='scrape-job-status'),
+    path('jobs/<int:pk>/download', job_download_view.as_view(), name='scrape-job-download'),
+    path('metrics', MetricsView.as_view(), name='metrics'),
+]
@@ -1,175 +1,641 @@
-from django.shortcuts import render
-import sys
-import os
-import csv
-import io
-from pathlib import Path
-import time
-
-from django.http import HttpResponse
-from django.db import transaction
+import json
+import logging
+from decimal import Decimal, InvalidOperation
+
+from django.conf import settings
+from django.db.models import F, Q
+from django.http import HttpResponse, HttpResponseNotModified, JsonResponse
+from django.shortcuts import get_object_or_404, render
 from django.utils import timezone
+from django.utils.decorators import method_decorator
+from django.utils.http import parse_etags
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
 
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
+from rest_framework.utils.urls import replace_query_param
+
+from .asyncdb import run_db
+from .exports import (
+    BATCH_EXPORT_FIELDS, DEFAULT_EXPORT_FORMAT, EXPORT_FORMATS, batch_export_response, cached_export_response,
+    export_cache_key, export_etag, export_response, get_cached_export, negotiate_export_format,
+)
+from .ingest import (
+    scrape_missing_pages, scrape_missing_pages_async, scrape_missing_pages_batch, scrape_missing_pages_batch_async,
+)
+from .jobs import enqueue_scrape_job, recently_attempted
+from .metrics import CONTENT_TYPE, EXPORT_REQUESTS, render_metrics
+from .models import ScrapeJob, SearchQuery, Product
+from .negotiation import ExportContentNegotiation
+from .normalize import MINOR_UNITS
+from .pagination import KeysetPagination
+from .progressive import progressive_response, wants_progressive
+from .refresh import record_request, record_requests
+from .search import normalize_search_term, search_products
+from .serializers import ProductSearchSerializer, ProductSerializer, ScrapeJobSerializer
+
+logger = logging.getLogger(__name__)
+
+# --- Export Helpers ---
+
+# Values of the 'sort' query parameter; price sorts use the (search_query, price_amount) index
+SORT_ORDERS = {
+    'page': ('page', 'id'),
+    'price': (F('price_amount').asc(nulls_last=True), 'id'),
+    '-price': (F('price_amount').desc(nulls_last=True), 'id'),
+}
+
+
+def parse_export_options(query_params):
+    """
+    Filters and order of an export: 'min_price' / 'max_price' (inclusive, in
+    pesos) and 'sort' (a key of SORT_ORDERS). Raises ValueError with a
+    message for the client when a value is invalid.
+    """
+    options = {'sort': query_params.get('sort') or 'page'}
+    if options['sort'] not in SORT_ORDERS:
+        raise ValueError(f"'sort' must be one of: {', '.join(SORT_ORDERS)}.")
+    for name in ('min_price', 'max_price'):
+        value = query_params.get(name)
+        if not value:
+            continue
+        try:
+            amount = Decimal(value)
+        except InvalidOperation:
+            raise ValueError(f"'{name}' must be a number.")
+        if not amount.is_finite() or amount < 0:
+            raise ValueError(f"'{name}' must be a non-negative number.")
+        options[name] = int(amount * MINOR_UNITS) # Compared with Product.price_amount
+    return options
+
+
+def filter_products(products, options):
+    """`products` within the 'min_price' / 'max_price' bounds of `options`."""
+    if 'min_price' in options:
+        products = products.filter(price_amount__gte=options['min_price'])
+    if 'max_price' in options:
+        products = products.filter(price_amount__lte=options['max_price'])
+    return products
+
+
+def export_variant(options):
+    """Part of the export cache key and ETag that depends on `options`, '' for the default export."""
+    if options == {'sort': 'page'}:
+        return ''
+    return f"{options.get('min_price', '')}:{options.get('max_price', '')}:{options['sort']}"
+
+
+def export_products(request, search_query, search_term, pages_required, options=None, export_format=None,
+                    async_stream=False):
+    """
+    Stream the stored products of `search_query` up to `pages_required` in
+    `export_format` (CSV by default, see exports.EXPORT_FORMATS), filtered
+    and ordered by `options` (see parse_export_options()) in the DB.
+
+    Answers 304 when the client's If-None-Match still matches, and serves
+    the rendered export from the cache when it is there. `async_stream` is
+    for async views (see exports.export_response()).
+    """
+    options = options or {'sort': 'page'}
+    export_format = export_format or EXPORT_FORMATS[DEFAULT_EXPORT_FORMAT]
+    variant = export_variant(options)
+    # Fetch products up to the number of pages required OR the max successfully scraped
+    final_max_page = min(pages_required, search_query.max_page_scraped)
+    filename = f"products_{search_term}_pages_1_to_{final_max_page}.{export_format.extension}"
+
+    etag = export_etag(search_query, final_max_page, export_format.name, variant)
+    if_none_match = parse_etags(request.headers.get('If-None-Match', ''))
+    if etag in if_none_match or '*' in if_none_match:
+        EXPORT_REQUESTS.labels(export_format.name, 'not_modified').inc()
+        response = HttpResponseNotModified()
+        response['ETag'] = etag
+        return response
+
+    cache_key = export_cache_key(search_query, final_max_page, export_format.name, variant)
+    cached = get_cached_export(cache_key)
+    if cached is not None:
+        EXPORT_REQUESTS.labels(export_format.name, 'hit').inc()
+        return cached_export_response(cached, export_format, filename, etag)
+
+    products = Product.objects.filter(
+        search_query=search_query,
+        page__lte=final_max_page
+    )
+
+    if not products.exists():
+        return Response({"message": f"No products found for '{search_term}' up to page {final_max_page} after attempting scrape."}, status=status.HTTP_404_NOT_FOUND)
+
+    # A price filter matching nothing gives an export with no rows
+    products = filter_products(products, options).order_by(*SORT_ORDERS[options['sort']]) # Order consistently for the export
+
+    # Rows are rendered while they are read from a chunked cursor
+    EXPORT_REQUESTS.labels(export_format.name, 'miss').inc()
+    return export_response(products, export_format, filename, etag, cache_key, async_stream)
+
+
+def progressive_export(search_query, search_term, pages_required, options, export_format, async_stream=False):
+    """
+    Progressive export (see progressive.py): the stored pages are streamed at
+    once and the missing ones are scraped alongside the response.
+    """
+    EXPORT_REQUESTS.labels(export_format.name, 'progressive').inc()
+    products = filter_products(Product.objects.filter(search_query=search_query), options)
+    return progressive_response(search_query, products, search_term, pages_required, export_format, async_stream)
+
+
+def parse_term_params(request):
+    """(search_term, pages_required) of a request. Raises ValueError with a message for the client."""
+    search_term = normalize_search_term(request.GET.get('search_term') or '')
+    pages_required_str = request.GET.get('pages_required')
+
+    if not search_term:
+        raise ValueError("'search_term' query parameter is required.")
+
+    if not pages_required_str:
+        raise ValueError("'pages_required' query parameter is required.")
+
+    try:
+        pages_required = int(pages_required_str)
+        if pages_required <= 0:
+            raise ValueError("Pages required must be positive.")
+    except ValueError:
+        raise ValueError("'pages_required' must be a positive integer.")
+
+    return search_term, pages_required
+
+
+def parse_product_params(request):
+    """
+    (search_term, pages_required, export options, ExportFormat) of a product
+    export request. Raises ValueError with a message for the client.
+    """
+    search_term, pages_required = parse_term_params(request)
+    return search_term, pages_required, parse_export_options(request.GET), negotiate_export_format(request)
 
-from .models import SearchQuery, Product
-# from .serializers import ProductSerializer # Not strictly needed for CSV export
 
-# --- Dynamically add scraping directory to sys.path ---
-# Calculate the path to the directory containing the scraping script
-# Assumes backend/ and scraping/ are siblings in the project root
-BACKEND_DIR = Path(__file__).resolve().parent.parent
-SCRAPING_DIR = BACKEND_DIR.parent / 'scraping'
+def open_search_query(search_term):
+    """The SearchQuery of `search_term`, created on first use, with this request counted."""
+    search_query, created = SearchQuery.objects.get_or_create(
+        search_term=normalize_search_term(search_term) # Variants of a term share its stored pages
+    )
+    record_request(search_query)
+    return search_query
 
-if str(SCRAPING_DIR) not in sys.path:
-    sys.path.insert(0, str(SCRAPING_DIR))
 
-try:
-    from scraper import search_mercadolibre
-except ImportError as e:
-    # Handle case where scraper.py might be missing or has issues
-    print(f"Error importing scraper: {e}")
-    # Define a dummy function or raise a more specific error if crucial
-    def search_mercadolibre(search_param, page=1):
-        print("Scraper function not available.")
-        return []
+def wants_scrape_job(request):
+    """True when missing pages should be queued as a job ('async' parameter, else SCRAPE_JOBS_ASYNC)."""
+    value = request.GET.get('async')
+    if value is None:
+        return settings.SCRAPE_JOBS_ASYNC
+    return value.lower() in ('1', 'true', 'yes')
 
-# --- API View ---
+
+def queue_scrape_job(request, search_query, pages_required):
+    """
+    202 response for a scrape job covering `pages_required`, or None when a
+    job tried those pages recently: the term simply has fewer pages, and the
+    stored ones are exported.
+    """
+    if recently_attempted(search_query, pages_required):
+        return None
+    # Leave the scraping to a run_scrape_jobs worker and let the client poll
+    job, job_created = enqueue_scrape_job(search_query, pages_required)
+    serializer = ScrapeJobSerializer(job, context={'request': request})
+    return Response(serializer.data, status=status.HTTP_202_ACCEPTED)
+
+
+def export_job(request, job, async_stream=False):
+    """Export of a finished scrape job, a 409 while it is still running."""
+    if job.status != ScrapeJob.STATUS_DONE:
+        return Response({"error": f"Job {job.pk} is {job.status}, the export is available once it is done."}, status=status.HTTP_409_CONFLICT)
+    try:
+        export_options = parse_export_options(request.GET)
+        export_format = negotiate_export_format(request)
+    except ValueError as e:
+        return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    return export_products(
+        request, job.search_query, job.search_query.search_term, job.pages_required, export_options, export_format,
+        async_stream,
+    )
+
+
+# --- Batch Helpers ---
+
+def parse_batch_terms(data):
+    """
+    {search_term: pages_required} of a batch request body such as
+    {"terms": [{"search_term": "iphone", "pages_required": 3}, ...]}. Terms
+    are normalized (normalize_search_term()), and a term given twice keeps
+    its largest page count.
+    Raises ValueError with a message for the client.
+    """
+    terms = data.get('terms') if isinstance(data, dict) else None
+    if not isinstance(terms, list) or not terms:
+        raise ValueError("'terms' must be a non-empty list of {\"search_term\": ..., \"pages_required\": ...} objects.")
+    if len(terms) > settings.BATCH_MAX_TERMS:
+        raise ValueError(f"A batch takes at most {settings.BATCH_MAX_TERMS} terms.")
+
+    pages_by_term = {}
+    for entry in terms:
+        if not isinstance(entry, dict) or not isinstance(entry.get('search_term'), str):
+            raise ValueError("Every entry of 'terms' needs a 'search_term'.")
+        search_term = normalize_search_term(entry['search_term'])
+        if not search_term:
+            raise ValueError("Every entry of 'terms' needs a 'search_term'.")
+        pages_required = entry.get('pages_required')
+        if isinstance(pages_required, str) and pages_required.isdigit():
+            pages_required = int(pages_required)
+        if not isinstance(pages_required, int) or isinstance(pages_required, bool) or pages_required <= 0:
+            raise ValueError(f"'pages_required' of '{search_term}' must be a positive integer.")
+        pages_by_term[search_term] = max(pages_by_term.get(search_term, 0), pages_required)
+    return pages_by_term
+
+
+def open_batch(pages_by_term):
+    """
+    (search_query, pages_required) targets of a batch, in request order. The
+    stored coverage of every term is read at once and missing terms are
+    created together: a few queries whatever the number of terms.
+    """
+    search_queries = SearchQuery.objects.in_bulk(list(pages_by_term), field_name='search_term')
+    missing = [search_term for search_term in pages_by_term if search_term not in search_queries]
+    if missing:
+        # ignore_conflicts: a concurrent request may create the same terms
+        SearchQuery.objects.bulk_create([SearchQuery(search_term=term) for term in missing], ignore_conflicts=True)
+        search_queries.update(SearchQuery.objects.in_bulk(missing, field_name='search_term'))
+    record_requests(search_queries.values())
+    return [(search_queries[search_term], pages) for search_term, pages in pages_by_term.items()]
+
+
+def export_batch(targets, options, export_format, async_stream=False):
+    """
+    One export of the stored products of every (search_query, pages_required)
+    target, with a leading search_term column. Rows are grouped by term and
+    ordered within each term by `options` (see parse_export_options()).
+    """
+    in_pages = Q()
+    for search_query, pages_required in targets:
+        last_page = min(pages_required, search_query.max_page_scraped)
+        if last_page > 0:
+            in_pages |= Q(search_query=search_query, page__lte=last_page)
+    products = Product.objects.filter(in_pages) if in_pages else Product.objects.none()
+    products = filter_products(products, options).annotate(search_term=F('search_query__search_term'))
+    products = products.order_by('search_query_id', *SORT_ORDERS[options['sort']])
+
+    EXPORT_REQUESTS.labels(export_format.name, 'batch').inc()
+    filename = f"products_batch_{len(targets)}_terms.{export_format.extension}"
+    return batch_export_response(products, BATCH_EXPORT_FIELDS, export_format, filename, async_stream)
+
+
+# --- API Views ---
 
 class ProductDataView(APIView):
     """
     API endpoint to retrieve product data for a search term.
 
-    Requires 'search_term' and 'pages_required' query parameters.
+    Requires 'search_term' and 'pages_required' query parameters. Optional
+    'min_price' / 'max_price' (pesos) and 'sort' ('page', 'price' or
+    '-price') filter and order the export. The format is CSV unless
+    '?format=' or the Accept header asks for csv.gz, ndjson, parquet or arrow.
     If data is not available or insufficient in the DB, it triggers
     the scraping process, stores the results, and then returns
-    the data as a CSV file.
+    the data as a file.
+
+    With 'async=true' (or SCRAPE_JOBS_ASYNC enabled) missing pages are not
+    scraped inside the request: a scrape job is queued and a 202 response
+    with the job id and its status URL is returned instead.
+
+    With 'progressive=true' (csv, csv.gz or ndjson, sorted by page) the stored
+    pages are streamed right away and each missing page is appended once it
+    is scraped, whatever the job setting (see progressive.py).
     """
+    # '?format=' and Accept select the export format, not a DRF renderer
+    content_negotiation_class = ExportContentNegotiation
 
     def get(self, request, *args, **kwargs):
-        search_term = request.query_params.get('search_term')
-        pages_required_str = request.query_params.get('pages_required')
+        try:
+            search_term, pages_required, export_options, export_format = parse_product_params(request)
+            progressive = wants_progressive(request, export_options, export_format)
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        # --- Data Fetching/Scraping Logic ---
+        try:
+            search_query = open_search_query(search_term)
+            if progressive:
+                return progressive_export(search_query, search_term, pages_required, export_options, export_format)
+
+            # Pages past the last page of results the term is known to have are not even queued
+            if search_query.max_page_scraped < search_query.reachable_pages(pages_required):
+                if wants_scrape_job(request):
+                    job_response = queue_scrape_job(request, search_query, pages_required)
+                    if job_response is not None:
+                        return job_response
+                else:
+                    # Missing pages are fetched concurrently and stored as they arrive
+                    scrape_missing_pages(search_query, pages_required)
+
+            return export_products(request, search_query, search_term, pages_required, export_options, export_format)
+
+        except Exception:
+            # Catch any unexpected errors during the process
+            logger.exception("Unexpected error in ProductDataView", extra={'search_term': search_term})
+            return Response({"error": "An internal server error occurred."}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+class ProductBatchView(APIView):
+    """
+    Export of many search terms in one request, for bulk jobs.
+
+    POST a JSON body {"terms": [{"search_term": "iphone", "pages_required": 3},
+    ...]} (up to BATCH_MAX_TERMS terms). The stored pages of all the terms
+    are looked up together and the missing pages of every term are scraped
+    through one shared fetch pool (BATCH_SCRAPE_CONCURRENCY pages at a time,
+    within the scraper rate limit). A single export with a leading
+    search_term column is streamed back, grouped by term. Format, price
+    filters and sort order are the query parameters of ProductDataView.
+    Always scrapes inside the request, whatever SCRAPE_JOBS_ASYNC says.
+    """
+    content_negotiation_class = ExportContentNegotiation
 
+    def post(self, request, *args, **kwargs):
+        try:
+            pages_by_term = parse_batch_terms(request.data)
+            export_options = parse_export_options(request.GET)
+            export_format = negotiate_export_format(request)
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            targets = open_batch(pages_by_term)
+            scrape_missing_pages_batch(targets, settings.BATCH_SCRAPE_CONCURRENCY)
+            return export_batch(targets, export_options, export_format)
+        except Exception:
+            logger.exception("Unexpected error in ProductBatchView", extra={'terms': len(pages_by_term)})
+            return Response({"error": "An internal server error occurred."}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+class ProductListView(APIView):
+    """
+    Stored products of a search term as JSON, a page of rows at a time.
+
+    Requires 'search_term'. Optional filters: 'page_min' / 'page_max' (listing
+    pages), 'min_price' / 'max_price' (pesos); 'sort' is 'page' (default),
+    'price' or '-price' (price sorts leave out rows without a price);
+    'fields' is a comma-separated list of the product fields to return.
+    Results are paginated with a keyset cursor ('next' link, 'page_size' up
+    to 500), so deep pages cost the same as the first one. Never scrapes.
+    """
+    # (page, id) is served by product_export_idx, (price_amount, id) by product_price_idx
+    KEYSET_ORDERS = {
+        'page': ('page', 'id'),
+        'price': ('price_amount', 'id'),
+        '-price': ('-price_amount', '-id'),
+    }
+
+    def parse_page(self, name):
+        value = self.request.query_params.get(name)
+        if not value:
+            return None
+        try:
+            page = int(value)
+        except ValueError:
+            page = 0
+        if page <= 0:
+            raise ValueError(f"'{name}' must be a positive integer.")
+        return page
+
+    def parse_fields(self):
+        value = self.request.query_params.get('fields')
+        if not value:
+            return None
+        fields = [name.strip() for name in value.split(',') if name.strip()]
+        unknown = [name for name in fields if name not in ProductSerializer().fields]
+        if unknown:
+            raise ValueError(f"Unknown field(s) in 'fields': {', '.join(unknown)}.")
+        return fields
+
+    def get(self, request, *args, **kwargs):
+        search_term = normalize_search_term(request.query_params.get('search_term') or '')
         if not search_term:
             return Response({"error": "'search_term' query parameter is required."}, status=status.HTTP_400_BAD_REQUEST)
 
-        if not pages_required_str:
-            return Response({"error": "'pages_required' query parameter is required."}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            options = parse_export_options(request.query_params)
+            page_min = self.parse_page('page_min') or 1
+            page_max = self.parse_page('page_max')
+            fields = self.parse_fields()
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        search_query = get_object_or_404(SearchQuery, search_term=search_term)
+        # Like the CSV export, only pages known to be complete are served
+        last_page = search_query.max_page_scraped if page_max is None else min(page_max, search_query.max_page_scraped)
+
+        products = Product.objects.filter(search_query=search_query, page__gte=page_min, page__lte=last_page)
+        products = filter_products(products, options)
+        if options['sort'] != 'page':
+            products = products.filter(price_amount__isnull=False)
+        ordering = self.KEYSET_ORDERS[options['sort']]
+        products = products.order_by(*ordering)
+        if fields is not None:
+            # Read only the columns sent, plus the ones the cursor is built from
+            products = products.only(*fields, *(name.lstrip('-') for name in ordering))
+
+        paginator = KeysetPagination()
+        rows = paginator.paginate_queryset(products, request, view=self)
+        serializer = ProductSerializer(rows, many=True, fields=fields)
+        return paginator.get_paginated_response(serializer.data)
+
 
+class ProductSearchView(APIView):
+    """
+    Full-text search over the titles of every stored product, whatever term
+    scraped it, most relevant first (see api/search.py). Never scrapes.
+
+    Requires 'q'. Optional filters: 'min_price' / 'max_price' (pesos). Each
+    result has the 'search_term' it was stored for and its 'rank'. Results
+    are paginated by offset ('next' link, 'page_size' up to 500): relevance
+    has no index to seek on, and deep pages of a search are rarely read.
+    """
+    page_size = 50
+    max_page_size = 500
+
+    def parse_int(self, name, default, minimum, maximum=None):
+        value = self.request.query_params.get(name)
+        if not value:
+            return default
         try:
-            pages_required = int(pages_required_str)
-            if pages_required <= 0:
-                raise ValueError("Pages required must be positive.")
+            number = int(value)
         except ValueError:
-            return Response({"error": "'pages_required' must be a positive integer."}, status=status.HTTP_400_BAD_REQUEST)
+            raise ValueError(f"'{name}' must be an integer.")
+        return max(number, minimum) if maximum is None else min(max(number, minimum), maximum)
 
-        # --- Data Fetching/Scraping Logic ---
+    def get(self, request, *args, **kwargs):
+        query = request.query_params.get('q', '')
+        if not query.strip():
+            return Response({"error": "'q' query parameter is required."}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            options = parse_export_options(request.query_params)
+            page_size = self.parse_int('page_size', self.page_size, 1, self.max_page_size)
+            offset = self.parse_int('offset', 0, 0)
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        # One extra row tells whether there is a next page
+        products = search_products(
+            query, limit=page_size + 1, offset=offset,
+            min_price=options.get('min_price'), max_price=options.get('max_price'),
+        )
+        next_url = None
+        if len(products) > page_size:
+            next_url = replace_query_param(request.build_absolute_uri(), 'offset', offset + page_size)
+        serializer = ProductSearchSerializer(products[:page_size], many=True)
+        return Response({'next': next_url, 'results': serializer.data})
+
+
+class ProductStatusView(APIView):
+    """
+    Pages of a term stored so far, out of 'pages_required': what a
+    progressive export of ProductDataView could not put in its body. Never
+    scrapes; 404 for a term that was never requested.
+
+    'pages_reachable' is 'pages_required' capped at the last page of results
+    of the term, when known (see SearchQuery.reachable_pages): the stored
+    pages are complete once 'pages_complete' reaches it.
+    """
+
+    def get(self, request, *args, **kwargs):
+        try:
+            search_term, pages_required = parse_term_params(request)
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        search_query = get_object_or_404(SearchQuery, search_term=search_term)
+        return Response({
+            'search_term': search_term,
+            'pages_complete': min(search_query.max_page_scraped, pages_required),
+            'pages_requested': pages_required,
+            'pages_reachable': search_query.reachable_pages(pages_required),
+        })
+
+
+class ScrapeJobStatusView(APIView):
+    """Progress of a queued scrape job, as returned by ProductDataView in async mode."""
+
+    def get(self, request, pk, *args, **kwargs):
+        job = get_object_or_404(ScrapeJob.objects.select_related('search_query'), pk=pk)
+        return Response(ScrapeJobSerializer(job, context={'request': request}).data)
+
+
+class ScrapeJobDownloadView(APIView):
+    """Export of a finished scrape job, in any of the formats of ProductDataView."""
+    content_negotiation_class = ExportContentNegotiation
+
+    def get(self, request, pk, *args, **kwargs):
+        job = get_object_or_404(ScrapeJob.objects.select_related('search_query'), pk=pk)
+        return export_job(request, job)
+
+
+class MetricsView(APIView):
+    """
+    Counters and latency histograms of this process in the Prometheus text
+    format: fetch, parse and DB write times, export render times and cache
+    results (see api/metrics.py and scraping/metrics.py).
+    """
+
+    def get(self, request, *args, **kwargs):
+        return HttpResponse(render_metrics(), content_type=CONTENT_TYPE)
+
+
+# --- Async Views ---
+
+def plain_response(response):
+    """
+    Response of the shared helpers, for an async view: DRF Responses (JSON
+    errors, 202s) become JsonResponses, since DRF only renders them in APIViews.
+    """
+    if isinstance(response, Response):
+        return JsonResponse(response.data, status=response.status_code)
+    return response
+
+
+class AsyncProductDataView(View):
+    """
+    ProductDataView as a native async view, for ASGI servers (uvicorn).
+
+    Same parameters and responses. Missing pages are fetched on the event
+    loop (see ingest.scrape_missing_pages_async()) and the export is streamed
+    from an async iterator, so a slow scrape holds a coroutine rather than a
+    worker: one process serves hundreds of them at once.
+    """
+
+    async def get(self, request, *args, **kwargs):
         try:
-            search_query, created = SearchQuery.objects.get_or_create(
-                search_term=search_term.lower() # Store search terms consistently
+            search_term, pages_required, export_options, export_format = parse_product_params(request)
+            progressive = wants_progressive(request, export_options, export_format)
+        except ValueError as e:
+            return JsonResponse({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            search_query = await run_db(open_search_query, search_term)
+            if progressive:
+                return progressive_export(
+                    search_query, search_term, pages_required, export_options, export_format, async_stream=True,
+                )
+
+            if search_query.max_page_scraped < search_query.reachable_pages(pages_required):
+                if wants_scrape_job(request):
+                    job_response = await run_db(queue_scrape_job, request, search_query, pages_required)
+                    if job_response is not None:
+                        return plain_response(job_response)
+                else:
+                    await scrape_missing_pages_async(search_query, pages_required)
+
+            response = await run_db(
+                export_products,
+                request, search_query, search_term, pages_required, export_options, export_format, async_stream=True,
             )
+            return plain_response(response)
 
-            pages_to_scrape = []
-            if search_query.max_page_scraped < pages_required:
-                pages_to_scrape = range(search_query.max_page_scraped + 1, pages_required + 1)
-
-            if pages_to_scrape:
-                print(f"Scraping required for '{search_term}' pages {pages_to_scrape.start} to {pages_to_scrape.stop - 1}")
-                max_page_successfully_scraped = search_query.max_page_scraped
-
-                with transaction.atomic(): # Ensure DB operations are atomic per request
-                    for page_num in pages_to_scrape:
-                        print(f"Scraping page {page_num} for '{search_term}'...")
-                        try:
-                            # Add a small delay between requests
-                            time.sleep(1)
-                            scraped_data = search_mercadolibre(search_term, page_num)
-
-                            # --- Debug Print ---
-                            print(f"Scraper returned for page {page_num}: {type(scraped_data)}, Length: {len(scraped_data) if isinstance(scraped_data, list) else 'N/A'}")
-                            if isinstance(scraped_data, list) and len(scraped_data) > 0:
-                                print(f"First item sample: {scraped_data[0]}")
-                            # --- End Debug Print ---
-
-                            if not scraped_data:
-                                print(f"No data returned from scraper for page {page_num}. Stopping scrape for this request.")
-                                # Don't update max_page_scraped beyond the last successful page
-                                break # Stop trying to scrape further pages for this request
-
-                            products_to_create = []
-                            for item in scraped_data:
-                                # Basic validation/cleaning could happen here if needed
-                                products_to_create.append(
-                                    Product(
-                                        search_query=search_query,
-                                        page=page_num,
-                                        title=item.get('title', 'N/A'),
-                                        price=item.get('price', 'N/A'),
-                                        seller=item.get('seller'),
-                                        reviews=item.get('reviews'),
-                                        image_url=item.get('image_url')
-                                    )
-                                )
-
-                            if products_to_create:
-                                # Use bulk_create for efficiency
-                                # ignore_conflicts=True handles the unique_together constraint gracefully
-                                # if an identical product is scraped again (e.g., during updates)
-                                Product.objects.bulk_create(products_to_create, ignore_conflicts=True)
-                                print(f"Stored {len(products_to_create)} products from page {page_num}.")
-                                max_page_successfully_scraped = page_num # Update highest successful page
-                            else:
-                                # If scraper returns empty list but no error, still treat as end of results
-                                print(f"Scraper returned empty list for page {page_num}. Assuming no more results.")
-                                break
-
-                        except Exception as e:
-                            # Catch exceptions during scraping/saving for a specific page
-                            print(f"Error scraping or saving page {page_num} for '{search_term}': {e}")
-                            # Decide if you want to stop entirely or just skip this page
-                            # For now, we stop scraping further for this request on error
-                            break
-
-                    # Update SearchQuery only after attempting all required pages
-                    if max_page_successfully_scraped > search_query.max_page_scraped:
-                        search_query.max_page_scraped = max_page_successfully_scraped
-                        # Update last_updated timestamp implicitly via auto_now=True
-                        # or explicitly: search_query.last_updated = timezone.now()
-                        search_query.save()
-                        print(f"Updated max_page_scraped for '{search_term}' to {max_page_successfully_scraped}")
-
-            # --- Retrieve Data for CSV ---
-            # Fetch products up to the number of pages required OR the max successfully scraped
-            final_max_page = min(pages_required, search_query.max_page_scraped)
-            products = Product.objects.filter(
-                search_query=search_query,
-                page__lte=final_max_page
-            ).order_by('page', 'id') # Order consistently for CSV
-
-            if not products.exists():
-                 return Response({"message": f"No products found for '{search_term}' up to page {final_max_page} after attempting scrape."}, status=status.HTTP_404_NOT_FOUND)
-
-
-            # --- Generate CSV Response ---
-            output = io.StringIO()
-            writer = csv.writer(output)
-
-            # Define header row
-            header = ['page', 'title', 'price', 'seller', 'reviews', 'image_url']
-            writer.writerow(header)
-
-            # Write data rows
-            for product in products.values_list('page', 'title', 'price', 'seller', 'reviews', 'image_url'):
-                 writer.writerow(product)
-
-            output.seek(0)
-            response = HttpResponse(output, content_type='text/csv')
-            response['Content-Disposition'] = f'attachment; filename="products_{search_term}_pages_1_to_{final_max_page}.csv"'
-            return response
-
-        except Exception as e:
-            # Catch any unexpected errors during the process
-            print(f"Unexpected error in ProductDataView: {e}") # Log this properly
-            return Response({"error": "An internal server error occurred."}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        except Exception:
+            logger.exception("Unexpected error in AsyncProductDataView", extra={'search_term': search_term})
+            return JsonResponse({"error": "An internal server error occurred."}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+class AsyncScrapeJobDownloadView(View):
+    """ScrapeJobDownloadView for ASGI servers: the export is streamed from an async iterator."""
+
+    async def get(self, request, pk, *args, **kwargs):
+        job = await run_db(ScrapeJob.objects.select_related('search_query').filter(pk=pk).first)
+        if job is None:
+            return JsonResponse({"detail": "No ScrapeJob matches the given query."}, status=status.HTTP_404_NOT_FOUND)
+        return plain_response(await run_db(export_job, request, job, async_stream=True))
+
+
+@method_decorator(csrf_exempt, name='dispatch') # An API for scripts, like the DRF views
+class AsyncProductBatchView(View):
+    """ProductBatchView for ASGI servers: pages are fetched on the event loop and the export is an async iterator."""
+
+    async def post(self, request, *args, **kwargs):
+        try:
+            data = json.loads(request.body or b'null')
+        except ValueError:
+            return JsonResponse({"error": "The request body must be JSON."}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            pages_by_term = parse_batch_terms(data)
+            export_options = parse_export_options(request.GET)
+            export_format = negotiate_export_format(request)
+        except ValueError as e:
+            return JsonResponse({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            targets = await run_db(open_batch, pages_by_term)
+            await scrape_missing_pages_batch_async(targets, settings.BATCH_SCRAPE_CONCURRENCY)
+            return export_batch(targets, export_options, export_format, async_stream=True)
+        except Exception:
+            logger.exception("Unexpected error in AsyncProductBatchView", extra={'terms': len(pages_by_term)})
+            return JsonResponse({"error": "An internal server error occurred."}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
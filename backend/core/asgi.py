@@ -12,5 +12,7 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'core.settings')
+# Makes ASGI_VIEWS default to True, so scrapes and exports run as coroutines (see settings.py)
+os.environ['SERVED_BY_ASGI'] = 'True'
 
 application = get_asgi_application()
@@ -117,6 +117,118 @@ else:
 # <--- END MODIFY SECTION
 
 
+# Scraper settings
+# Number of listing pages fetched in parallel for a single request
+SCRAPER_CONCURRENCY = int(os.getenv('SCRAPER_CONCURRENCY', '4'))
+# The outgoing request rate (SCRAPER_RATE, SCRAPER_BURST, SCRAPER_RATE_FILE) is read
+# from the environment by scraping/fetcher.py, since the scraper does not depend on Django
+# Seconds after which a page claim that is still fetching is considered abandoned
+PAGE_CLAIM_TTL = int(os.getenv('PAGE_CLAIM_TTL', '120'))
+# Seconds during which a page another run stored or found empty is reused instead of fetched again
+PAGE_CLAIM_REUSE_TTL = int(os.getenv('PAGE_CLAIM_REUSE_TTL', '900'))
+# Seconds during which the result count of a term (read from its listing pages) caps the pages
+# scraped for it; older counts are ignored until a page of the term is fetched again
+RESULT_COUNT_MAX_AGE = int(os.getenv('RESULT_COUNT_MAX_AGE', '86400'))
+# Serve /api/products and job downloads with the async views. On by default when served by
+# core.asgi (uvicorn), off under WSGI (gunicorn sync workers, runserver)
+ASGI_VIEWS = os.getenv('ASGI_VIEWS', os.getenv('SERVED_BY_ASGI', 'False')) == 'True'
+# DB steps of the async views running at once per process; each holds a connection only while it runs
+ASGI_DB_CONNECTIONS = int(os.getenv('ASGI_DB_CONNECTIONS', '10'))
+# Exports streamed at once per process by the async views; each holds a connection until its download ends
+ASGI_EXPORT_CONNECTIONS = int(os.getenv('ASGI_EXPORT_CONNECTIONS', '4'))
+
+# Batch export (POST /api/products/batch) settings
+# Most search terms accepted in one batch request
+BATCH_MAX_TERMS = int(os.getenv('BATCH_MAX_TERMS', '500'))
+# Pages fetched in parallel for a batch; all its terms share this pool, and the rate limit still applies
+BATCH_SCRAPE_CONCURRENCY = int(os.getenv('BATCH_SCRAPE_CONCURRENCY', '16'))
+
+# Scrape job settings
+# Queue a scrape job (202 + polling) instead of scraping inside the request by default
+SCRAPE_JOBS_ASYNC = os.getenv('SCRAPE_JOBS_ASYNC', 'False') == 'True'
+# A running job whose worker sent no heartbeat for this many seconds is picked up again
+SCRAPE_JOB_STALE_AFTER = int(os.getenv('SCRAPE_JOB_STALE_AFTER', '300'))
+# Seconds during which a finished job counts as an attempt, so short terms are not re-queued forever
+SCRAPE_JOB_RETRY_AFTER = int(os.getenv('SCRAPE_JOB_RETRY_AFTER', '3600'))
+
+# Ingest settings
+# On Postgres, write scraped pages with COPY into a staging table and one merge statement
+INGEST_USE_COPY = os.getenv('INGEST_USE_COPY', 'True') == 'True'
+
+# Refresh (update_products) settings
+# Pages of a term leased and refreshed together by one worker
+REFRESH_UNIT_PAGES = int(os.getenv('REFRESH_UNIT_PAGES', '5'))
+# Seconds a refresh lease lasts without a heartbeat before another host may take the unit over
+REFRESH_LEASE_SECONDS = int(os.getenv('REFRESH_LEASE_SECONDS', '300'))
+
+# Retention (compact_storage) settings; 0 keeps the rows forever
+# Days a product may go unlisted, once its term was fully refreshed since, before it is deleted
+PRODUCT_RETENTION_DAYS = int(os.getenv('PRODUCT_RETENTION_DAYS', '30'))
+# Days of price changes kept; the product row always keeps the latest price
+PRICE_HISTORY_RETENTION_DAYS = int(os.getenv('PRICE_HISTORY_RETENTION_DAYS', '365'))
+# Days finished scrape jobs are kept after they end
+SCRAPE_JOB_RETENTION_DAYS = int(os.getenv('SCRAPE_JOB_RETENTION_DAYS', '7'))
+# Rows deleted per transaction, and primary keys scanned per batch
+COMPACTION_BATCH_SIZE = int(os.getenv('COMPACTION_BATCH_SIZE', '5000'))
+
+# Export settings
+# Rows fetched per round trip by the server-side cursor used for CSV exports
+EXPORT_CHUNK_SIZE = int(os.getenv('EXPORT_CHUNK_SIZE', '2000'))
+# Rendered exports larger than this are streamed but not cached
+EXPORT_CACHE_MAX_BYTES = int(os.getenv('EXPORT_CACHE_MAX_BYTES', str(20 * 1024 * 1024)))
+
+
+# Caches
+# https://docs.djangoproject.com/en/5.2/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # Rendered exports. File based so every gunicorn worker shares them; keys embed
+    # SearchQuery.last_updated, so stale entries are never served and simply expire.
+    'exports': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.getenv('EXPORT_CACHE_DIR', str(BASE_DIR / '.export_cache')),
+        'TIMEOUT': int(os.getenv('EXPORT_CACHE_TIMEOUT', '86400')),
+        'OPTIONS': {
+            'MAX_ENTRIES': int(os.getenv('EXPORT_CACHE_MAX_ENTRIES', '500')),
+        },
+    },
+}
+
+
+# Logging
+# https://docs.djangoproject.com/en/5.2/topics/logging/
+
+# Level of the application and scraper loggers (DEBUG also logs every page fetched and parsed)
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+# 'text' for people, 'json' for one JSON object per line (with the search term, page, etc. as fields)
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text')
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'text': {'format': '%(asctime)s %(levelname)s %(name)s: %(message)s'},
+        'json': {'()': 'core.log_format.JsonFormatter'},
+    },
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler', 'formatter': LOG_FORMAT},
+    },
+    # The scraper modules log under their own names (scraper, fetcher, ...), so everything goes through the root
+    'root': {'handlers': ['console'], 'level': LOG_LEVEL},
+    'loggers': {
+        'django': {'handlers': ['console'], 'level': 'INFO', 'propagate': False},
+    },
+}
+
+# Metrics
+# Port of the Prometheus endpoint served by worker commands (run_scrape_jobs); 0 disables it.
+# Web processes serve theirs at /api/metrics.
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
 
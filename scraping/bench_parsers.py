@@ -0,0 +1,46 @@
+"""
+Micro-benchmark for the listing page parsers.
+
+Times each available backend on the saved fixture pages. That they all
+give the same output is checked by the test suite (backend/api/tests.py).
+
+Usage: python bench_parsers.py [--rounds N]
+"""
+import argparse
+import time
+from pathlib import Path
+
+from parsers import available_parsers, get_parser
+
+FIXTURES_DIR = Path(__file__).resolve().parent / 'fixtures'
+
+
+def time_parser(parser, pages, rounds):
+    """Best-of-`rounds` average parse time per page, in milliseconds."""
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for html in pages:
+            list(parser.iter_items(html))
+        elapsed = (time.perf_counter() - start) / len(pages)
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1000
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    arg_parser.add_argument('--rounds', type=int, default=20)
+    args = arg_parser.parse_args()
+
+    fixtures = sorted(FIXTURES_DIR.glob('*.html'))
+    pages = [path.read_text(encoding='utf-8') for path in fixtures]
+
+    baseline = None
+    for name in available_parsers():
+        per_page = time_parser(get_parser(name), pages, args.rounds)
+        baseline = baseline or per_page
+        print(f"{name:>6}: {per_page:8.2f} ms/page  ({baseline / per_page:.1f}x vs soup)")
+
+
+if __name__ == '__main__':
+    main()
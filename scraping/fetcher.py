@@ -0,0 +1,247 @@
+import asyncio
+import os
+import threading
+import time
+import weakref
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import Counter, Histogram
+
+try:
+    import fcntl
+except ImportError: # Windows: no file locks, only the in-process limiter is available
+    fcntl = None
+
+try:
+    import httpx
+except ImportError: # httpx is optional, only the async fetcher needs it
+    httpx = None
+
+FETCH_SECONDS = Histogram(
+    'scraper_fetch_seconds', 'Time of listing page requests, by HTTP status or exception name.', ['status'],
+)
+FETCH_BYTES = Counter('scraper_fetch_bytes_total', 'Bytes of listing page bodies received.')
+RATE_LIMIT_WAIT_SECONDS = Histogram(
+    'scraper_rate_limit_wait_seconds', 'Time requests waited for the rate limiter before being sent.',
+)
+
+DEFAULT_HEADERS = {
+    'User-Agent': (
+        'Mozilla/5.0 (Windows NT 10.0; Win64; x64) '
+        'AppleWebKit/537.36 (KHTML, like Gecko) Chrome/136.0.0.0 Safari/537.36'
+    )
+}
+
+
+class TokenBucket:
+    """
+    Thread-safe token-bucket rate limiter.
+
+    Allows `rate` requests per second on average, with bursts of up to
+    `capacity` requests. `acquire()` blocks until a token is available.
+    """
+    # True when _take() does blocking I/O, which acquire_async() must keep off the event loop
+    take_blocks = False
+
+    def __init__(self, rate, capacity=1):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, tokens, last, now):
+        return min(self.capacity, tokens + (now - last) * self.rate)
+
+    def _take(self):
+        """Take a token if one is available. Returns the seconds to wait otherwise."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = self._refill(self._tokens, self._last, now)
+            self._last = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) / self.rate
+
+    def acquire(self):
+        while True:
+            wait = self._take()
+            if not wait:
+                return
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        """acquire() for coroutines: waits on the event loop instead of blocking the thread."""
+        while True:
+            wait = await asyncio.to_thread(self._take) if self.take_blocks else self._take()
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+
+class FileTokenBucket(TokenBucket):
+    """
+    Token bucket whose state lives in a locked file, so every process on the
+    host (e.g. all gunicorn workers and the cron job) shares one request budget.
+    """
+    take_blocks = True # flock() waits on other processes
+
+    def __init__(self, path, rate, capacity=1):
+        super().__init__(rate, capacity)
+        self.path = path
+
+    def _take(self):
+        # The thread lock keeps threads of this process from racing on the
+        # same file descriptor; flock serializes across processes.
+        with self._lock, open(self.path, 'a+') as fh:
+            fcntl.flock(fh, fcntl.LOCK_EX)
+            fh.seek(0)
+            try:
+                tokens, last = (float(value) for value in fh.read().split())
+            except ValueError: # New or corrupted state file, start full
+                tokens, last = self.capacity, time.time()
+
+            now = time.time()
+            tokens = self._refill(tokens, last, now)
+            wait = 0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / self.rate
+
+            fh.seek(0)
+            fh.truncate()
+            fh.write(f'{tokens} {now}')
+            return wait
+
+
+class Fetcher:
+    """
+    Shared HTTP client for listado.mercadolibre.com.co.
+
+    Keeps connections alive in a pooled `requests.Session` and sends every
+    request through a rate limiter, so callers never need to sleep themselves.
+    """
+
+    def __init__(self, limiter, pool_size=10, timeout=10, headers=None):
+        self.limiter = limiter
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers.update(headers or DEFAULT_HEADERS)
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, pool_block=True)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def get(self, url):
+        started = time.perf_counter()
+        self.limiter.acquire()
+        sent = time.perf_counter()
+        RATE_LIMIT_WAIT_SECONDS.observe(sent - started)
+        try:
+            response = self.session.get(url, timeout=self.timeout)
+        except requests.RequestException as e:
+            FETCH_SECONDS.labels(type(e).__name__).observe(time.perf_counter() - sent)
+            raise
+        FETCH_SECONDS.labels(response.status_code).observe(time.perf_counter() - sent)
+        FETCH_BYTES.inc(len(response.content))
+        response.raise_for_status()
+        return response
+
+
+class AsyncFetcher:
+    """
+    Fetcher for coroutines, on an `httpx.AsyncClient` with pooled keep-alive
+    connections. A request waiting on MercadoLibre or on the rate limiter
+    holds no thread, so one process can have hundreds of them in flight.
+    The client belongs to the event loop it was created on.
+    """
+
+    def __init__(self, limiter, pool_size=10, timeout=10, headers=None):
+        self.limiter = limiter
+        self.client = httpx.AsyncClient(
+            # Like pool_block in Fetcher, waiting for a free connection has no time limit
+            headers=headers or DEFAULT_HEADERS, timeout=httpx.Timeout(timeout, pool=None), follow_redirects=True,
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+        )
+
+    async def get(self, url):
+        started = time.perf_counter()
+        await self.limiter.acquire_async()
+        sent = time.perf_counter()
+        RATE_LIMIT_WAIT_SECONDS.observe(sent - started)
+        try:
+            response = await self.client.get(url)
+        except httpx.HTTPError as e:
+            FETCH_SECONDS.labels(type(e).__name__).observe(time.perf_counter() - sent)
+            raise
+        FETCH_SECONDS.labels(response.status_code).observe(time.perf_counter() - sent)
+        FETCH_BYTES.inc(len(response.content))
+        response.raise_for_status()
+        return response
+
+
+# Errors of a failed page request, from either fetcher
+HTTP_ERRORS = (requests.RequestException,) if httpx is None else (requests.RequestException, httpx.HTTPError)
+
+
+def limiter_from_env():
+    """
+    Build the request limiter from environment variables.
+
+    SCRAPER_RATE (requests per second) and SCRAPER_BURST set the budget.
+    If SCRAPER_RATE_FILE is set, the budget is shared by every process using that file.
+    """
+    rate = float(os.getenv('SCRAPER_RATE', '2'))
+    burst = float(os.getenv('SCRAPER_BURST', '4'))
+    rate_file = os.getenv('SCRAPER_RATE_FILE')
+    if rate_file and fcntl is not None:
+        return FileTokenBucket(rate_file, rate, burst)
+    return TokenBucket(rate, burst)
+
+
+_default_limiter = None
+_default_fetcher = None
+_async_fetchers = weakref.WeakKeyDictionary() # event loop -> AsyncFetcher
+_default_fetcher_lock = threading.Lock()
+
+
+def _fetcher_options():
+    return {
+        'pool_size': int(os.getenv('SCRAPER_POOL_SIZE', '10')),
+        'timeout': float(os.getenv('SCRAPER_TIMEOUT', '10')),
+    }
+
+
+def _get_default_limiter():
+    # Called with _default_fetcher_lock held
+    global _default_limiter
+    if _default_limiter is None:
+        _default_limiter = limiter_from_env()
+    return _default_limiter
+
+
+def get_default_fetcher():
+    """Process-wide fetcher, created on first use from the environment."""
+    global _default_fetcher
+    with _default_fetcher_lock:
+        if _default_fetcher is None:
+            _default_fetcher = Fetcher(_get_default_limiter(), **_fetcher_options())
+        return _default_fetcher
+
+
+def get_async_fetcher():
+    """
+    AsyncFetcher of the running event loop, sharing the request budget of
+    get_default_fetcher(). None when httpx is not installed.
+    """
+    if httpx is None:
+        return None
+    loop = asyncio.get_running_loop()
+    with _default_fetcher_lock:
+        fetcher = _async_fetchers.get(loop)
+        if fetcher is None:
+            fetcher = _async_fetchers[loop] = AsyncFetcher(_get_default_limiter(), **_fetcher_options())
+        return fetcher
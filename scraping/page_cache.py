@@ -0,0 +1,156 @@
+import gzip
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+
+try:
+    import zstandard
+except ImportError: # zstd is optional, gzip is always available
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_DIR = Path(__file__).resolve().parent / '.page_cache'
+
+
+def _compress(data):
+    if zstandard is not None:
+        return zstandard.ZstdCompressor(level=10).compress(data), '.zst'
+    return gzip.compress(data, compresslevel=6), '.gz'
+
+
+def _decompress(data, suffix):
+    if suffix == '.zst':
+        return zstandard.ZstdDecompressor().decompress(data)
+    return gzip.decompress(data)
+
+
+class PageCache:
+    """
+    Compressed on-disk cache of raw listing page HTML.
+
+    Entries are keyed by a hash of (search term, page offset) and stored as
+    a JSON metadata line followed by the HTML, compressed with zstd when
+    available and gzip otherwise. Entries older than `ttl` seconds are not
+    served to the scraper (but can still be read with `allow_stale=True`,
+    e.g. to re-parse them), and the least recently used entries are evicted
+    once the cache grows past `max_bytes`.
+    """
+
+    def __init__(self, directory, ttl=3600, max_bytes=512 * 1024 * 1024):
+        self.directory = Path(directory)
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._size = None # Total size on disk, computed on first write
+
+    @staticmethod
+    def key(search_term, offset):
+        return hashlib.sha256(f'{search_term}\0{offset}'.encode('utf-8')).hexdigest()
+
+    def _candidates(self, key):
+        base = self.directory / key[:2] / key
+        suffixes = ('.zst', '.gz') if zstandard is not None else ('.gz',)
+        return [base.with_name(key + '.html' + suffix) for suffix in suffixes]
+
+    def get(self, search_term, offset, allow_stale=False):
+        """Return the cached HTML, or None if it is missing or older than the TTL."""
+        for path in self._candidates(self.key(search_term, offset)):
+            try:
+                raw = path.read_bytes()
+            except FileNotFoundError:
+                continue
+            try:
+                header, _, body = _decompress(raw, path.suffix).partition(b'\n')
+                meta = json.loads(header)
+            except Exception as e:
+                logger.warning("Discarding unreadable cache entry %s: %s", path.name, e)
+                path.unlink(missing_ok=True)
+                continue
+
+            if not allow_stale and time.time() - meta['fetched_at'] > self.ttl:
+                return None
+            try:
+                os.utime(path) # Mark as recently used for LRU eviction
+            except FileNotFoundError:
+                pass
+            return body.decode('utf-8')
+        return None
+
+    def put(self, search_term, offset, html, url=None):
+        meta = {'search_term': search_term, 'offset': offset, 'url': url, 'fetched_at': time.time()}
+        data, suffix = _compress(json.dumps(meta).encode('utf-8') + b'\n' + html.encode('utf-8'))
+
+        key = self.key(search_term, offset)
+        path = self.directory / key[:2] / (key + '.html' + suffix)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Write to a temporary file first so readers never see a partial entry
+        tmp_path = path.with_name(f'{path.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+        tmp_path.write_bytes(data)
+        old_size = path.stat().st_size if path.exists() else 0
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            if self._size is not None:
+                self._size += len(data) - old_size
+            if self._size is None or self._size > self.max_bytes:
+                self._evict()
+
+    def _entries(self):
+        for path in self.directory.glob('*/*.html.*'):
+            if path.suffix == '.tmp':
+                continue
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            yield path, stat
+
+    def _evict(self):
+        """Delete least recently used entries until the cache is back under 90% of max_bytes."""
+        entries = sorted(self._entries(), key=lambda entry: entry[1].st_mtime)
+        self._size = sum(stat.st_size for _, stat in entries)
+        target = self.max_bytes * 0.9
+        if self._size <= self.max_bytes:
+            return
+        for path, stat in entries:
+            if self._size <= target:
+                break
+            path.unlink(missing_ok=True)
+            self._size -= stat.st_size
+
+
+def cache_from_env():
+    """
+    Build the page cache from environment variables, or return None if it is disabled.
+
+    SCRAPER_CACHE_DIR sets the directory (empty disables the cache),
+    SCRAPER_CACHE_TTL the freshness in seconds and SCRAPER_CACHE_MAX_MB the size bound.
+    """
+    directory = os.getenv('SCRAPER_CACHE_DIR', str(DEFAULT_CACHE_DIR))
+    if not directory:
+        return None
+    return PageCache(
+        directory,
+        ttl=float(os.getenv('SCRAPER_CACHE_TTL', '3600')),
+        max_bytes=int(float(os.getenv('SCRAPER_CACHE_MAX_MB', '512')) * 1024 * 1024),
+    )
+
+
+_default_cache = None
+_default_cache_loaded = False
+_default_cache_lock = threading.Lock()
+
+
+def get_default_cache():
+    """Process-wide page cache (None when disabled), created on first use."""
+    global _default_cache, _default_cache_loaded
+    with _default_cache_lock:
+        if not _default_cache_loaded:
+            _default_cache = cache_from_env()
+            _default_cache_loaded = True
+        return _default_cache
@@ -0,0 +1,224 @@
+import logging
+import os
+import re
+from dataclasses import dataclass
+
+from bs4 import BeautifulSoup
+
+try:
+    import lxml.html
+    from lxml import etree
+except ImportError: # lxml is optional, the BeautifulSoup parser is always available
+    lxml = None
+
+logger = logging.getLogger(__name__)
+
+# Value stored when a field is missing from a listing item
+FALLBACKS = {
+    'title': 'No title',
+    'price': 'No price',
+    'seller': 'No seller info',
+    'reviews': 'No reviews',
+    'image_url': 'No image',
+}
+
+ITEM_CLASS = 'ui-search-layout__item'
+
+# Item id in a listing link: /MCO-123456789-slug, /p/MCO123456789 or wid=MCO123456789 (ad clicks)
+_LINK_ITEM_ID = re.compile(r'\b(M[A-Z]{2})-?(\d{6,})')
+# Picture id in an image URL: .../D_Q_NP_2X_483452-MLA88220482_092023-E.webp
+_IMAGE_PICTURE_ID = re.compile(r'_(\d+-ML[A-Z]\d+)_')
+
+# Totals of the whole search shown on every listing page: '3.218 resultados' in the header
+# and 'de <!-- -->42' in the pagination (MercadoLibre stops paginating at page 42)
+_RESULT_COUNT = re.compile(r'quantity-results[^>]*>\s*([\d.,]+)')
+_PAGE_COUNT = re.compile(r'pagination__page-count[^>]*>\s*de\s*(?:<!--\s*-->)?\s*(\d+)')
+
+# (field, tag, class) of the first element inside an item that holds each field
+FIELD_SELECTORS = (
+    ('title', 'a', 'poly-component__title'),
+    ('price', 'span', 'andes-money-amount andes-money-amount--cents-superscript'),
+    ('seller', 'span', 'poly-component__seller'),
+    ('reviews', 'span', 'andes-visually-hidden'),
+    ('image_url', 'img', 'poly-component__picture'),
+)
+
+
+@dataclass(slots=True)
+class ListingItem:
+    """
+    One item of a listing page. Slotted: the record takes 80 bytes against
+    272 for the equivalent dict (strings aside).
+    """
+    item_id: str # See extract_item_id()
+    title: str
+    price: str
+    seller: str
+    reviews: str
+    image_url: str
+
+    def as_dict(self):
+        return {
+            'item_id': self.item_id, 'title': self.title, 'price': self.price,
+            'seller': self.seller, 'reviews': self.reviews, 'image_url': self.image_url,
+        }
+
+
+def extract_item_id(link, image_url):
+    """
+    Stable identity of a listing item: the MercadoLibre item id from its link
+    (e.g. 'MCO504285457'), else the picture id from its image URL, else ''.
+    """
+    match = _LINK_ITEM_ID.search(link or '')
+    if match:
+        return match.group(1) + match.group(2)
+    match = _IMAGE_PICTURE_ID.search(image_url or '')
+    if match:
+        return match.group(1)
+    return ''
+
+
+def parse_result_count(html):
+    """
+    (total_results, total_pages) that a listing page reports for the whole
+    search, each None when the page does not show it. A regex on the raw
+    HTML: the same for every backend, and a fraction of a parse.
+    """
+    match = _RESULT_COUNT.search(html)
+    total_results = int(match.group(1).replace('.', '').replace(',', '')) if match else None
+    match = _PAGE_COUNT.search(html)
+    total_pages = int(match.group(1)) if match else None
+    return total_results, total_pages
+
+
+class ListingParser:
+    """
+    Turns the HTML of a MercadoLibre listing page into ListingItem records,
+    with the FALLBACKS value for every field missing from an item.
+    Every backend must give the same output.
+    """
+    name = None
+
+    def iter_items(self, html):
+        """Yield the ListingItem of every item on the page, in page order."""
+        raise NotImplementedError
+
+    def parse(self, html):
+        """The items of the page as a list of dicts (keys of FALLBACKS plus 'item_id')."""
+        return [item.as_dict() for item in self.iter_items(html)]
+
+
+class SoupParser(ListingParser):
+    """Pure-Python BeautifulSoup backend. Slow, but has no extra dependencies."""
+    name = 'soup'
+
+    def iter_items(self, html):
+        soup = BeautifulSoup(html, 'html.parser')
+        for item in soup.find_all('li', class_=ITEM_CLASS):
+            title_tag = item.find('a', class_='poly-component__title')
+            price_tag = item.find('span', class_='andes-money-amount andes-money-amount--cents-superscript')
+            seller_tag = item.find('span', class_='poly-component__seller')
+            reviews_tag = item.find('span', class_='andes-visually-hidden')
+            image_tag = item.find('img', class_='poly-component__picture')
+
+            image_url = image_tag.get('src') if image_tag and image_tag.has_attr('src') else FALLBACKS['image_url']
+            yield ListingItem(
+                item_id=extract_item_id(title_tag.get('href') if title_tag else None, image_url),
+                title=title_tag.get_text(strip=True) if title_tag else FALLBACKS['title'],
+                price=price_tag.get_text(strip=True) if price_tag else FALLBACKS['price'],
+                seller=seller_tag.get_text(strip=True) if seller_tag else FALLBACKS['seller'],
+                reviews=reviews_tag.get_text(strip=True) if reviews_tag else FALLBACKS['reviews'],
+                image_url=image_url,
+            )
+
+
+# tag -> [(field, class), ...] so each element is only checked against its own tag
+_SELECTORS_BY_TAG = {}
+for _field, _tag, _class in FIELD_SELECTORS:
+    _SELECTORS_BY_TAG.setdefault(_tag, []).append((_field, _class))
+
+if lxml is not None:
+    _FIND_ITEMS = etree.XPath(
+        f"//li[contains(concat(' ', normalize-space(@class), ' '), ' {ITEM_CLASS} ')]"
+    )
+    # BeautifulSoup's get_text() leaves out comments and script/style contents
+    _TEXT_NODES = etree.XPath('.//text()[not(parent::script or parent::style or parent::template)]')
+
+
+def _class_matches(class_attr, wanted):
+    # Same rule as BeautifulSoup's class_ filter: either one of the classes
+    # equals `wanted`, or the whole (whitespace-normalized) attribute does.
+    classes = class_attr.split()
+    return wanted in classes or ' '.join(classes) == wanted
+
+
+def _text(element):
+    # Equivalent of BeautifulSoup's get_text(strip=True)
+    return ''.join(text.strip() for text in _TEXT_NODES(element))
+
+
+class LxmlParser(ListingParser):
+    """
+    libxml2 backend. Items are located with a precompiled XPath and every
+    item subtree is walked once, filling all five fields in the same pass.
+    """
+    name = 'lxml'
+
+    def iter_items(self, html):
+        root = lxml.html.fromstring(html)
+        for item in _FIND_ITEMS(root):
+            yield self._parse_item(item)
+
+    def _parse_item(self, item):
+        found = {}
+        for element in item.iterdescendants():
+            candidates = _SELECTORS_BY_TAG.get(element.tag)
+            if not candidates:
+                continue
+            class_attr = element.get('class')
+            if not class_attr:
+                continue
+            for field, wanted in candidates:
+                if field not in found and _class_matches(class_attr, wanted):
+                    found[field] = element
+            if len(found) == len(FIELD_SELECTORS):
+                break
+
+        texts = {}
+        for field in ('title', 'price', 'seller', 'reviews'):
+            element = found.get(field)
+            texts[field] = _text(element) if element is not None else FALLBACKS[field]
+        image = found.get('image_url')
+        src = image.get('src') if image is not None else None
+        image_url = src if src is not None else FALLBACKS['image_url']
+        title = found.get('title')
+        return ListingItem(
+            item_id=extract_item_id(title.get('href') if title is not None else None, image_url),
+            image_url=image_url,
+            **texts,
+        )
+
+
+PARSERS = {
+    SoupParser.name: SoupParser,
+    LxmlParser.name: LxmlParser,
+}
+
+
+def available_parsers():
+    """Names of the backends that can run in this environment."""
+    return [name for name in PARSERS if name != LxmlParser.name or lxml is not None]
+
+
+def get_parser(name=None):
+    """
+    Return a parser instance. `name` (or the SCRAPER_PARSER environment
+    variable) picks a backend; by default the fastest available one is used.
+    """
+    name = name or os.getenv('SCRAPER_PARSER')
+    if name is None:
+        name = LxmlParser.name if lxml is not None else SoupParser.name
+    if name not in available_parsers():
+        logger.warning("Parser '%s' is not available, falling back to BeautifulSoup.", name)
+        name = SoupParser.name
+    return PARSERS[name]()
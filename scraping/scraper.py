@@ -1,54 +1,180 @@
-import requests
-from bs4 import BeautifulSoup
-
-def search_mercadolibre(search_param, page=1):
-    base_url = 'https://listado.mercadolibre.com.co/'
-    offset = (page - 1) * 48 + 1
-    search_url = f'{base_url}{search_param}_Desde_{offset}_NoIndex_True'
-
-    headers = {
-        'User-Agent': (
-            'Mozilla/5.0 (Windows NT 10.0; Win64; x64) '
-            'AppleWebKit/537.36 (KHTML, like Gecko) Chrome/136.0.0.0 Safari/537.36'
-        )
-    }
-
-    print(f"Requesting URL: {search_url}")
+import asyncio
+import logging
+import os
+import time
+
+from fetcher import HTTP_ERRORS, get_async_fetcher, get_default_fetcher
+from metrics import Counter, Histogram
+from page_cache import get_default_cache
+from parsers import ListingItem, get_parser, parse_result_count # noqa: F401 (ListingItem is re-exported for the backend)
+
+logger = logging.getLogger(__name__)
+
+# SCRAPER_BASE_URL points the scraper somewhere else, e.g. the local stand-in server of standin_server.py
+BASE_URL = os.getenv('SCRAPER_BASE_URL', 'https://listado.mercadolibre.com.co/').rstrip('/') + '/'
+RESULTS_PER_PAGE = 48
+
+PAGE_CACHE_LOOKUPS = Counter('scraper_page_cache_lookups_total', 'Raw page cache lookups, by result (hit or miss).', ['result'])
+PARSE_SECONDS = Histogram('scraper_parse_seconds', 'Time to parse a listing page, by parser backend.', ['parser'])
+ITEMS_PER_PAGE = Histogram(
+    'scraper_items_per_page', 'Items parsed from each listing page.',
+    buckets=(0, 1, 10, 20, 30, 40, 47, 48, 60),
+)
+
+
+class ListingItems(list):
+    """
+    ListingItem records of a listing page, with the totals the page reports
+    for the whole search: `total_results` and `total_pages` (the last page
+    with results), None when not shown. Pages past the last one report 0
+    results.
+    """
+    __slots__ = ('total_results', 'total_pages')
+
+    def __init__(self, items=(), total_results=None, total_pages=None):
+        super().__init__(items)
+        self.total_results = total_results
+        self.total_pages = total_pages
+
+
+def page_offset(page):
+    return (page - 1) * RESULTS_PER_PAGE + 1
+
+
+def listing_url(search_param, page=1):
+    return f'{BASE_URL}{search_param}_Desde_{page_offset(page)}_NoIndex_True'
+
+
+def cached_listing_html(search_param, page=1):
+    """Fresh copy of a listing page from the page cache, or None."""
+    cache = get_default_cache()
+    if cache is None:
+        return None
+    html = cache.get(search_param, page_offset(page))
+    PAGE_CACHE_LOOKUPS.labels('miss' if html is None else 'hit').inc()
+    if html is not None:
+        logger.debug("Using cached page %s for '%s'", page, search_param,
+                     extra={'search_term': search_param, 'page': page})
+    return html
+
+
+def cache_listing_html(search_param, page, html, url):
+    cache = get_default_cache()
+    if cache is not None:
+        try:
+            cache.put(search_param, page_offset(page), html, url=url)
+        except OSError as e:
+            logger.warning("Could not cache page %s of '%s': %s", page, search_param, e)
+
+
+def fetch_listing_html(search_param, page=1, use_cache=True):
+    """
+    Raw HTML of a listing page. Served from the page cache when a fresh copy
+    exists (and `use_cache` is set); every page fetched from the network is
+    written to the cache.
+    """
+    if use_cache:
+        html = cached_listing_html(search_param, page)
+        if html is not None:
+            return html
+
+    search_url = listing_url(search_param, page)
+    logger.debug("Requesting URL: %s", search_url, extra={'search_term': search_param, 'page': page})
+    # Pooled keep-alive session; the fetcher also enforces the request rate limit
+    response = get_default_fetcher().get(search_url)
+    html = response.text
+    cache_listing_html(search_param, page, html, search_url)
+    return html
+
+
+async def fetch_listing_html_async(search_param, page=1, use_cache=True):
+    """
+    fetch_listing_html() for coroutines. The request is sent by the async
+    fetcher of the running loop; the page cache is read and written in a
+    worker thread. Without httpx the whole fetch runs in a worker thread.
+    """
+    fetcher = get_async_fetcher()
+    if fetcher is None:
+        return await asyncio.to_thread(fetch_listing_html, search_param, page, use_cache)
+    if use_cache:
+        html = await asyncio.to_thread(cached_listing_html, search_param, page)
+        if html is not None:
+            return html
+
+    search_url = listing_url(search_param, page)
+    logger.debug("Requesting URL: %s", search_url, extra={'search_term': search_param, 'page': page})
+    response = await fetcher.get(search_url)
+    html = response.text
+    await asyncio.to_thread(cache_listing_html, search_param, page, html, search_url)
+    return html
+
+
+def parse_listing(html):
+    """ListingItems of a listing page, recording the parse time and item count."""
+    # lxml backend when installed, BeautifulSoup otherwise (see parsers.py)
+    parser = get_parser()
+    started = time.perf_counter()
+    results = ListingItems(parser.iter_items(html))
+    results.total_results, results.total_pages = parse_result_count(html)
+    if results.total_pages is None and results.total_results is not None:
+        results.total_pages = -(-results.total_results // RESULTS_PER_PAGE)
+    PARSE_SECONDS.labels(parser.name).observe(time.perf_counter() - started)
+    ITEMS_PER_PAGE.observe(len(results))
+    return results
+
+
+def parse_cached_listing(search_param, page=1):
+    """
+    Parse a page from the cache only, ignoring its age. Returns its ListingItem
+    records, or None when the page is not cached, so re-parsing never touches
+    the network.
+    """
+    cache = get_default_cache()
+    html = cache.get(search_param, page_offset(page), allow_stale=True) if cache is not None else None
+    if html is None:
+        return None
+    return parse_listing(html)
+
+
+def _page_items(search_param, page, results):
+    context = {'search_term': search_param, 'page': page, 'items': len(results)}
+    logger.debug("Found %s items on page %s for '%s'", len(results), page, search_param, extra=context)
+    if not results:
+        logger.info("No items found matching the selector on page %s for '%s'.", page, search_param, extra=context)
+    return results
+
+
+def _page_failed(search_param, page, error):
+    context = {'search_term': search_param, 'page': page}
+    if isinstance(error, HTTP_ERRORS):
+        logger.warning("Error during request for page %s of '%s': %r", page, search_param, error, extra=context)
+    else:
+        logger.error("Unexpected error while parsing page %s of '%s'", page, search_param, extra=context,
+                     exc_info=error)
+    return []
+
+
+def fetch_listing_items(search_param, page=1, use_cache=True):
+    """
+    ListingItems of a listing page. A page that fails to download or parse
+    gives an empty list, like a page past the last one, but without totals.
+    """
     try:
-        response = requests.get(search_url, headers=headers, timeout=10)
-        response.raise_for_status()
-
-        soup = BeautifulSoup(response.text, 'html.parser')
-        items = soup.find_all('li', class_='ui-search-layout__item')
-        print(f"Found {len(items)} items on page {page} for '{search_param}'")
-
-        if not items:
-            print(f"No items found matching the selector on page {page} for '{search_param}'.")
-            return []
-
-        results = []
-        for item in items:
-            title_tag = item.find('a', class_='poly-component__title')
-            price_tag = item.find('span', class_='andes-money-amount andes-money-amount--cents-superscript')
-            seller_tag = item.find('span', class_='poly-component__seller')
-            reviews_tag = item.find('span', class_='andes-visually-hidden')
-            image_tag = item.find('img', class_='poly-component__picture')
-
-            results.append({
-                'title': title_tag.get_text(strip=True) if title_tag else 'No title',
-                'price': price_tag.get_text(strip=True) if price_tag else 'No price',
-                'seller': seller_tag.get_text(strip=True) if seller_tag else 'No seller info',
-                'reviews': reviews_tag.get_text(strip=True) if reviews_tag else 'No reviews',
-                'image_url': (
-                    image_tag.get('src') if image_tag and image_tag.has_attr('src') else 'No image'
-                )
-            })
-
-        return results
-
-    except requests.exceptions.RequestException as e:
-        print(f"Error during request for page {page} of '{search_param}': {e}")
-        return []
+        html = fetch_listing_html(search_param, page, use_cache=use_cache)
+        return _page_items(search_param, page, parse_listing(html))
     except Exception as e:
-        print(f"Unexpected error while parsing page {page} of '{search_param}': {e}")
-        return []
+        return _page_failed(search_param, page, e)
+
+
+async def fetch_listing_items_async(search_param, page=1, use_cache=True):
+    """fetch_listing_items() for coroutines. The page is parsed in a worker thread, off the event loop."""
+    try:
+        html = await fetch_listing_html_async(search_param, page, use_cache=use_cache)
+        return _page_items(search_param, page, await asyncio.to_thread(parse_listing, html))
+    except Exception as e:
+        return _page_failed(search_param, page, e)
+
+
+def search_mercadolibre(search_param, page=1, use_cache=True):
+    """Items of a listing page as dicts (see parsers.ListingItem.as_dict())."""
+    return [item.as_dict() for item in fetch_listing_items(search_param, page, use_cache=use_cache)]
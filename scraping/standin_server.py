@@ -0,0 +1,214 @@
+"""
+Local stand-in for listado.mercadolibre.com.co, for benchmarks and offline runs.
+
+Serves the recorded pages in fixtures/ at the listing URLs the scraper builds
+({term}_Desde_{offset}_NoIndex_True): full pages up to the last page of a
+term, the partial last page, then the "no results" page. Item and picture
+ids are rewritten per term and page, so every page has products of its own,
+and the result and page counts shown match the pages of the term.
+Latency, error rate, page counts and price changes between fetches are
+configurable. GET /_stats returns the requests served so far as JSON.
+
+Point the scraper at it with SCRAPER_BASE_URL=http://127.0.0.1:<port>/.
+
+Usage: python standin_server.py [--port 8765] [--latency 0.2] [--jitter 0.05]
+       [--error-rate 0] [--pages 20] [--term-pages iphone=3 ...]
+       [--price-change-rate 0] [--seed N]
+"""
+import argparse
+import json
+import random
+import re
+import sys
+import threading
+import time
+import zlib
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import unquote
+
+FIXTURES_DIR = Path(__file__).resolve().parent / 'fixtures'
+RESULTS_PER_PAGE = 48
+
+_LISTING_PATH = re.compile(r'^/(?P<term>.+)_Desde_(?P<offset>\d+)_NoIndex_True$')
+# Same shape as the ids parsers.extract_item_id() looks for (links and picture ids)
+_ITEM_ID = re.compile(r'\b(M[A-Z]{2}-?)(\d{6,})')
+_PRICE_FRACTION = re.compile(r'(andes-money-amount__fraction[^>]*>)([\d.]+)(<)')
+# Totals of the search shown in the header and pagination, rewritten to match the pages of each term
+_RESULT_COUNT = re.compile(r'(quantity-results[^>]*>)[\d.]+')
+_PAGE_COUNT = re.compile(r'(pagination__page-count[^>]*>de (?:<!-- -->)?)\d+')
+_ITEM = 'class="ui-search-layout__item'
+
+
+class StandinOptions:
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, pages=20, term_pages=None,
+                 price_change_rate=0.0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.pages = pages # Pages with results of every term not in term_pages
+        self.term_pages = term_pages or {}
+        self.price_change_rate = price_change_rate
+        self.random = random.Random(seed)
+        self.random_lock = threading.Lock()
+
+    def pages_for(self, term):
+        return self.term_pages.get(term, self.pages)
+
+    def draw(self):
+        with self.random_lock:
+            return self.random.random()
+
+
+def load_fixtures():
+    return {
+        name: (FIXTURES_DIR / f'listing_page_{name}.html').read_text(encoding='utf-8')
+        for name in ('1', 'last', 'empty')
+    }
+
+
+def rewrite_ids(html, term, page):
+    """Give the ids of a recorded page a prefix unique to (term, page), keeping their shape."""
+    prefix = f'{zlib.crc32(term.encode("utf-8")) % 10000:04d}{page:05d}'
+    return _ITEM_ID.sub(lambda match: f'{match.group(1)}{prefix}{match.group(2)}', html)
+
+
+def drift_prices(html, options):
+    """Raise each price by 1% with probability `price_change_rate`, to simulate a refresh finding changes."""
+    if not options.price_change_rate:
+        return html
+
+    def drift(match):
+        if options.draw() >= options.price_change_rate:
+            return match.group(0)
+        amount = int(match.group(2).replace('.', ''))
+        amount += max(1, amount // 100)
+        return f'{match.group(1)}{amount:,}{match.group(3)}'.replace(',', '.')
+
+    return _PRICE_FRACTION.sub(drift, html)
+
+
+def rewrite_totals(html, fixtures, last_page):
+    """Report the result and page counts of a term with `last_page` pages instead of the recorded ones."""
+    total_results = (last_page - 1) * RESULTS_PER_PAGE + fixtures['last'].count(_ITEM)
+    html = _RESULT_COUNT.sub(lambda match: f'{match.group(1)}{total_results:,}'.replace(',', '.'), html, count=1)
+    return _PAGE_COUNT.sub(lambda match: f'{match.group(1)}{last_page}', html, count=1)
+
+
+def listing_page(fixtures, options, term, page):
+    """Body of page `page` of `term`: a full page, the last (partial) page, or no results."""
+    last_page = options.pages_for(term)
+    if page > last_page:
+        return fixtures['empty']
+    html = fixtures['1'] if page < last_page else fixtures['last']
+    html = rewrite_totals(html, fixtures, last_page)
+    return drift_prices(rewrite_ids(html, term, page), options)
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    fixtures = None
+    options = None
+    stats = None
+    stats_lock = None
+
+    def count(self, key):
+        with self.stats_lock:
+            self.stats[key] += 1
+
+    def send_body(self, status, body, content_type='text/html; charset=utf-8'):
+        data = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == '/_stats':
+            with self.stats_lock:
+                stats = dict(self.stats)
+            return self.send_body(200, json.dumps(stats), 'application/json')
+
+        match = _LISTING_PATH.match(self.path.split('?')[0])
+        if match is None:
+            self.count('404')
+            return self.send_body(404, 'Not found')
+
+        options = self.options
+        delay = options.latency + options.jitter * (2 * options.draw() - 1)
+        if delay > 0:
+            time.sleep(delay)
+        if options.error_rate and options.draw() < options.error_rate:
+            self.count('503')
+            return self.send_body(503, 'Service unavailable')
+
+        term = unquote(match.group('term'))
+        page = (int(match.group('offset')) - 1) // RESULTS_PER_PAGE + 1
+        self.count('200')
+        self.send_body(200, listing_page(self.fixtures, options, term, page))
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StandinServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # socketserver's default backlog of 5 drops connections when hundreds of clients connect at once
+    request_queue_size = 1024
+
+
+def make_server(options, port=0, address='127.0.0.1'):
+    """A threaded HTTP server serving the stand-in (not started). Port 0 picks a free port."""
+    handler = type('Handler', (StandinHandler,), {
+        'fixtures': load_fixtures(),
+        'options': options,
+        'stats': Counter(),
+        'stats_lock': threading.Lock(),
+    })
+    return StandinServer((address, port), handler)
+
+
+def parse_term_pages(values):
+    term_pages = {}
+    for value in values:
+        term, _, pages = value.rpartition('=')
+        if not term or not pages.isdigit():
+            raise argparse.ArgumentTypeError(f"--term-pages expects TERM=PAGES, got '{value}'")
+        term_pages[term] = int(pages)
+    return term_pages
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve recorded MercadoLibre listing pages locally.')
+    parser.add_argument('--port', type=int, default=8765, help='Port to listen on (0 picks a free one).')
+    parser.add_argument('--address', default='127.0.0.1')
+    parser.add_argument('--latency', type=float, default=0.2, help='Seconds before each page is answered.')
+    parser.add_argument('--jitter', type=float, default=0.05, help='Latency varies uniformly by up to this many seconds.')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of page requests answered with 503.')
+    parser.add_argument('--pages', type=int, default=20, help='Pages with results of every term.')
+    parser.add_argument('--term-pages', nargs='*', default=[], metavar='TERM=PAGES', help='Pages with results of given terms.')
+    parser.add_argument('--price-change-rate', type=float, default=0.0,
+                        help='Fraction of prices that change each time a page is served.')
+    parser.add_argument('--seed', type=int, default=None, help='Seed for latency jitter, errors and price changes.')
+    args = parser.parse_args()
+
+    options = StandinOptions(
+        latency=args.latency, jitter=args.jitter, error_rate=args.error_rate, pages=args.pages,
+        term_pages=parse_term_pages(args.term_pages), price_change_rate=args.price_change_rate, seed=args.seed,
+    )
+    server = make_server(options, args.port, args.address)
+    host, port = server.server_address[:2]
+    # First line of output: read by bench_scrape to find the port
+    print(f'Listening on http://{host}:{port}/', flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())